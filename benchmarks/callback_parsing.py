@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""
+Compare the CPU cost of parsing a The3rdMan callback with the original
+minidom and ``parse_qs`` implementations and the current single-pass parser.
+
+The last column is the number of callbacks one core could parse per second,
+which is the ceiling on the callback rate before any database work.
+
+Run from the repo root with::
+
+    python benchmarks/callback_parsing.py
+"""
+import os
+import sys
+import timeit
+from xml.dom.minidom import parseString
+
+from six.moves.urllib.parse import parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from datacash.the3rdman import parsing  # noqa
+
+XML_CALLBACK = b"""<?xml version="1.0" encoding="utf-8"?>
+<RealTimeCallBack xmlns="T3MCallback">
+    <aggregator_identifier/>
+    <merchant_identifier>32217</merchant_identifier>
+    <merchant_order_ref>100117</merchant_order_ref>
+    <t3m_id>1815120370</t3m_id>
+    <score>46</score>
+    <recommendation>1</recommendation>
+    <message_digest>baa7421d73c962ce92220e64526af1a559f26f46</message_digest>
+</RealTimeCallBack>"""
+
+QUERY_CALLBACK = (
+    b"aggregator_identifier=&merchant_identifier=32195&"
+    b"merchant_order_ref=100032&t3m_id=1701673332&score=114&recommendation=2&"
+    b"message_digest=87d81ea49035fe2f8d59ceea3f16b1f43744701c")
+
+
+def minidom_extract(xml_str):
+    # The implementation FraudResponse used before the streaming parser
+    def tag_text(doc, tag_name):
+        try:
+            ele = doc.getElementsByTagName(tag_name)[0]
+        except IndexError:
+            return ''
+        if ele.firstChild:
+            return ele.firstChild.data
+        return ''
+    doc = parseString(xml_str)
+    return dict((name, tag_text(doc, name)) for name in parsing.FIELDS)
+
+
+def parse_qs_extract(query):
+    data = parse_qs(query)
+    return dict((name, data.get(name, [""])[0]) for name in parsing.FIELDS)
+
+
+def main(number=20000):
+    print("%-12s %12s %12s %16s" % ("", "original", "single-pass",
+                                    "callbacks/s"))
+    for label, body, original in (
+            ('xml', XML_CALLBACK, minidom_extract),
+            ('querystring', QUERY_CALLBACK, parse_qs_extract)):
+        row = []
+        for fn in (original, parsing.parse_callback):
+            seconds = min(timeit.repeat(lambda: fn(body), number=number,
+                                        repeat=3))
+            row.append(seconds / number * 1e6)
+        print("%-12s %10.1fus %10.1fus %16.0f" % (
+            label, row[0], row[1], 1e6 / row[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+"""
+Compare the CPU cost of building request XML with minidom and with the
+streaming serialiser.
+
+Run from the repo root with::
+
+    python benchmarks/request_building.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from datacash.gateway import Gateway  # noqa
+from tests.gateway_tests import (  # noqa
+    RequestXmlEquivalenceTests, minidom_request_xml)
+
+
+def main(number=5000):
+    gateway = Gateway('example.com', '/Transaction', 'client', 'password', True)
+    print("%-12s %12s %12s" % ("", "minidom", "streaming"))
+    for method, kwargs in RequestXmlEquivalenceTests.requests:
+        label = method
+        if kwargs.get('the3rdman_data'):
+            label += '+3rdman'
+        row = []
+        for fn in (lambda: minidom_request_xml(gateway, method, **kwargs),
+                   lambda: gateway._build_request_xml(method, **kwargs)):
+            seconds = min(timeit.repeat(fn, number=number, repeat=3))
+            row.append(seconds / number * 1e6)
+        print("%-12s %10.1fus %10.1fus" % (label, row[0], row[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""
+Compare the CPU cost of parsing a gateway response with the original minidom
+implementation and the current single-pass parser.
+
+Run from the repo root with::
+
+    python benchmarks/response_parsing.py
+"""
+import os
+import sys
+import timeit
+from xml.dom.minidom import parseString
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from datacash.gateway import Response  # noqa
+from tests import fixtures  # noqa
+
+
+def minidom_extract(response_xml):
+    # The implementation Response used before the streaming parser
+    def text(doc, tag):
+        try:
+            ele = doc.getElementsByTagName(tag)[0]
+        except IndexError:
+            return None
+        return ele.firstChild.data
+    doc = parseString(response_xml)
+    return dict((key, text(doc, tag))
+                for key, tag in Response.field_tags.items())
+
+
+def streaming_extract(response_xml):
+    return Response('', response_xml).is_successful()
+
+
+def main(number=20000):
+    print("%-10s %12s %12s" % ("", "minidom", "streaming"))
+    for label, xml in (('auth', fixtures.SAMPLE_RESPONSE),
+                       ('fulfill', fixtures.SAMPLE_SUCCESSFUL_FULFILL_RESPONSE)):
+        row = []
+        for fn in (minidom_extract, streaming_extract):
+            seconds = min(timeit.repeat(lambda: fn(xml), number=number,
+                                        repeat=3))
+            row.append(seconds / number * 1e6)
+        print("%-10s %10.1fus %10.1fus" % (label, row[0], row[1]))
+
+
+if __name__ == '__main__':
+    main()
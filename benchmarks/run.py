@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks for the hot paths of the Datacash package.
+
+Nothing is sent to Datacash: requests are built and responses parsed from
+the test fixtures and models are saved to an in-memory SQLite database.
+
+Usage (from the repo root)::
+
+    python benchmarks/run.py                      # run everything
+    python benchmarks/run.py build parse          # only matching benchmarks
+    python benchmarks/run.py --save baseline.json
+    python benchmarks/run.py --compare baseline.json
+
+Results of every run are written to benchmarks/results/ as JSON.
+"""
+import datetime
+import itertools
+import json
+import os
+import platform
+import sys
+import time
+from optparse import OptionParser
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2
+    tracemalloc = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+
+import django  # noqa
+from django.conf import settings  # noqa
+
+if not settings.configured:
+    settings.configure(
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3'}},
+        INSTALLED_APPS=['django.contrib.contenttypes', 'django.contrib.auth',
+                        'datacash'],
+        DATACASH_HOST='testserver.datacash.com',
+        DATACASH_CLIENT='99000001',
+        DATACASH_PASSWORD='boomboom',
+        DATACASH_CURRENCY='GBP',
+        DATACASH_USE_CV2AVS=True,
+    )
+    if hasattr(django, 'setup'):
+        django.setup()
+
+from django.db import connection  # noqa
+
+from tests import fixtures  # noqa
+from tests.gateway_tests import (  # noqa
+    CARD_KWARGS, THE3RDMAN_DATA, RequestXmlEquivalenceTests)
+from tests.the3rdman_model_tests import QUERY_RESPONSE, stub_response  # noqa
+
+BENCHMARKS = []
+
+
+def benchmark(name):
+    """
+    Register a benchmark.  The decorated function does any set-up and
+    returns the callable to be timed, or a ``(callable, teardown)`` pair.
+    """
+    def decorator(fn):
+        BENCHMARKS.append((name, fn))
+        return fn
+    return decorator
+
+
+# Gateway
+
+def _build_benchmark(method, kwargs):
+    from datacash.gateway import Gateway
+
+    def setup():
+        gateway = Gateway('example.com', '/Transaction', 'client',
+                          'password', True)
+        return lambda: gateway._build_request_xml(method, **kwargs)
+    return setup
+
+for _method, _kwargs in RequestXmlEquivalenceTests.requests:
+    _name = 'build.%s' % _method
+    if _kwargs.get('the3rdman_data'):
+        _name += '.3rdman'
+    if _name not in dict(BENCHMARKS):
+        benchmark(_name)(_build_benchmark(_method, _kwargs))
+
+
+@benchmark('parse.response')
+def parse_response():
+    from datacash.gateway import Response
+    return lambda: Response('', fixtures.SAMPLE_RESPONSE).is_successful()
+
+
+@benchmark('check_kwargs')
+def check_kwargs():
+    from datacash.gateway import Gateway, REQUIRED_KWARGS
+    gateway = Gateway('example.com', '/Transaction', 'client', 'password')
+    return lambda: gateway._check_kwargs(dict(CARD_KWARGS),
+                                         REQUIRED_KWARGS['auth'])
+
+
+# Models
+
+@benchmark('model.save_redaction')
+def save_redaction():
+    from mock import patch
+    from django.db.models import Model
+    from datacash.models import OrderTransaction
+
+    # Only time the redaction, not the INSERT
+    patcher = patch.object(Model, 'save')
+    patcher.start()
+
+    def op():
+        OrderTransaction(request_xml=fixtures.SAMPLE_CV2AVS_REQUEST).save()
+    return op, patcher.stop
+
+
+@benchmark('model.scrub')
+def scrub_request():
+    from datacash.scrubber import scrub
+    return lambda: scrub(fixtures.SAMPLE_CV2AVS_REQUEST)
+
+
+@benchmark('model.prettify_xml')
+def prettify():
+    from datacash.models import prettify_xml
+    return lambda: prettify_xml(fixtures.SAMPLE_CV2AVS_REQUEST)
+
+
+@benchmark('fraud.parse_xml')
+def parse_fraud_xml():
+    from datacash.the3rdman import parsing
+    xml = stub_response(score=46, recommendation=1)
+    return lambda: parsing.parse_callback(xml)
+
+
+@benchmark('fraud.parse_querystring')
+def parse_fraud_querystring():
+    from datacash.the3rdman import parsing
+    return lambda: parsing.parse_callback(QUERY_RESPONSE)
+
+
+def _unique_callbacks(callback, t3m_id):
+    # Repeated callbacks aren't saved again, so give each one a new t3m ID
+    ids = itertools.count()
+    return lambda: callback.replace(t3m_id, '%s%d' % (t3m_id, next(ids)))
+
+
+@benchmark('fraud.create_from_xml')
+def create_from_xml():
+    from datacash.models import FraudResponse
+    callbacks = _unique_callbacks(
+        stub_response(score=46, recommendation=1), '333333333')
+    return lambda: FraudResponse.create_from_xml(callbacks())
+
+
+@benchmark('fraud.create_from_querystring')
+def create_from_querystring():
+    from datacash.models import FraudResponse
+    callbacks = _unique_callbacks(QUERY_RESPONSE, '1701673332')
+    return lambda: FraudResponse.create_from_querystring(callbacks())
+
+
+# The3rdMan
+
+def _fraud_fields_benchmark(num_products):
+    def setup():
+        from datacash import the3rdman
+        product = THE3RDMAN_DATA['order_info']['products'][0]
+        data = dict(THE3RDMAN_DATA,
+                    order_info={'products': [product] * num_products})
+        return lambda: the3rdman.add_fraud_fields(**data)
+    return setup
+
+for _n in (1, 50, 500):
+    benchmark('the3rdman.add_fraud_fields.%d' % _n)(_fraud_fields_benchmark(_n))
+
+
+# Facade
+
+@benchmark('facade.merchant_reference')
+def merchant_reference():
+    from datacash.facade import Facade
+    facade = Facade()
+    return lambda: facade.merchant_reference('100500', 'pre')
+
+
+# Runner
+
+def time_op(op, min_time=0.2, repeat=3):
+    """
+    Return the best ops/sec over ``repeat`` runs of at least ``min_time``
+    seconds each
+    """
+    number = 1
+    while True:
+        start = time.time()
+        for i in range(number):
+            op()
+        elapsed = time.time() - start
+        if elapsed >= min_time:
+            break
+        number *= 2
+    best = elapsed
+    for i in range(repeat - 1):
+        start = time.time()
+        for i in range(number):
+            op()
+        best = min(best, time.time() - start)
+    return number / best
+
+
+def measure_allocations(op, number=50):
+    """
+    Return the peak memory allocated (in bytes) during a single call
+    """
+    if tracemalloc is None:
+        return None
+    op()  # Warm up any caches
+    tracemalloc.start()
+    try:
+        peak = 0
+        for i in range(number):
+            tracemalloc.clear_traces()
+            base = tracemalloc.get_traced_memory()[0]
+            op()
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - base)
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def run(patterns):
+    connection.creation.create_test_db(verbosity=0)
+    print("%-36s %18s %14s" % ("", "throughput", "peak memory"))
+    results = {}
+    for name, setup in BENCHMARKS:
+        if patterns and not any(p in name for p in patterns):
+            continue
+        op, teardown = setup(), None
+        if isinstance(op, tuple):
+            op, teardown = op
+        try:
+            results[name] = {
+                'ops_per_sec': time_op(op),
+                'peak_bytes': measure_allocations(op),
+            }
+        finally:
+            if teardown is not None:
+                teardown()
+        print_result(name, results[name])
+    return results
+
+
+def print_result(name, result, baseline=None):
+    line = "%-36s %12.0f ops/s" % (name, result['ops_per_sec'])
+    if result['peak_bytes'] is not None:
+        line += " %10.1f KiB" % (result['peak_bytes'] / 1024.0)
+    if baseline is not None:
+        change = (result['ops_per_sec'] / baseline['ops_per_sec'] - 1) * 100
+        line += " %+7.1f%%" % change
+    print(line)
+
+
+def save(results, path):
+    data = {
+        'date': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'results': results,
+    }
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+
+
+def compare(results, path):
+    with open(path) as f:
+        baseline = json.load(f)['results']
+    print("\nCompared with %s:" % path)
+    for name in sorted(results):
+        print_result(name, results[name], baseline.get(name))
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="%prog [options] [pattern ...]")
+    parser.add_option('--save', help="Also save results to this file")
+    parser.add_option('--compare', help="Compare results with this file")
+    options, args = parser.parse_args()
+
+    results = run(args)
+    save(results, os.path.join(RESULTS_DIR, '%s.json' % (
+        datetime.datetime.now().strftime('%Y%m%d-%H%M%S'))))
+    if options.save:
+        save(results, options.save)
+    if options.compare:
+        compare(results, options.compare)
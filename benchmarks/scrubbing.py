@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+Compare the CPU cost of masking sensitive data in request XML with the
+original three-regex implementation and the single-pass scrubber.
+
+Run from the repo root with::
+
+    python benchmarks/scrubbing.py
+"""
+import os
+import re
+import sys
+import timeit
+from decimal import Decimal as D
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from datacash.gateway import Gateway  # noqa
+from datacash.scrubber import scrub  # noqa
+from tests import fixtures  # noqa
+from tests.gateway_tests import THE3RDMAN_DATA  # noqa
+
+
+def _replace_credit_card_number(matchobj):
+    return "<%(element)s>%(hidden)s%(last4)s</%(element)s>" % {
+        'element': matchobj.group(1),
+        'hidden': "X" * len(matchobj.group(2)),
+        'last4': matchobj.group(3),
+    }
+
+
+def three_pass_scrub(request_xml):
+    # The implementation OrderTransaction.save used before the scrubber
+    cc_regex = re.compile(r'<(pan|alt_pan)>(\d+)(\d{4})</\1>')
+    request_xml = cc_regex.sub(_replace_credit_card_number, request_xml)
+    ccv_regex = re.compile(r'<cv2>\d+</cv2>')
+    request_xml = ccv_regex.sub('<cv2>XXX</cv2>', request_xml)
+    pw_regex = re.compile(r'<password>.*</password>')
+    return pw_regex.sub('<password>XXX</password>', request_xml)
+
+
+def documents():
+    gateway = Gateway('example.com', '/Transaction', '99001381',
+                      'hbANDMzErH', cv2avs=True)
+    auth = gateway._build_request_xml(
+        'auth', amount=D('35.21'), currency='GBP',
+        card_number='1000350000000007', expiry_date='10/12',
+        merchant_reference='100024_182223', ccv='123',
+        address_line1='1 house', postcode='n12 9et')
+    fraud = gateway._build_request_xml(
+        'pre', amount=D('35.21'), currency='GBP',
+        card_number='1000350000000007', expiry_date='10/12',
+        merchant_reference='100024_182223', ccv='123',
+        the3rdman_data=dict(THE3RDMAN_DATA, order_info={
+            'products': THE3RDMAN_DATA['order_info']['products'] * 20}))
+    return (('fixture', fixtures.SAMPLE_CV2AVS_REQUEST),
+            ('auth', auth),
+            ('3rdman', fraud),
+            ('3rdman-bytes', fraud.encode('utf8')))
+
+
+def main(number=20000):
+    print("%-14s %8s %12s %12s" % ("", "bytes", "three-pass", "single-pass"))
+    for label, xml in documents():
+        if isinstance(xml, bytes) and not isinstance(xml, str):
+            # The original implementation only handled text
+            three_pass = None
+        else:
+            assert three_pass_scrub(xml) == scrub(xml), label
+            three_pass = min(timeit.repeat(lambda: three_pass_scrub(xml),
+                                           number=number, repeat=3))
+        single_pass = min(timeit.repeat(lambda: scrub(xml), number=number,
+                                        repeat=3))
+        print("%-14s %8d %12s %10.1fus" % (
+            label, len(xml),
+            '%10.1fus' % (three_pass / number * 1e6) if three_pass else '-',
+            single_pass / number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
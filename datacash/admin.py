@@ -5,7 +5,24 @@ from datacash.models import OrderTransaction
 class OrderTransactionAdmin(admin.ModelAdmin):
     readonly_fields = ('order_number', 'method', 'amount', 'merchant_reference',
                        'datacash_reference', 'auth_code', 'status', 'reason',
-                       'request_xml', 'response_xml', 'date_created')
+                       'request_xml', 'response_xml', 'date_created',
+                       'date_restored')
 
+    def get_queryset(self, request):
+        # The changelist doesn't show the (large) XML
+        parent = super(OrderTransactionAdmin, self)
+        queryset = getattr(parent, 'get_queryset', None) or parent.queryset
+        return queryset(request).without_payload()
 
-admin.site.register(OrderTransaction, OrderTransactionAdmin)
\ No newline at end of file
+    # Django < 1.6
+    queryset = get_queryset
+
+    def get_object(self, request, object_id, *args):
+        # ...but the change form does
+        try:
+            return OrderTransaction.objects.get(pk=int(object_id))
+        except (OrderTransaction.DoesNotExist, ValueError):
+            return None
+
+
+admin.site.register(OrderTransaction, OrderTransactionAdmin)
@@ -0,0 +1,6 @@
+"""
+asyncio versions of the gateway and facade.
+
+The modules in this package use ``async``/``await`` syntax and so require
+Python 3.5 or later.  Nothing else in ``datacash`` imports them.
+"""
@@ -0,0 +1,140 @@
+"""
+ASGI version of the The3rdMan callback view.
+
+Django (up to 1.7) can't serve a view asynchronously, so this is a plain ASGI
+application which handles the ``datacash-3rdman-callback`` URL itself and
+passes every other request to the application it wraps, eg::
+
+    from asgiref.wsgi import WsgiToAsgi
+    from django.core.wsgi import get_wsgi_application
+    from datacash.aio.callback import CallbackApplication
+
+    application = CallbackApplication(WsgiToAsgi(get_wsgi_application()))
+
+The body is read and parsed on the event loop and only the ORM calls and
+synchronous ``response_received`` receivers are run in a worker thread.
+Receivers may also be coroutine functions, which are awaited on the event
+loop.  (The synchronous callback view can't await them, so only connect
+async receivers when all callbacks come through this application.)
+"""
+import asyncio
+import logging
+
+from django.core.urlresolvers import reverse
+
+from datacash.models import FraudResponse
+from datacash.the3rdman import inbox, parsing, signals
+
+from .utils import run_sync
+
+logger = logging.getLogger('datacash.the3rdman')
+
+
+class CallbackApplication(object):
+    """
+    Handle The3rdMan callbacks, passing other requests to ``application``
+    """
+    url_name = 'datacash-3rdman-callback'
+
+    def __init__(self, application=None):
+        self.application = application
+        self._path = None
+
+    @property
+    def path(self):
+        # The URLconf may not be loaded when this is created.  The path is
+        # relative to where the application is mounted (the script prefix).
+        if self._path is None:
+            self._path = reverse(self.url_name, prefix='/')
+        return self._path
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or request_path(scope) != self.path:
+            if self.application is not None:
+                await self.application(scope, receive, send)
+            elif scope['type'] == 'http':
+                await respond(send, 404, b"not found")
+            return
+        if scope['method'] != 'POST':
+            await respond(send, 405, b"", [(b'allow', b'POST')])
+            return
+
+        try:
+            body = await read_body(receive)
+            await self.handle(body)
+        except Exception:
+            logger.error("Error raised handling response", exc_info=True)
+            await respond(send, 500, b"error")
+        else:
+            await respond(send, 200, b"ok")
+
+    async def handle(self, body):
+        if inbox.ack_first_enabled():
+            callback = await run_sync(inbox.store, body)
+            logger.info("Response stored as callback %s", callback.pk)
+            return
+        response = FraudResponse.build_from_body(body)
+        response, created = await run_sync(response.save_unless_repeat)
+        if created:
+            await send_response_received(response)
+        logger.info("Successful response received with merchant ref %s",
+                    response.merchant_order_ref)
+
+
+def request_path(scope):
+    """
+    Return the path of a request relative to where the application is mounted
+    """
+    path, root_path = scope['path'], scope.get('root_path', '')
+    if root_path and path.startswith(root_path):
+        # Servers include the root path in the path
+        path = path[len(root_path):]
+    return path
+
+
+async def read_body(receive, max_size=parsing.MAX_SIZE):
+    """
+    Read a request body, rejecting it as soon as it is too large
+    """
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise parsing.InvalidCallback("Client disconnected")
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > max_size:
+            raise parsing.InvalidCallback(
+                "Callback is too large (over %d bytes)" % max_size)
+        chunks.append(chunk)
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+async def send_response_received(response):
+    """
+    Send ``response_received``, running synchronous receivers in a worker
+    thread and awaiting coroutine receivers.  As with ``send_robust``,
+    errors raised by receivers are logged rather than raised.
+    """
+    results = await run_sync(signals.response_received.send_robust,
+                             sender=FraudResponse, response=response)
+    for receiver, result in results:
+        if asyncio.iscoroutine(result):
+            try:
+                await result
+            except Exception:
+                logger.error("Error raised by receiver %r", receiver,
+                             exc_info=True)
+        elif isinstance(result, Exception):
+            logger.error("Error raised by receiver %r: %r", receiver, result)
+
+
+async def respond(send, status, body, headers=()):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'text/plain')] + list(headers),
+    })
+    await send({'type': 'http.response.body', 'body': body})
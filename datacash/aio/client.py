@@ -0,0 +1,308 @@
+"""
+A minimal HTTP/1.1 client built on asyncio streams.
+
+It only supports what the Datacash XML endpoint needs: POSTing a body and
+reading back a response delimited by ``Content-Length``, chunked encoding or
+connection close.  Connections are kept alive and pooled per event loop.
+"""
+import asyncio
+import collections
+import ssl
+import time
+import weakref
+
+from datacash.connection import SENDING_HEADERS, SENDING_BODY, RECEIVING
+
+# Errors which show that a re-used connection was closed by the server while
+# it sat idle in the pool.  As with the blocking pool, the request is only
+# retried (once, on a new connection) when the server can't have received it.
+STALE_CONNECTION_ERRORS = (ConnectionResetError, BrokenPipeError,
+                           ConnectionAbortedError)
+
+_pools = weakref.WeakKeyDictionary()
+
+
+class HTTPError(Exception):
+    pass
+
+
+class RemoteDisconnected(ConnectionResetError):
+    """
+    The server closed the connection without sending any of the response
+    """
+
+
+class CountingStreamReader(asyncio.StreamReader):
+    """
+    StreamReader which counts the bytes fed to it by its protocol
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CountingStreamReader, self).__init__(*args, **kwargs)
+        self.num_received = 0
+
+    def feed_data(self, data):
+        self.num_received += len(data)
+        super(CountingStreamReader, self).feed_data(data)
+
+
+class AsyncConnection(object):
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.created = self.last_used = time.time()
+        self.num_requests = 0
+        # Bytes consumed from the reader, to spot unread data
+        self.num_read = 0
+        self.phase = None
+
+    def is_expired(self, now, idle_timeout, max_lifetime):
+        if idle_timeout is not None and now - self.last_used > idle_timeout:
+            return True
+        if max_lifetime is not None and now - self.created > max_lifetime:
+            return True
+        return False
+
+    def is_broken(self):
+        # An idle keep-alive connection should have no unread data and must
+        # not have seen EOF or an error.
+        if self.reader.at_eof() or self.reader.exception() is not None:
+            return True
+        if self.reader.num_received != self.num_read:
+            return True
+        transport = self.writer.transport
+        return transport is None or transport.is_closing()
+
+    def close(self):
+        try:
+            self.writer.close()
+        except Exception:
+            pass
+
+    async def request(self, method, host, path, body, headers):
+        """
+        Send a request and return ``(status, headers, body)``
+        """
+        lines = ['%s %s HTTP/1.1' % (method, path),
+                 'Host: %s' % host,
+                 'Content-Length: %d' % len(body),
+                 'Connection: keep-alive']
+        for name, value in headers.items():
+            lines.append('%s: %s' % (name, value))
+        head = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+        self.phase = SENDING_HEADERS
+        self.writer.write(head)
+        await self.writer.drain()
+        self.phase = SENDING_BODY
+        self.writer.write(body)
+        await self.writer.drain()
+
+        self.phase = RECEIVING
+        status_line = await self._readline()
+        if not status_line:
+            raise RemoteDisconnected("Connection closed by server")
+        try:
+            version, status = status_line.split(None, 2)[:2]
+            status = int(status)
+        except ValueError:
+            raise HTTPError("Invalid status line: %r" % status_line)
+
+        response_headers = {}
+        while True:
+            line = await self._readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+
+        if response_headers.get('transfer-encoding', '').lower() == 'chunked':
+            content = await self._read_chunked()
+        elif 'content-length' in response_headers:
+            content = await self._readexactly(
+                int(response_headers['content-length']))
+        else:
+            content = await self._read()
+            response_headers['connection'] = 'close'
+        self.num_requests += 1
+        self.phase = None
+        return status, response_headers, content
+
+    async def _readline(self):
+        line = await self.reader.readline()
+        self.num_read += len(line)
+        return line
+
+    async def _readexactly(self, n):
+        data = await self.reader.readexactly(n)
+        self.num_read += n
+        return data
+
+    async def _read(self):
+        data = await self.reader.read()
+        self.num_read += len(data)
+        return data
+
+    async def _read_chunked(self):
+        chunks = []
+        while True:
+            size_line = await self._readline()
+            size = int(size_line.split(b';', 1)[0].strip(), 16)
+            if size == 0:
+                # Skip trailers
+                while (await self._readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                return b''.join(chunks)
+            chunks.append(await self._readexactly(size))
+            await self._readexactly(2)
+
+
+class AsyncConnectionPool(object):
+    """
+    A pool of keep-alive connections to a single host for one event loop.
+
+    At most ``max_connections`` requests are in flight at once; further
+    requests wait for a free slot.  Up to ``maxsize`` idle connections are
+    kept for re-use.
+    """
+
+    def __init__(self, host, port=None, timeout=30, maxsize=10,
+                 max_connections=100, idle_timeout=60, max_lifetime=300,
+                 secure=True, ssl_context=None):
+        if port is None and ':' in host:
+            host, port = host.rsplit(':', 1)
+            port = int(port)
+        self.host = host
+        self.port = port or (443 if secure else 80)
+        self.timeout = timeout
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.secure = secure
+        self.ssl_context = ssl_context
+        self._idle = collections.deque()
+        self._semaphore = asyncio.Semaphore(max_connections)
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.discarded = 0
+        self.retries = 0
+
+    @property
+    def host_header(self):
+        default_port = 443 if self.secure else 80
+        if self.port == default_port:
+            return self.host
+        return '%s:%s' % (self.host, self.port)
+
+    async def _new_connection(self):
+        ssl_context = None
+        if self.secure:
+            ssl_context = self.ssl_context or ssl.create_default_context()
+        # As asyncio.open_connection but with a reader which counts the bytes
+        # received
+        loop = asyncio.get_event_loop()
+        reader = CountingStreamReader(loop=loop)
+        protocol = asyncio.StreamReaderProtocol(reader, loop=loop)
+        transport, _ = await loop.create_connection(
+            lambda: protocol, self.host, self.port, ssl=ssl_context)
+        writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+        return AsyncConnection(reader, writer)
+
+    async def acquire(self):
+        now = time.time()
+        while self._idle:
+            conn = self._idle.pop()
+            if (conn.is_expired(now, self.idle_timeout, self.max_lifetime)
+                    or conn.is_broken()):
+                self.discard(conn)
+                continue
+            self.hits += 1
+            return conn, True
+        self.misses += 1
+        return await self._new_connection(), False
+
+    def release(self, conn):
+        conn.last_used = time.time()
+        if len(self._idle) < self.maxsize:
+            self._idle.append(conn)
+        else:
+            self.discard(conn)
+
+    def discard(self, conn):
+        self.discarded += 1
+        conn.close()
+
+    def clear(self):
+        idle, self._idle = self._idle, collections.deque()
+        for conn in idle:
+            conn.close()
+
+    async def request(self, method, path, body, headers):
+        """
+        Perform a request and return a ``(status, body)`` tuple
+        """
+        async with self._semaphore:
+            return await asyncio.wait_for(
+                self._request(method, path, body, headers), self.timeout)
+
+    async def _request(self, method, path, body, headers):
+        conn, reused = await self.acquire()
+        try:
+            return await self._send(conn, method, path, body, headers)
+        except STALE_CONNECTION_ERRORS as e:
+            if not reused or not _is_retryable(e, conn.phase):
+                raise
+            self.retries += 1
+            self.misses += 1
+            conn = await self._new_connection()
+            return await self._send(conn, method, path, body, headers)
+
+    async def _send(self, conn, method, path, body, headers):
+        try:
+            status, response_headers, content = await conn.request(
+                method, self.host_header, path, body, headers)
+        except BaseException:
+            # Includes cancellation by wait_for: the connection is left in an
+            # unknown state so can't be re-used.
+            self.discard(conn)
+            raise
+        if response_headers.get('connection', '').lower() == 'close':
+            self.discard(conn)
+        else:
+            self.release(conn)
+        return status, content
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'discarded': self.discarded,
+                'retries': self.retries,
+                'idle': len(self._idle)}
+
+
+def _is_retryable(error, phase):
+    """
+    Return whether a request on a re-used connection which failed with
+    ``error`` in ``phase`` can't have been received by the server
+    """
+    if phase == SENDING_HEADERS:
+        return True
+    if phase == RECEIVING:
+        # The server closed the idle connection without reading the request
+        return isinstance(error, RemoteDisconnected)
+    return False
+
+
+def get_pool(host, port=None, loop=None, **kwargs):
+    """
+    Return the shared pool for the given host and event loop
+    """
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    pools = _pools.setdefault(loop, {})
+    key = (host, port) + tuple(sorted(kwargs.items()))
+    if key not in pools:
+        pools[key] = AsyncConnectionPool(host, port, **kwargs)
+    return pools[key]
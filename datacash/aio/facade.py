@@ -0,0 +1,97 @@
+from django.conf import settings
+from oscar.apps.payment.exceptions import UnableToTakePayment
+
+from datacash import gateway
+from datacash.facade import Facade
+
+from .gateway import AsyncGateway
+from .utils import run_sync
+
+
+class AsyncFacade(Facade):
+    """
+    asyncio flavour of ``datacash.facade.Facade``.
+
+    The API methods are coroutines.  Gateway calls are made on the event loop
+    while the ORM calls (merchant references and the audit trail) are run in
+    a worker thread as Django's ORM is blocking.
+    """
+    gateway_class = AsyncGateway
+
+    async def handle_response(self, method, order_number, amount, currency,
+                              response):
+        await run_sync(self.record_txn, method, order_number, amount,
+                       currency, response)
+        return self.check_response(response)
+
+    # ========================
+    # API - 2 stage processing
+    # ========================
+
+    async def pre_authorise(self, order_number, amount, bankcard=None,
+                            txn_reference=None, billing_address=None,
+                            the3rdman_data=None, currency=None):
+        if amount == 0:
+            raise UnableToTakePayment("Order amount must be non-zero")
+        if currency is None:
+            currency = settings.DATACASH_CURRENCY
+        merchant_ref = self.merchant_reference(order_number, gateway.PRE)
+        response = await self.gateway.pre(**self.payment_kwargs(
+            amount, currency, merchant_ref, bankcard, txn_reference,
+            billing_address, the3rdman_data=the3rdman_data))
+        return await self.handle_response(
+            gateway.PRE, order_number, amount, currency, response)
+
+    async def fulfill_transaction(self, order_number, amount, txn_reference,
+                                  auth_code, currency=None):
+        if currency is None:
+            currency = settings.DATACASH_CURRENCY
+        merchant_ref = self.merchant_reference(order_number, gateway.FULFILL)
+        response = await self.gateway.fulfill(
+            amount=amount, currency=currency,
+            merchant_reference=merchant_ref, txn_reference=txn_reference,
+            auth_code=auth_code)
+        return await self.handle_response(
+            gateway.FULFILL, order_number, amount, currency, response)
+
+    async def refund_transaction(self, order_number, amount, txn_reference,
+                                 currency=None):
+        if currency is None:
+            currency = settings.DATACASH_CURRENCY
+        response = await self.gateway.txn_refund(
+            amount=amount, currency=currency, txn_reference=txn_reference)
+        return await self.handle_response(
+            gateway.TXN_REFUND, order_number, amount, currency, response)
+
+    async def cancel_transaction(self, order_number, txn_reference):
+        response = await self.gateway.cancel(txn_reference)
+        return await self.handle_response(
+            gateway.CANCEL, order_number, None, None, response)
+
+    # ========================
+    # API - 1 stage processing
+    # ========================
+
+    async def authorise(self, order_number, amount, bankcard=None,
+                        txn_reference=None, billing_address=None,
+                        the3rdman_data=None, currency=None):
+        if amount == 0:
+            raise UnableToTakePayment("Order amount must be non-zero")
+        if currency is None:
+            currency = settings.DATACASH_CURRENCY
+        merchant_ref = self.merchant_reference(order_number, gateway.AUTH)
+        response = await self.gateway.auth(**self.payment_kwargs(
+            amount, currency, merchant_ref, bankcard, txn_reference,
+            billing_address, the3rdman_data=the3rdman_data))
+        return await self.handle_response(
+            gateway.AUTH, order_number, amount, currency, response)
+
+    async def refund(self, order_number, amount, bankcard=None,
+                     txn_reference=None, currency=None):
+        if currency is None:
+            currency = settings.DATACASH_CURRENCY
+        merchant_ref = self.merchant_reference(order_number, gateway.REFUND)
+        response = await self.gateway.refund(**self.payment_kwargs(
+            amount, currency, merchant_ref, bankcard, txn_reference))
+        return await self.handle_response(
+            gateway.REFUND, order_number, amount, currency, response)
@@ -0,0 +1,126 @@
+import asyncio
+import logging
+
+from oscar.apps.payment.exceptions import GatewayError
+
+from datacash import gateway
+from datacash.gateway import (
+    AUTH, PRE, REFUND, ERP, CANCEL, FULFILL, TXN_REFUND, REQUIRED_KWARGS,
+    BatchResult)
+
+from . import client as aio_client
+
+logger = logging.getLogger('datacash')
+
+
+class AsyncGateway(gateway.Gateway):
+    """
+    asyncio counterpart of ``datacash.gateway.Gateway``.
+
+    Requests are built, validated and parsed exactly as for the blocking
+    gateway but the API methods are coroutines and the HTTP request is made
+    on a non-blocking connection taken from a per-event-loop keep-alive pool.
+    """
+
+    def __init__(self, host, path, client, password, cv2avs=False,
+                 capturemethod='ecomm', timeout=30, pool_size=10,
+                 pool_idle_timeout=60, pool_max_lifetime=300,
+                 use_ssl=True, ssl_context=None, max_connections=100):
+        self._max_connections = max_connections
+        super(AsyncGateway, self).__init__(
+            host, path, client, password, cv2avs, capturemethod, timeout,
+            pool_size, pool_idle_timeout, pool_max_lifetime, use_ssl,
+            ssl_context)
+
+    def _create_pool(self, **kwargs):
+        # No blocking pool is needed
+        self._async_pool_kwargs = dict(
+            kwargs, max_connections=self._max_connections)
+        return None
+
+    def get_async_pool(self):
+        # Streams are bound to an event loop so the pool is looked up for
+        # the running loop on each request.
+        return aio_client.get_pool(self._host, **self._async_pool_kwargs)
+
+    @property
+    def pool_stats(self):
+        return self.get_async_pool().stats()
+
+    async def _fetch_response_xml(self, request_xml):
+        headers = {"Content-type": "application/xml",
+                   "Accept": ""}
+        status, response_xml = await self.get_async_pool().request(
+            "POST", self._path, request_xml.encode('utf8'), headers)
+        if status != 200:
+            raise GatewayError("Unable to communicate with payment gateway (code: %s, response: %s)" % (status, response_xml))
+        return response_xml
+
+    async def _do_request(self, method, **kwargs):
+        request_xml = self._prepare_request(method, **kwargs)
+        response_xml = await self._fetch_response_xml(request_xml)
+        return self._process_response(method, request_xml, response_xml,
+                                      **kwargs)
+
+    async def _do_batch_request(self, index, method, kwargs):
+        try:
+            response = await self._do_request(method, **kwargs)
+        except Exception as e:
+            logger.error("Batch request %d (%s) failed: %s", index, method, e,
+                         exc_info=True)
+            return BatchResult(index, method, kwargs, None, e)
+        return BatchResult(index, method, kwargs, response, None)
+
+    # ===
+    # API
+    # ===
+
+    async def submit_many(self, requests, max_workers=None, ordered=True):
+        """
+        Submit many transactions concurrently on the event loop.
+
+        As ``Gateway.submit_many`` but returns a list of ``BatchResult``
+        instances, in input order if ``ordered`` is true, otherwise in the
+        order they completed.  At most ``max_workers`` requests (by default
+        the gateway's ``max_connections``) are in flight at once.
+        """
+        pending, invalid = self._check_batch(requests)
+        semaphore = asyncio.Semaphore(max_workers or self._max_connections)
+        results = list(invalid.values())
+
+        async def submit(index, method, kwargs):
+            async with semaphore:
+                result = await self._do_batch_request(index, method, kwargs)
+            results.append(result)
+
+        await asyncio.gather(*[submit(*request) for request in pending])
+        if ordered:
+            results.sort(key=lambda result: result.index)
+        return results
+
+    async def auth(self, **kwargs):
+        self._check_kwargs(kwargs, REQUIRED_KWARGS[AUTH])
+        return await self._do_request(AUTH, **kwargs)
+
+    async def pre(self, **kwargs):
+        self._check_kwargs(kwargs, REQUIRED_KWARGS[PRE])
+        return await self._do_request(PRE, **kwargs)
+
+    async def refund(self, **kwargs):
+        self._check_kwargs(kwargs, REQUIRED_KWARGS[REFUND])
+        return await self._do_request(REFUND, **kwargs)
+
+    async def erp(self, **kwargs):
+        self._check_kwargs(kwargs, REQUIRED_KWARGS[ERP])
+        return await self._do_request(ERP, **kwargs)
+
+    async def cancel(self, txn_reference):
+        return await self._do_request(CANCEL, txn_reference=txn_reference)
+
+    async def fulfill(self, **kwargs):
+        self._check_kwargs(kwargs, REQUIRED_KWARGS[FULFILL])
+        return await self._do_request(FULFILL, **kwargs)
+
+    async def txn_refund(self, **kwargs):
+        self._check_kwargs(kwargs, REQUIRED_KWARGS[TXN_REFUND])
+        return await self._do_request(TXN_REFUND, **kwargs)
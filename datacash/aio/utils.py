@@ -0,0 +1,35 @@
+import asyncio
+import functools
+
+try:
+    from asgiref.sync import sync_to_async
+except ImportError:
+    sync_to_async = None
+
+try:
+    from django.db import close_old_connections
+except ImportError:
+    # Django < 1.6
+    def close_old_connections():
+        pass
+
+
+def _call_with_connection_cleanup(fn, *args, **kwargs):
+    # Mirror Django's request cycle so connections held by executor threads
+    # respect CONN_MAX_AGE rather than staying open forever.
+    close_old_connections()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+async def run_sync(fn, *args, **kwargs):
+    """
+    Run blocking code (typically the ORM) without blocking the event loop
+    """
+    if sync_to_async is not None:
+        return await sync_to_async(fn)(*args, **kwargs)
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, functools.partial(
+        _call_with_connection_cleanup, fn, *args, **kwargs))
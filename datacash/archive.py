@@ -0,0 +1,242 @@
+"""
+Archival of old transactions and fraud responses.
+
+Rows older than a cut-off are written, a batch at a time, to gzipped JSON lines
+files and then either deleted or have their (large) raw payloads blanked.
+Each batch is written to a temporary file which is renamed once complete, and
+the rows are only changed after that, so an interrupted run loses nothing and
+can simply be run again: rows which have already been archived are no longer
+selected.  File names start with the time the run started, so when rows have
+been archived more than once (eg after being restored) the latest copy can be
+found, and existing files are never replaced: if a batch's file name is taken
+a sequence number is added to it.
+
+Archived rows can be restored for an order with ``restore``.  Restored rows
+keep their original ``date_created`` but aren't archived again until they
+have been restored for as long as the archive cut-off.
+"""
+import datetime
+import errno
+import glob
+import gzip
+import json
+import os
+import re
+import time
+
+from django.db import transaction
+from django.utils import timezone
+
+from . import export
+from .fields import CompressedTextField
+from .models import OrderTransaction, FraudResponse
+
+try:
+    atomic = transaction.atomic
+except AttributeError:
+    # Django < 1.6
+    atomic = transaction.commit_on_success
+
+DELETE, BLANK = 'delete', 'blank'
+MODES = (DELETE, BLANK)
+
+MODELS = (OrderTransaction, FraudResponse)
+
+PAYLOAD_FIELDS = export.PAYLOAD_FIELDS
+
+
+def get_fields(model):
+    return tuple(field.attname for field in model._meta.fields)
+
+
+def _model_name(model):
+    # Django < 1.6 calls this module_name
+    return getattr(model._meta, 'model_name', None) or model._meta.module_name
+
+
+RUN_FORMAT = '%Y%m%dT%H%M%S%f'
+
+
+def archive_filename(model, run, first_pk, last_pk):
+    return '%s-%s-%010d-%010d.jsonl.gz' % (
+        _model_name(model), run.strftime(RUN_FORMAT), first_pk, last_pk)
+
+
+def _archive_order(path):
+    # Files sort by the run which wrote them (files written before runs were
+    # named sort first), then by their rows and sequence number
+    match = re.match(
+        r'.*?-(?:(\d{8}T\d{12})-)?(\d{10,})-(\d{10,})(?:-(\d+))?\.jsonl\.gz$',
+        os.path.basename(path))
+    if match is None:
+        return '', 0, 0, 0, os.path.basename(path)
+    run, first_pk, last_pk, sequence = match.groups()
+    return (run or '', int(first_pk), int(last_pk), int(sequence or 0),
+            os.path.basename(path))
+
+
+class Archiver(object):
+    """
+    Archive rows of ``model`` created before ``cutoff`` into ``directory``
+    """
+
+    def __init__(self, model, directory, cutoff, mode=DELETE, batch_size=500,
+                 pause=0):
+        if mode not in MODES:
+            raise ValueError("Unknown archive mode: %s" % mode)
+        self.model = model
+        self.directory = directory
+        self.cutoff = cutoff
+        self.mode = mode
+        self.batch_size = batch_size
+        self.pause = pause
+        self.run_started = datetime.datetime.utcnow()
+        self.fields = get_fields(model)
+        self.num_archived = 0
+        self.files = []
+
+    def get_queryset(self):
+        queryset = self.model._default_manager.filter(
+            date_created__lt=self.cutoff).exclude(
+                date_restored__gte=self.cutoff)
+        if self.mode == BLANK:
+            # Blanked rows have already been archived
+            queryset = queryset.exclude(**dict(
+                (name, '') for name in PAYLOAD_FIELDS[self.model]))
+        return queryset.order_by('pk')
+
+    def run(self):
+        while True:
+            num_rows = self.archive_batch()
+            if num_rows < self.batch_size:
+                return self.num_archived
+            if self.pause:
+                # Give other writers a chance to take locks
+                time.sleep(self.pause)
+
+    def archive_batch(self):
+        rows = list(self.get_queryset().values_list(
+            *self.fields)[:self.batch_size])
+        if not rows:
+            return 0
+        pks = [row[0] for row in rows]
+        self.write(rows, archive_filename(self.model, self.run_started,
+                                          pks[0], pks[-1]))
+        with atomic():
+            queryset = self.model._default_manager.filter(pk__in=pks)
+            if self.mode == DELETE:
+                queryset.delete()
+            else:
+                queryset.update(**dict(
+                    (name, '') for name in PAYLOAD_FIELDS[self.model]))
+        self.num_archived += len(rows)
+        return len(rows)
+
+    def write(self, rows, filename):
+        meta = self.model._meta
+        converters = [
+            (i, meta.get_field(name).to_python)
+            for i, name in enumerate(self.fields)
+            if isinstance(meta.get_field(name), CompressedTextField)]
+        path = os.path.join(self.directory, filename)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+                for row in rows:
+                    row = list(row)
+                    for i, to_python in converters:
+                        row[i] = to_python(row[i])
+                    record = dict(zip(self.fields, map(export.to_json, row)))
+                    gz.write((json.dumps(record, sort_keys=True) +
+                              '\n').encode('utf8'))
+            f.flush()
+            os.fsync(f.fileno())
+        self.files.append(_move_to_unused_path(tmp_path, path))
+
+
+def _move_to_unused_path(tmp_path, path):
+    """
+    Move ``tmp_path`` to ``path``, or to ``path`` with a sequence number if
+    that already exists, and return the new path
+    """
+    base, ext = path[:-len('.jsonl.gz')], '.jsonl.gz'
+    sequence = 0
+    while True:
+        try:
+            # Unlike rename, link fails rather than replacing an existing file
+            os.link(tmp_path, path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            sequence += 1
+            path = '%s-%d%s' % (base, sequence, ext)
+        else:
+            os.unlink(tmp_path)
+            return path
+
+
+def archive(directory, days, mode=DELETE, batch_size=500, pause=0,
+            models=MODELS):
+    """
+    Archive rows older than ``days`` days, returning the number archived for
+    each model
+    """
+    cutoff = timezone.now() - datetime.timedelta(days=days)
+    counts = {}
+    for model in models:
+        archiver = Archiver(model, directory, cutoff, mode, batch_size, pause)
+        counts[model] = archiver.run()
+    return counts
+
+
+def read_archive(directory, model):
+    """
+    Yield each record (a dict) archived for ``model``
+    """
+    pattern = os.path.join(directory, '%s-*.jsonl.gz' % _model_name(model))
+    for path in sorted(glob.glob(pattern), key=_archive_order):
+        with gzip.open(path, 'rb') as gz:
+            for line in gz:
+                yield json.loads(line.decode('utf8'))
+
+
+def _matches_order(model, record, order_number):
+    if model is OrderTransaction:
+        return record['order_number'] == order_number
+    return record['merchant_order_ref'].split('_')[0] == order_number
+
+
+def restore(directory, order_number, models=MODELS):
+    """
+    Restore the archived rows for an order, returning the number restored for
+    each model.  Deleted rows are recreated with their original ids and
+    blanked payloads are filled in again.
+    """
+    counts = {}
+    for model in models:
+        records = {}
+        for record in read_archive(directory, model):
+            if _matches_order(model, record, order_number):
+                # A row can be archived twice (by an interrupted run, or
+                # after being restored), in which case the latest wins
+                records[record['id']] = record
+        for record in records.values():
+            _restore_record(model, record)
+        counts[model] = len(records)
+    return counts
+
+
+def _restore_record(model, record):
+    meta = model._meta
+    values = dict((name, meta.get_field(name).to_python(value))
+                  for name, value in record.items())
+    values['date_restored'] = timezone.now()
+    payload = dict((name, values[name]) for name in PAYLOAD_FIELDS[model])
+    with atomic():
+        queryset = model._default_manager.filter(pk=values['id'])
+        if queryset.exists():
+            queryset.update(date_restored=values['date_restored'], **payload)
+            return
+        model(**values).save(force_insert=True)
+        # date_created is set automatically on insert
+        queryset.update(date_created=values['date_created'])
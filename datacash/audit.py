@@ -0,0 +1,218 @@
+"""
+Write-behind storage of the ``OrderTransaction`` audit trail.
+
+When ``DATACASH_AUDIT_ASYNC`` is enabled, ``Facade.record_txn`` hands each
+transaction to an in-process queue rather than INSERTing it during the
+customer's request.  A background thread saves queued transactions in batches
+using ``bulk_create``.
+
+* The queue is bounded by ``DATACASH_AUDIT_QUEUE_SIZE``.  When it is full the
+  transaction is saved synchronously instead, so nothing is dropped.
+* The queue is flushed when the process exits normally (via ``atexit``).
+* Sensitive data is redacted before a transaction is queued.
+
+As transactions are saved after the request that created them, their
+``date_created`` is the time they were written (normally a few milliseconds
+later) and they may not be visible to queries made immediately afterwards.
+"""
+import atexit
+import logging
+import os
+import threading
+
+from django.conf import settings
+from django.db import connection
+from six.moves import queue
+
+from .models import OrderTransaction
+
+try:
+    from django.db import close_old_connections
+except ImportError:
+    # Django < 1.6
+    def close_old_connections():
+        pass
+
+logger = logging.getLogger('datacash.audit')
+
+_writer = None
+_writer_lock = threading.Lock()
+
+# Put on the queue to stop the writer thread
+_STOP = object()
+
+
+class AuditWriter(object):
+    """
+    Saves model instances in batches from a background thread.
+
+    If ``autostart`` is False, no thread is started and queued instances are
+    only saved when ``flush`` or ``close`` is called.
+    """
+
+    def __init__(self, model=OrderTransaction, maxsize=1000, batch_size=100,
+                 flush_interval=1.0, autostart=True):
+        self.model = model
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize)
+        self._thread = None
+        self._closed = False
+        self._lock = threading.Lock()
+        self.pid = os.getpid()
+
+        # Counters
+        self.num_written = 0
+        self.num_batches = 0
+        self.num_sync_writes = 0
+        self.num_failed = 0
+
+        if autostart:
+            self.start()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name='datacash-audit-writer')
+            self._thread.daemon = True
+            self._thread.start()
+        atexit.register(self.close)
+
+    def write(self, instance):
+        """
+        Queue an unsaved instance, or save it immediately if the queue is full
+        or the writer has been closed
+        """
+        if hasattr(instance, 'redact'):
+            instance.redact()
+        # Held so close() can't drain the queue between the check and the put
+        with self._lock:
+            if not self._closed:
+                try:
+                    self.queue.put_nowait(instance)
+                    return
+                except queue.Full:
+                    pass
+        self.num_sync_writes += 1
+        instance.save()
+
+    def flush(self):
+        """
+        Block until everything queued so far has been saved
+        """
+        if self._thread is not None and self._thread.is_alive():
+            self.queue.join()
+        else:
+            self._drain()
+
+    def close(self, timeout=None):
+        """
+        Save everything still queued and stop the writer thread
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        if self._thread is not None and self._thread.is_alive():
+            self.queue.put(_STOP)
+            self._thread.join(timeout)
+        # Anything left is saved in the calling thread
+        self._drain()
+
+    def _drain(self):
+        batch = []
+        while True:
+            try:
+                instance = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if instance is _STOP:
+                self.queue.task_done()
+                continue
+            batch.append(instance)
+            if len(batch) >= self.batch_size:
+                self._save_batch(batch)
+                batch = []
+        if batch:
+            self._save_batch(batch)
+
+    def _run(self):
+        try:
+            while True:
+                batch, stop = self._next_batch()
+                if batch:
+                    close_old_connections()
+                    self._save_batch(batch)
+                if stop:
+                    return
+        finally:
+            connection.close()
+
+    def _next_batch(self):
+        """
+        Wait for the first instance, then take as many as are already queued
+        (up to the batch size)
+        """
+        batch = []
+        try:
+            instance = self.queue.get(timeout=self.flush_interval)
+        except queue.Empty:
+            return batch, False
+        while True:
+            if instance is _STOP:
+                self.queue.task_done()
+                return batch, True
+            batch.append(instance)
+            if len(batch) >= self.batch_size:
+                return batch, False
+            try:
+                instance = self.queue.get_nowait()
+            except queue.Empty:
+                return batch, False
+
+    def _save_batch(self, batch):
+        try:
+            self.model.objects.bulk_create(batch)
+            self.num_written += len(batch)
+            self.num_batches += 1
+        except Exception:
+            logger.exception("Unable to save a batch of %d audit records, "
+                             "saving them individually", len(batch))
+            # Don't let one bad record lose the whole batch
+            for instance in batch:
+                try:
+                    instance.save()
+                    self.num_written += 1
+                except Exception:
+                    self.num_failed += 1
+                    logger.exception("Unable to save audit record: %s",
+                                     instance)
+        finally:
+            for i in range(len(batch)):
+                self.queue.task_done()
+
+    def stats(self):
+        return {'queued': self.queue.qsize(),
+                'written': self.num_written,
+                'batches': self.num_batches,
+                'sync_writes': self.num_sync_writes,
+                'failed': self.num_failed}
+
+
+def get_writer():
+    """
+    Return the audit writer for this process, creating it from the
+    ``DATACASH_AUDIT_*`` settings if necessary
+    """
+    global _writer
+    with _writer_lock:
+        # A forked worker needs its own thread
+        if _writer is None or _writer.pid != os.getpid():
+            _writer = AuditWriter(
+                maxsize=getattr(settings, 'DATACASH_AUDIT_QUEUE_SIZE', 1000),
+                batch_size=getattr(settings, 'DATACASH_AUDIT_BATCH_SIZE', 100),
+                flush_interval=getattr(
+                    settings, 'DATACASH_AUDIT_FLUSH_INTERVAL', 1.0))
+        return _writer
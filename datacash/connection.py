@@ -0,0 +1,277 @@
+"""
+Keep-alive connection pooling for the Datacash XML endpoint.
+
+Opening a new HTTPS connection for every transaction means paying for a TCP
+and TLS handshake on each payment.  The pool below keeps a bounded number of
+idle connections per host so they can be re-used by subsequent requests (from
+any thread).
+"""
+import collections
+import errno
+import select
+import socket
+import threading
+import time
+
+from six.moves import http_client
+
+# Exceptions that can indicate a re-used connection was closed by the server
+# while it sat idle in the pool.  Whether a request that fails with one of
+# them can be retried depends on how far it got (see ``_is_retryable``).
+STALE_CONNECTION_ERRORS = (http_client.BadStatusLine,
+                           http_client.ImproperConnectionState,
+                           socket.error)
+
+# The phases of a request, recorded so we know whether the server could have
+# received it when it fails
+SENDING_HEADERS, SENDING_BODY, RECEIVING = 'headers', 'body', 'response'
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class PooledConnection(object):
+    """
+    Wrapper around a HTTP connection which tracks its age and usage
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.created = self.last_used = time.time()
+        self.num_requests = 0
+        self.phase = None
+
+    def is_expired(self, now, idle_timeout, max_lifetime):
+        if idle_timeout is not None and now - self.last_used > idle_timeout:
+            return True
+        if max_lifetime is not None and now - self.created > max_lifetime:
+            return True
+        return False
+
+    def is_broken(self):
+        """
+        Test whether the server has closed the underlying socket.
+
+        An idle keep-alive socket should have nothing to read.  If it is
+        readable then the server has either closed it (EOF) or sent something
+        we weren't expecting - either way it can't be re-used.
+        """
+        sock = self.conn.sock
+        if sock is None:
+            return True
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (ValueError, select.error, socket.error):
+            return True
+        return bool(readable)
+
+    def close(self):
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+
+
+class ConnectionPool(object):
+    """
+    A thread-safe pool of keep-alive connections to a single host.
+
+    At most ``maxsize`` idle connections are kept.  Connections which have
+    been idle for longer than ``idle_timeout`` seconds or open for longer than
+    ``max_lifetime`` seconds are closed rather than re-used.
+    """
+
+    def __init__(self, host, port=None, timeout=30, maxsize=10,
+                 idle_timeout=60, max_lifetime=300, secure=True,
+                 ssl_context=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.secure = secure
+        self.ssl_context = ssl_context
+        self._idle = collections.deque()
+        self._lock = threading.Lock()
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.discarded = 0
+        self.retries = 0
+
+    def _new_connection(self):
+        if not self.secure:
+            return http_client.HTTPConnection(
+                self.host, self.port, timeout=self.timeout)
+        kwargs = {'timeout': self.timeout}
+        if self.ssl_context is not None:
+            kwargs['context'] = self.ssl_context
+        return http_client.HTTPSConnection(self.host, self.port, **kwargs)
+
+    def acquire(self):
+        """
+        Return a connection, re-using an idle one where possible
+        """
+        now = time.time()
+        with self._lock:
+            while self._idle:
+                pooled = self._idle.pop()
+                if (pooled.is_expired(now, self.idle_timeout,
+                                      self.max_lifetime)
+                        or pooled.is_broken()):
+                    self.discarded += 1
+                    pooled.close()
+                    continue
+                self.hits += 1
+                return pooled, True
+            self.misses += 1
+        return PooledConnection(self._new_connection()), False
+
+    def release(self, pooled):
+        """
+        Return a connection to the pool once its response has been read
+        """
+        pooled.last_used = time.time()
+        with self._lock:
+            if len(self._idle) < self.maxsize:
+                self._idle.append(pooled)
+                return
+            self.discarded += 1
+        pooled.close()
+
+    def discard(self, pooled):
+        with self._lock:
+            self.discarded += 1
+        pooled.close()
+
+    def clear(self):
+        """
+        Close all idle connections
+        """
+        with self._lock:
+            idle, self._idle = self._idle, collections.deque()
+        for pooled in idle:
+            pooled.close()
+
+    def request(self, method, path, body, headers):
+        """
+        Perform a request and return a ``(status, body)`` tuple.
+
+        If a re-used connection turns out to have been closed by the server
+        before it could have received the request, the request is retried
+        once on a fresh connection.  Anything else is raised, as retrying
+        could submit a payment twice.
+        """
+        pooled, reused = self.acquire()
+        try:
+            return self._request(pooled, method, path, body, headers)
+        except STALE_CONNECTION_ERRORS as e:
+            if not reused or not _is_retryable(e, pooled.phase):
+                raise
+            with self._lock:
+                self.retries += 1
+            pooled, _ = self._acquire_new()
+            return self._request(pooled, method, path, body, headers)
+
+    def _acquire_new(self):
+        with self._lock:
+            self.misses += 1
+        return PooledConnection(self._new_connection()), False
+
+    def _request(self, pooled, method, path, body, headers):
+        conn = pooled.conn
+        try:
+            # The headers are sent separately so a failure writing them means
+            # none of the request reached the server
+            pooled.phase = SENDING_HEADERS
+            conn.putrequest(method, path)
+            for name, value in headers.items():
+                conn.putheader(name, value)
+            conn.putheader('Content-Length', str(len(body)))
+            conn.endheaders()
+            pooled.phase = SENDING_BODY
+            conn.send(body)
+            pooled.phase = RECEIVING
+            response = conn.getresponse()
+            content = response.read()
+        except Exception:
+            self.discard(pooled)
+            raise
+        pooled.phase = None
+        pooled.num_requests += 1
+        if response.will_close:
+            self.discard(pooled)
+        else:
+            self.release(pooled)
+        return response.status, content
+
+    @property
+    def num_idle(self):
+        return len(self._idle)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'discarded': self.discarded,
+                    'retries': self.retries,
+                    'idle': len(self._idle)}
+
+
+def _is_retryable(error, phase):
+    """
+    Return whether a request on a re-used connection which failed with
+    ``error`` in ``phase`` can't have been received by the server
+    """
+    # Timeouts mean the server may have received and processed the request so
+    # retrying could duplicate a payment.
+    if isinstance(error, socket.timeout):
+        return False
+    if phase == SENDING_HEADERS:
+        if isinstance(error, http_client.ImproperConnectionState):
+            # Raised before anything is written
+            return True
+        return getattr(error, 'errno', None) in (
+            errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+    if phase == RECEIVING:
+        # The server closed the idle connection without reading the request
+        return _no_response_received(error)
+    return False
+
+
+def _no_response_received(error):
+    remote_disconnected = getattr(http_client, 'RemoteDisconnected', None)
+    if remote_disconnected is not None:
+        # Python 3.5+
+        return isinstance(error, remote_disconnected)
+    if not isinstance(error, http_client.BadStatusLine):
+        return False
+    # Python 2 raises BadStatusLine with the (empty) status line or a message
+    # saying none was received
+    line = error.line or ''
+    return line in ("''", '""') or line.startswith('No status line received')
+
+
+def get_pool(host, port=None, **kwargs):
+    """
+    Return the shared pool for the given host, creating it if necessary.
+
+    Pools are shared between ``Gateway`` instances as a new gateway is
+    typically created for each checkout request.
+    """
+    key = (host, port) + tuple(sorted(kwargs.items()))
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(host, port, **kwargs)
+        return pool
+
+
+def clear_pools():
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.clear()
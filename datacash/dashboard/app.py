@@ -11,6 +11,9 @@ class DatacashDashboardApplication(Application):
     list_view = views.TransactionListView
     detail_view = views.TransactionDetailView
     fraud_list_view = views.FraudResponseListView
+    export_view = views.TransactionExportView
+    fraud_export_view = views.FraudResponseExportView
+    statistics_view = views.StatisticsView
 
     def get_urls(self):
         urlpatterns = patterns('',
@@ -18,8 +21,15 @@ class DatacashDashboardApplication(Application):
                 name='datacash-transaction-list'),
             url(r'^transactions/(?P<pk>\d+)/$', self.detail_view.as_view(),
                 name='datacash-transaction-detail'),
+            url(r'^transactions/export/$', self.export_view.as_view(),
+                name='datacash-transaction-export'),
             url(r'^fraud-responses/$', self.fraud_list_view.as_view(),
                 name='datacash-fraud-response-list'),
+            url(r'^fraud-responses/export/$',
+                self.fraud_export_view.as_view(),
+                name='datacash-fraud-response-export'),
+            url(r'^statistics/$', self.statistics_view.as_view(),
+                name='datacash-statistics'),
         )
         return self.post_process_urls(urlpatterns)
 
@@ -0,0 +1,102 @@
+import datetime
+
+from django import forms
+from django.utils.translation import ugettext_lazy as _
+
+from datacash import gateway, stats
+
+
+class TransactionSearchForm(forms.Form):
+    """
+    Filters for the transaction list.  Each filter is an exact match or range
+    on an indexed column.
+    """
+    order_number = forms.CharField(required=False, label=_("Order number"))
+    datacash_reference = forms.CharField(
+        required=False, label=_("Datacash reference"))
+    merchant_reference = forms.CharField(
+        required=False, label=_("Merchant reference"))
+
+    method_choices = (('', '---------'),) + tuple(
+        (method, method) for method in (
+            gateway.AUTH, gateway.PRE, gateway.REFUND, gateway.ERP,
+            gateway.CANCEL, gateway.FULFILL, gateway.TXN_REFUND))
+    method = forms.ChoiceField(choices=method_choices, required=False,
+                               label=_("Method"))
+    status = forms.IntegerField(required=False, min_value=0,
+                                label=_("Status"))
+    currency = forms.CharField(required=False, max_length=12,
+                               label=_("Currency"))
+
+    amount_from = forms.DecimalField(required=False, label=_("Amount from"))
+    amount_to = forms.DecimalField(required=False, label=_("Amount to"))
+    date_from = forms.DateField(required=False, label=_("Date from"))
+    date_to = forms.DateField(required=False, label=_("Date to"))
+
+    def clean_currency(self):
+        return self.cleaned_data['currency'].upper()
+
+    def filter(self, queryset):
+        """
+        Return ``queryset`` filtered by the cleaned form data
+        """
+        data = self.cleaned_data
+        for name in ('order_number', 'datacash_reference',
+                     'merchant_reference', 'method', 'currency'):
+            if data.get(name):
+                queryset = queryset.filter(**{name: data[name].strip()})
+        if data.get('status') is not None:
+            queryset = queryset.filter(status=data['status'])
+        if data.get('amount_from') is not None:
+            queryset = queryset.filter(amount__gte=data['amount_from'])
+        if data.get('amount_to') is not None:
+            queryset = queryset.filter(amount__lte=data['amount_to'])
+        return filter_date_range(queryset, data)
+
+
+class FraudResponseSearchForm(forms.Form):
+    date_from = forms.DateField(required=False, label=_("Date from"))
+    date_to = forms.DateField(required=False, label=_("Date to"))
+
+    def filter(self, queryset):
+        return filter_date_range(queryset, self.cleaned_data)
+
+
+class StatisticsForm(forms.Form):
+    date_from = forms.DateField(required=False, label=_("Date from"))
+    date_to = forms.DateField(required=False, label=_("Date to"))
+    group_by_choices = (
+        ('method', _("Method")),
+        ('currency', _("Currency")),
+        ('card_scheme', _("Card scheme")),
+        ('status', _("Status")),
+        ('hour', _("Hour")),
+    )
+    group_by = forms.ChoiceField(choices=group_by_choices, required=False,
+                                 label=_("Group by"))
+
+    # Days shown when no dates are given
+    default_days = 7
+
+    def get_summary(self):
+        """
+        Return the date range and summary rows for the cleaned data
+        """
+        data = self.cleaned_data
+        date_to = data.get('date_to') or datetime.date.today()
+        date_from = data.get('date_from') or date_to - datetime.timedelta(
+            days=self.default_days - 1)
+        rows = stats.summarise(
+            date_from, date_to + datetime.timedelta(days=1),
+            data.get('group_by') or 'method')
+        return date_from, date_to, rows
+
+
+def filter_date_range(queryset, data):
+    if data.get('date_from'):
+        queryset = queryset.filter(date_created__gte=data['date_from'])
+    if data.get('date_to'):
+        # Include the whole of the last day
+        queryset = queryset.filter(
+            date_created__lt=data['date_to'] + datetime.timedelta(days=1))
+    return queryset
@@ -1,13 +1,131 @@
-from django.views.generic import ListView, DetailView
+from django.db.models import Q
+from django.http import Http404, StreamingHttpResponse
+from django.utils.dateparse import parse_datetime
+from django.views.generic import ListView, DetailView, TemplateView, View
 
-from datacash import models
+from datacash import export, models
+from datacash.dashboard import forms
 
 
-class TransactionListView(ListView):
+class KeysetPage(object):
+    """
+    A page of results from keyset pagination.  Unlike Django's ``Page`` it
+    doesn't know how many pages there are.
+    """
+
+    def __init__(self, object_list, has_next, has_previous, next_url=None,
+                 previous_url=None):
+        self.object_list = object_list
+        self._has_next = has_next
+        self._has_previous = has_previous
+        self.next_url = next_url
+        self.previous_url = previous_url
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self._has_next or self._has_previous
+
+
+class KeysetPaginationMixin(object):
+    """
+    Paginates a list newest first using a cursor on ``(date_created, id)``
+    (passed as ``?after=`` or ``?before=``) rather than a page number.
+
+    This avoids counting the table and scanning past every earlier row, so
+    pages are equally cheap however far back they are.  The model needs an
+    index on ``(date_created, id)``.
+    """
+    paginate_by = 20
+
+    def paginate_queryset(self, queryset, page_size):
+        after = self.request.GET.get('after')
+        before = self.request.GET.get('before')
+        queryset = queryset.order_by('-date_created', '-id')
+
+        if before:
+            date_created, pk = self.parse_cursor(before)
+            rows = list(queryset.filter(
+                Q(date_created__gt=date_created) |
+                Q(date_created=date_created, id__gt=pk)
+            ).reverse()[:page_size + 1])
+            has_previous = len(rows) > page_size
+            rows = rows[:page_size][::-1]
+            # The cursor row follows this page (unless it has been deleted)
+            has_next = bool(rows)
+        else:
+            if after:
+                date_created, pk = self.parse_cursor(after)
+                queryset = queryset.filter(
+                    Q(date_created__lt=date_created) |
+                    Q(date_created=date_created, id__lt=pk))
+            rows = list(queryset[:page_size + 1])
+            has_next = len(rows) > page_size
+            rows = rows[:page_size]
+            has_previous = bool(after)
+
+        page = KeysetPage(rows, has_next, has_previous)
+        if rows:
+            if has_next:
+                page.next_url = self.page_url('after', rows[-1])
+            if has_previous:
+                page.previous_url = self.page_url('before', rows[0])
+        return None, page, rows, page.has_other_pages()
+
+    def parse_cursor(self, cursor):
+        try:
+            date_created, pk = cursor.rsplit('_', 1)
+            date_created = parse_datetime(date_created)
+            pk = int(pk)
+        except ValueError:
+            date_created = None
+        if date_created is None:
+            raise Http404("Invalid page")
+        return date_created, pk
+
+    def page_url(self, direction, obj):
+        params = self.request.GET.copy()
+        params.pop('after', None)
+        params.pop('before', None)
+        params[direction] = '%s_%d' % (obj.date_created.isoformat(), obj.pk)
+        return '?' + params.urlencode()
+
+
+class SearchMixin(object):
+    """
+    Filters the queryset using ``form_class`` and the query string.  Invalid
+    filters are ignored (and shown as errors on the form).
+    """
+    form_class = None
+
+    def get_queryset(self):
+        queryset = super(SearchMixin, self).get_queryset()
+        self.form = self.form_class(self.request.GET)
+        if self.form.is_valid():
+            queryset = self.form.filter(queryset)
+        return queryset
+
+    def get_context_data(self, **kwargs):
+        ctx = super(SearchMixin, self).get_context_data(**kwargs)
+        ctx['form'] = self.form
+        # The current search without the page cursor
+        params = self.request.GET.copy()
+        params.pop('after', None)
+        params.pop('before', None)
+        ctx['search_params'] = params.urlencode()
+        return ctx
+
+
+class TransactionListView(SearchMixin, KeysetPaginationMixin, ListView):
     model = models.OrderTransaction
+    queryset = models.OrderTransaction.objects.without_payload()
     context_object_name = 'transactions'
     template_name = 'datacash/dashboard/transaction_list.html'
-    paginate_by = 20
+    form_class = forms.TransactionSearchForm
 
 
 class TransactionDetailView(DetailView):
@@ -16,8 +134,75 @@ class TransactionDetailView(DetailView):
     template_name = 'datacash/dashboard/transaction_detail.html'
 
 
-class FraudResponseListView(ListView):
+class FraudResponseListView(SearchMixin, KeysetPaginationMixin, ListView):
     model = models.FraudResponse
     context_object_name = 'responses'
     template_name = 'datacash/dashboard/fraudresponse_list.html'
-    paginate_by = 20
+    form_class = forms.FraudResponseSearchForm
+
+
+class ExportView(View):
+    """
+    Stream every row matching the list filters as CSV (the default) or JSON
+    lines (``?format=jsonl``).  The raw XML is only included with
+    ``?include_xml=1``.
+    """
+    model = None
+    queryset = None
+    form_class = None
+    filename = None
+
+    def get_queryset(self):
+        if self.queryset is not None:
+            return self.queryset.all()
+        return self.model._default_manager.all()
+
+    def get(self, request, *args, **kwargs):
+        format = request.GET.get('format', export.CSV)
+        if format not in export.FORMATS:
+            raise Http404("Unknown export format")
+        form = self.form_class(request.GET)
+        if not form.is_valid():
+            raise Http404("Invalid filters")
+        queryset = form.filter(self.get_queryset())
+        include_xml = bool(request.GET.get('include_xml'))
+        response = StreamingHttpResponse(
+            export.export(queryset, format, include_payload=include_xml),
+            content_type='%s; charset=utf-8' % export.CONTENT_TYPES[format])
+        response['Content-Disposition'] = 'attachment; filename=%s.%s' % (
+            self.filename, format)
+        return response
+
+
+class TransactionExportView(ExportView):
+    model = models.OrderTransaction
+    queryset = models.OrderTransaction.objects.without_payload()
+    form_class = forms.TransactionSearchForm
+    filename = 'datacash-transactions'
+
+
+class FraudResponseExportView(ExportView):
+    model = models.FraudResponse
+    form_class = forms.FraudResponseSearchForm
+    filename = 'datacash-fraud-responses'
+
+
+class StatisticsView(TemplateView):
+    """
+    Acceptance rates and totals, read from the rolled up statistics rather
+    than the transactions
+    """
+    template_name = 'datacash/dashboard/statistics.html'
+    form_class = forms.StatisticsForm
+
+    def get_context_data(self, **kwargs):
+        ctx = super(StatisticsView, self).get_context_data(**kwargs)
+        ctx['form'] = form = self.form_class(self.request.GET)
+        if not form.is_valid():
+            # Show the errors alongside the default summary
+            form = self.form_class({})
+            form.is_valid()
+        ctx['date_from'], ctx['date_to'], ctx['rows'] = form.get_summary()
+        ctx['group_by'] = dict(form.group_by_choices)[
+            form.cleaned_data.get('group_by') or 'method']
+        return ctx
@@ -0,0 +1,149 @@
+"""
+Streaming export of transactions and fraud responses as CSV or JSON lines.
+
+Rows are read in primary key order in batches (using ``values_list`` and a
+``pk > last`` condition rather than an offset) and written one line at a time,
+so memory use doesn't grow with the number of rows exported.  This is used by
+both the dashboard export views and the ``datacash_export`` command.
+"""
+import csv
+import datetime
+import functools
+import json
+from decimal import Decimal
+
+import six
+from django.db import models
+
+from .fields import CompressedTextField
+from .models import OrderTransaction, FraudResponse
+
+CSV, JSONL = 'csv', 'jsonl'
+FORMATS = (CSV, JSONL)
+
+CONTENT_TYPES = {
+    CSV: 'text/csv',
+    JSONL: 'application/x-ndjson',
+}
+
+# Exported columns, excluding the (large) raw payloads which are only included
+# when asked for
+FIELDS = {
+    OrderTransaction: ('id', 'order_number', 'method', 'amount', 'currency',
+                       'merchant_reference', 'datacash_reference',
+                       'auth_code', 'status', 'reason', 'date_created'),
+    FraudResponse: ('id', 'aggregator_identifier', 'merchant_identifier',
+                    'merchant_order_ref', 't3m_id', 'score', 'recommendation',
+                    'message_digest', 'date_created'),
+}
+PAYLOAD_FIELDS = {
+    OrderTransaction: ('request_xml', 'response_xml'),
+    FraudResponse: ('raw_response',),
+}
+
+
+def get_fields(model, include_payload=False):
+    fields = FIELDS[model]
+    if include_payload:
+        fields += PAYLOAD_FIELDS[model]
+    return fields
+
+
+def iter_rows(queryset, fields, batch_size=1000):
+    """
+    Yield tuples of ``fields`` for each row of ``queryset``, in primary key
+    order, fetching ``batch_size`` rows per query
+    """
+    meta = queryset.model._meta
+    converters = []
+    for i, name in enumerate(fields):
+        field = meta.get_field(name)
+        if isinstance(field, CompressedTextField):
+            # Compressed values aren't decompressed by values_list
+            converters.append((i, field.to_python))
+        elif isinstance(field, models.DecimalField):
+            # Some databases (SQLite) drop trailing zeroes
+            converters.append((i, functools.partial(
+                quantize, exponent=Decimal(1).scaleb(-field.decimal_places))))
+    queryset = queryset.order_by('pk')
+    last_pk = None
+    while True:
+        batch = queryset
+        if last_pk is not None:
+            batch = batch.filter(pk__gt=last_pk)
+        rows = list(batch.values_list('pk', *fields)[:batch_size])
+        for row in rows:
+            row = list(row[1:])
+            for i, to_python in converters:
+                row[i] = to_python(row[i])
+            yield tuple(row)
+        if len(rows) < batch_size:
+            return
+        last_pk = rows[-1][0]
+
+
+def quantize(value, exponent):
+    if value is None:
+        return value
+    return value.quantize(exponent)
+
+
+def to_text(value):
+    if value is None:
+        return u''
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return six.text_type(value.isoformat())
+    return six.text_type(value)
+
+
+def to_json(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        # As a string so no precision is lost
+        return str(value)
+    return value
+
+
+class Echo(object):
+    """
+    A file-like object which returns what is written to it, so that a
+    ``csv.writer`` can produce one line at a time
+    """
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows, fields):
+    writer = csv.writer(Echo())
+    if six.PY3:
+        def line(values):
+            return writer.writerow([to_text(value) for value in values])
+    else:
+        # The Python 2 csv module doesn't support unicode
+        def line(values):
+            return writer.writerow([to_text(value).encode('utf8')
+                                    for value in values]).decode('utf8')
+    yield line(fields)
+    for row in rows:
+        yield line(row)
+
+
+def jsonl_lines(rows, fields):
+    for row in rows:
+        yield json.dumps(dict(zip(fields, map(to_json, row))),
+                         sort_keys=True) + u'\n'
+
+
+def export(queryset, format=CSV, include_payload=False, batch_size=1000):
+    """
+    Return an iterator of lines (text) exporting ``queryset``
+    """
+    if format not in FORMATS:
+        raise ValueError("Unknown export format: %s" % format)
+    fields = get_fields(queryset.model, include_payload)
+    rows = iter_rows(queryset, fields, batch_size)
+    if format == CSV:
+        return csv_lines(rows, fields)
+    return jsonl_lines(rows, fields)
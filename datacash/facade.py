@@ -1,32 +1,98 @@
+import itertools
+import logging
 import random
+import ssl
+import time
 
 from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 from oscar.apps.payment.exceptions import UnableToTakePayment, InvalidGatewayRequestError
 
-from datacash import gateway
+from datacash import audit, gateway, stats
 from datacash.models import OrderTransaction
 
+logger = logging.getLogger('datacash')
+
+MERCHANT_REF_MAX_LENGTH = 32
+
+BASE36_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+# Merchant references made by this process are numbered from a random
+# starting point so that different processes are unlikely to overlap.
+_sequence = itertools.count(random.randint(0, 36 ** 3 - 1))
+
+
+def _base36(number, width=0):
+    digits = []
+    while number:
+        number, i = divmod(number, 36)
+        digits.append(BASE36_DIGITS[i])
+    return ''.join(reversed(digits)).rjust(width, '0')
+
+
+def _unique_token():
+    """
+    Return an 11 character token which is unique within this process and
+    very unlikely to be repeated by another.
+
+    It is the time in milliseconds followed by a per-process sequence number,
+    both base 36 encoded.  The time is 8 characters until 2059.
+    """
+    millis = int(time.time() * 1000)
+    return _base36(millis, 8) + _base36(next(_sequence) % 36 ** 3, 3)
+
+
+# SSL contexts by CA file.  Connection pools are keyed on the context so it
+# must be shared between facades.
+_ssl_contexts = {}
+
 
 class Facade(object):
     """
     A bridge between oscar's objects and the core gateway object
     """
+    gateway_class = gateway.Gateway
 
     def __init__(self):
-        self.gateway = gateway.Gateway(
+        self.gateway = self.gateway_class(
             settings.DATACASH_HOST,
             getattr(settings, 'DATACASH_PATH', '/Transaction'),
             settings.DATACASH_CLIENT,
             settings.DATACASH_PASSWORD,
             getattr(settings, 'DATACASH_USE_CV2AVS', False),
-            getattr(settings, 'DATACASH_CAPTURE_METHOD', 'ecomm'))
+            getattr(settings, 'DATACASH_CAPTURE_METHOD', 'ecomm'),
+            timeout=getattr(settings, 'DATACASH_TIMEOUT', 30),
+            pool_size=getattr(settings, 'DATACASH_POOL_SIZE', 10),
+            pool_idle_timeout=getattr(
+                settings, 'DATACASH_POOL_IDLE_TIMEOUT', 60),
+            pool_max_lifetime=getattr(
+                settings, 'DATACASH_POOL_MAX_LIFETIME', 300),
+            use_ssl=getattr(settings, 'DATACASH_USE_SSL', True),
+            ssl_context=self.get_ssl_context())
+
+    def get_ssl_context(self):
+        """
+        Return the SSL context used to verify the Datacash host, or None to
+        use the default CA certificates.
+        """
+        cafile = getattr(settings, 'DATACASH_SSL_CAFILE', None)
+        if not cafile:
+            return None
+        if cafile not in _ssl_contexts:
+            _ssl_contexts[cafile] = ssl.create_default_context(cafile=cafile)
+        return _ssl_contexts[cafile]
 
     def handle_response(self, method, order_number, amount, currency, response):
 
         # Maintain audit trail
         self.record_txn(method, order_number, amount, currency, response)
+        return self.check_response(response)
 
+    def check_response(self, response):
+        """
+        Return the Datacash reference of a successful response or raise an
+        appropriate exception.
+        """
         # A response is either successful, declined or an error
         if response.is_successful():
             return response['datacash_reference']
@@ -44,7 +110,7 @@ class Facade(object):
             raise InvalidGatewayRequestError(response.reason)
 
     def record_txn(self, method, order_number, amount, currency, response):
-        OrderTransaction.objects.create(
+        txn = OrderTransaction(
             order_number=order_number,
             method=method,
             datacash_reference=response['datacash_reference'],
@@ -56,6 +122,18 @@ class Facade(object):
             reason=response['reason'],
             request_xml=response.request_xml,
             response_xml=response.response_xml)
+        if getattr(settings, 'DATACASH_AUDIT_ASYNC', False):
+            audit.get_writer().write(txn)
+        else:
+            txn.save()
+        if stats.realtime_enabled():
+            # The card has been charged by now so a failure here mustn't be
+            # raised to the customer
+            try:
+                stats.record(txn, response['card_scheme'])
+            except Exception:
+                logger.exception("Unable to update the payment statistics "
+                                 "for order %s", order_number)
 
     def get_friendly_decline_message(self, response):
         return _('The transaction was declined by your bank - '
@@ -72,6 +150,26 @@ class Facade(object):
         }
         return errors.get(response.status)
 
+    def payment_kwargs(self, amount, currency, merchant_ref, bankcard=None,
+                       txn_reference=None, billing_address=None, **kwargs):
+        """
+        Return the gateway kwargs for a payment against a bankcard or a
+        previous transaction
+        """
+        kwargs.update(amount=amount, currency=currency,
+                      merchant_reference=merchant_ref)
+        if bankcard:
+            kwargs.update(card_number=bankcard.number,
+                          expiry_date=bankcard.expiry_date,
+                          ccv=bankcard.ccv)
+        elif txn_reference:
+            kwargs['previous_txn_reference'] = txn_reference
+        else:
+            raise ValueError(
+                "You must specify either a bankcard or a previous txn reference")
+        kwargs.update(self.extract_address_data(billing_address))
+        return kwargs
+
     def extract_address_data(self, address):
         data = {}
         if not address:
@@ -103,41 +201,34 @@ class Facade(object):
         if currency is None:
             currency = settings.DATACASH_CURRENCY
         merchant_ref = self.merchant_reference(order_number, gateway.PRE)
-        address_data = self.extract_address_data(billing_address)
-        if bankcard:
-            response = self.gateway.pre(
-                card_number=bankcard.number,
-                expiry_date=bankcard.expiry_date,
-                amount=amount,
-                currency=currency,
-                merchant_reference=merchant_ref,
-                ccv=bankcard.ccv,
-                the3rdman_data=the3rdman_data,
-                **address_data)
-        elif txn_reference:
-            response = self.gateway.pre(
-                amount=amount,
-                currency=currency,
-                merchant_reference=merchant_ref,
-                previous_txn_reference=txn_reference,
-                the3rdman_data=the3rdman_data,
-                **address_data)
-        else:
-            raise ValueError(
-                "You must specify either a bankcard or a previous txn reference")
+        response = self.gateway.pre(**self.payment_kwargs(
+            amount, currency, merchant_ref, bankcard, txn_reference,
+            billing_address, the3rdman_data=the3rdman_data))
         return self.handle_response(
             gateway.PRE, order_number, amount, currency, response)
 
     def merchant_reference(self, order_number, method):
-        # Determine the previous number of these transactions.
-        num_previous = OrderTransaction.objects.filter(
-            order_number=order_number, method=method).count()
-        # Get a random number to append to the end.  This solves the problem
-        # where a previous request crashed out and didn't save a model
-        # instance.  Hence we can get a clash of merchant references.
-        rand = "%04.f" % (random.random() * 10000)
-        return u'%s_%s_%d_%s' % (order_number, method.upper(), num_previous+1,
-                                 rand)
+        """
+        Return a unique merchant reference for a transaction, in the form
+        ORDERNUMBER_METHOD_TOKEN.
+
+        Datacash requires merchant references to be unique and between 6 and 32
+        characters long.  The order number must come first so it can be
+        recovered from The3rdMan callbacks (see
+        ``FraudResponse.order_number``), so it can't be shortened: order
+        numbers longer than 20 characters raise ``ValueError``.
+        """
+        token = _unique_token()
+        ref = u'%s_%s_%s' % (order_number, method.upper(), token)
+        if len(ref) > MERCHANT_REF_MAX_LENGTH:
+            # Drop the method rather than truncate the order number
+            ref = u'%s_%s' % (order_number, token)
+        if len(ref) > MERCHANT_REF_MAX_LENGTH:
+            raise ValueError(
+                "Order number %s is too long for a Datacash merchant reference "
+                "(the maximum is %d characters)" % (
+                    order_number, MERCHANT_REF_MAX_LENGTH - 1 - len(token)))
+        return ref
 
     def fulfill_transaction(self, order_number, amount, txn_reference,
                             auth_code, currency=None):
@@ -196,27 +287,9 @@ class Facade(object):
             currency = settings.DATACASH_CURRENCY
 
         merchant_ref = self.merchant_reference(order_number, gateway.AUTH)
-        address_data = self.extract_address_data(billing_address)
-        if bankcard:
-            response = self.gateway.auth(card_number=bankcard.number,
-                                         expiry_date=bankcard.expiry_date,
-                                         amount=amount,
-                                         currency=currency,
-                                         merchant_reference=merchant_ref,
-                                         ccv=bankcard.ccv,
-                                         the3rdman_data=the3rdman_data,
-                                         **address_data)
-        elif txn_reference:
-            response = self.gateway.auth(amount=amount,
-                                         currency=currency,
-                                         merchant_reference=merchant_ref,
-                                         previous_txn_reference=txn_reference,
-                                         the3rdman_data=the3rdman_data,
-                                         **address_data)
-        else:
-            raise ValueError(
-                "You must specify either a bankcard or a previous txn reference")
-
+        response = self.gateway.auth(**self.payment_kwargs(
+            amount, currency, merchant_ref, bankcard, txn_reference,
+            billing_address, the3rdman_data=the3rdman_data))
         return self.handle_response(gateway.AUTH, order_number, amount,
                                     currency, response)
 
@@ -228,19 +301,7 @@ class Facade(object):
         if currency is None:
             currency = settings.DATACASH_CURRENCY
         merchant_ref = self.merchant_reference(order_number, gateway.REFUND)
-        if bankcard:
-            response = self.gateway.refund(card_number=bankcard.number,
-                                           expiry_date=bankcard.expiry_date,
-                                           amount=amount,
-                                           currency=currency,
-                                           merchant_reference=merchant_ref,
-                                           ccv=bankcard.ccv)
-        elif txn_reference:
-            response = self.gateway.refund(
-                amount=amount, currency=currency,
-                merchant_reference=merchant_ref,
-                previous_txn_reference=txn_reference)
-        else:
-            raise ValueError("You must specify either a bankcard or a previous txn reference")
+        response = self.gateway.refund(**self.payment_kwargs(
+            amount, currency, merchant_ref, bankcard, txn_reference))
         return self.handle_response(gateway.REFUND, order_number, amount,
                                     currency, response)
@@ -0,0 +1,146 @@
+"""
+A text field which can store its value compressed.
+
+Values are compressed when ``DATACASH_COMPRESS_XML`` is enabled and stored as
+a marker followed by base 64 encoded zlib data, so the column type doesn't
+change.  Compressed values are always decompressed when loaded, whatever the
+setting, so compression can be turned on (or off) at any time and existing
+rows converted with the ``datacash_compress_xml`` command.
+
+Values are plain zlib by default, which every supported Python can read.
+Datacash documents are small and repetitive so, with
+``DATACASH_COMPRESS_XML_ZDICT`` enabled and where zlib supports it (Python
+3.3+), they are compressed against a preset dictionary of common Datacash XML
+instead.  Values compressed with the dictionary can't be read by Python 2.
+"""
+import base64
+import zlib
+
+import six
+from django.conf import settings
+from django.db import models
+
+# Stored values start with one of these markers.  Neither can begin an XML
+# document.
+ZLIB_MARKER = 'zlib1:'
+ZLIB_DICT_MARKER = 'zlibd1:'
+
+# Must never change as stored values depend on it: add a new version (and
+# marker) instead.  Later content is referenced more cheaply so the most
+# common strings are at the end.
+ZDICT_V1 = (
+    b'<The3rdMan type="realtime"><Realtime><real_time_callback_format>XML'
+    b'</real_time_callback_format><real_time_callback>http://</real_time_'
+    b'callback></Realtime><CustomerInformation><customer_reference>'
+    b'</customer_reference><delivery_forename></delivery_forename>'
+    b'<delivery_surname></delivery_surname><email></email><forename>'
+    b'</forename><ip_address></ip_address><sales_channel>3</sales_channel>'
+    b'<surname></surname><telephone></telephone></CustomerInformation>'
+    b'<DeliveryAddress><street_address_1></street_address_1><city></city>'
+    b'<postcode></postcode><country>826</country></DeliveryAddress>'
+    b'<BillingAddress></BillingAddress><OrderInformation><Products count="">'
+    b'<Product><code></code><quantity>1</quantity><price></price>'
+    b'</Product></Products></OrderInformation></The3rdMan>'
+    b'<Cv2Avs><street_address1></street_address1><postcode></postcode>'
+    b'<cv2>XXX</cv2></Cv2Avs><startdate></startdate><issuenumber>'
+    b'</issuenumber><card_details type="preregistered"></card_details>'
+    b'<HistoricTxn><reference></reference><method>fulfill</method>'
+    b'<authcode></authcode></HistoricTxn>'
+    b'<?xml version="1.0" encoding="UTF-8" ?>\n<Response><CardTxn>'
+    b'<authcode></authcode><card_scheme>VISA</card_scheme><country>United '
+    b'Kingdom</country><issuer></issuer></CardTxn><datacash_reference>'
+    b'</datacash_reference><merchantreference></merchantreference><mode>'
+    b'LIVE</mode><reason>ACCEPTED</reason><status>1</status><time>1'
+    b'</time></Response>'
+    b'<?xml version="1.0" encoding="UTF-8" ?><Request><Authentication>'
+    b'<client></client><password>XXX</password></Authentication>'
+    b'<Transaction><CardTxn><method>auth</method><Card><pan>XXXXXXXXXXXX'
+    b'</pan><expirydate></expirydate></Card></CardTxn><TxnDetails>'
+    b'<merchantreference>_AUTH_</merchantreference><amount currency="GBP">'
+    b'</amount><capturemethod>ecomm</capturemethod></TxnDetails>'
+    b'</Transaction></Request>'
+)
+
+HAS_ZDICT = six.PY3
+
+
+def compression_enabled():
+    return getattr(settings, 'DATACASH_COMPRESS_XML', False)
+
+
+def zdict_enabled():
+    return HAS_ZDICT and getattr(settings, 'DATACASH_COMPRESS_XML_ZDICT',
+                                 False)
+
+
+def is_compressed(value):
+    return isinstance(value, six.string_types) and (
+        value.startswith(ZLIB_DICT_MARKER) or value.startswith(ZLIB_MARKER))
+
+
+def compress(value, level=6, zdict=None):
+    """
+    Return the stored (compressed) representation of a text value.  The preset
+    dictionary is used if ``zdict`` is true (by default, if
+    ``DATACASH_COMPRESS_XML_ZDICT`` is enabled).
+    """
+    data = value.encode('utf8')
+    if zdict is None:
+        zdict = zdict_enabled()
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 15, 9,
+                                      zlib.Z_DEFAULT_STRATEGY, ZDICT_V1)
+        marker = ZLIB_DICT_MARKER
+    else:
+        compressor = zlib.compressobj(level)
+        marker = ZLIB_MARKER
+    data = compressor.compress(data) + compressor.flush()
+    return marker + base64.b64encode(data).decode('ascii')
+
+
+def decompress(value):
+    """
+    Return the text value of a stored value, which may not be compressed
+    """
+    if value.startswith(ZLIB_DICT_MARKER):
+        if not HAS_ZDICT:
+            raise ValueError("This value was compressed with a preset "
+                             "dictionary which requires Python 3.3+")
+        data = base64.b64decode(value[len(ZLIB_DICT_MARKER):])
+        decompressor = zlib.decompressobj(zdict=ZDICT_V1)
+        data = decompressor.decompress(data) + decompressor.flush()
+    elif value.startswith(ZLIB_MARKER):
+        data = zlib.decompress(base64.b64decode(value[len(ZLIB_MARKER):]))
+    else:
+        return value
+    return data.decode('utf8')
+
+
+class CompressedTextField(six.with_metaclass(models.SubfieldBase,
+                                             models.TextField)):
+    """
+    A ``TextField`` which is compressed in the database when
+    ``DATACASH_COMPRESS_XML`` is enabled.  The attribute is always the
+    uncompressed text.
+    """
+
+    def to_python(self, value):
+        if is_compressed(value):
+            return decompress(value)
+        return super(CompressedTextField, self).to_python(value)
+
+    def get_db_prep_save(self, value, connection):
+        # Only values being written are compressed, not lookups
+        value = super(CompressedTextField, self).get_db_prep_save(
+            value, connection)
+        if value and compression_enabled() and not is_compressed(value):
+            return compress(value)
+        return value
+
+
+try:
+    from south.modelsinspector import add_introspection_rules
+except ImportError:
+    pass
+else:
+    add_introspection_rules([], [r'^datacash\.fields\.CompressedTextField'])
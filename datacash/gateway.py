@@ -1,14 +1,14 @@
-from xml.dom.minidom import Document, parseString
-
-from six.moves import http_client
+from six.moves import http_client, queue
+import collections
 import re
 import logging
 import datetime
+import threading
 from django.utils.encoding import python_2_unicode_compatible
 
 from oscar.apps.payment.exceptions import GatewayError
 
-from . import the3rdman, xmlutils
+from . import connection, the3rdman, xmlutils
 
 logger = logging.getLogger('datacash')
 
@@ -24,6 +24,17 @@ TXN_REFUND = 'txn_refund'
 # Status codes
 ACCEPTED, DECLINED, INVALID_CREDENTIALS = '1', '7', '10'
 
+# Keyword arguments that must be passed for each method
+REQUIRED_KWARGS = {
+    AUTH: ('amount', 'currency', 'merchant_reference'),
+    PRE: ('amount', 'currency', 'merchant_reference'),
+    REFUND: ('amount', 'currency', 'merchant_reference'),
+    ERP: ('amount', 'currency', 'merchant_reference'),
+    CANCEL: ('txn_reference',),
+    FULFILL: ('amount', 'currency', 'txn_reference', 'auth_code'),
+    TXN_REFUND: ('amount', 'currency', 'txn_reference'),
+}
+
 
 @python_2_unicode_compatible
 class Response(object):
@@ -31,29 +42,48 @@ class Response(object):
     Encapsulate a Datacash response
     """
 
+    # Map of data keys to the response element they are read from
+    field_tags = {
+        'status': 'status',
+        'datacash_reference': 'datacash_reference',
+        'merchant_reference': 'merchantreference',
+        'reason': 'reason',
+        'card_scheme': 'card_scheme',
+        'country': 'country',
+        'auth_code': 'authcode',
+    }
+
     def __init__(self, request_xml, response_xml):
         self.request_xml = request_xml
         self.response_xml = response_xml
-        self.data = self._extract_data(response_xml)
+        self._data = None
+        self._elements = None
+
+    @property
+    def data(self):
+        # The response is only parsed once a field is accessed
+        if self._data is None:
+            self._data = self._extract_data(self.response_xml)
+        return self._data
+
+    @property
+    def elements(self):
+        """
+        Ordered dict of the text of every leaf element in the response, keyed
+        by its path (eg 'CardTxn.Cv2Avs.cv2avs_status')
+        """
+        if self._elements is None:
+            self._data = self._extract_data(self.response_xml)
+        return self._elements
 
     def _extract_data(self, response_xml):
-        doc = parseString(response_xml)
-        data = {'status': self._get_element_text(doc, 'status'),
-                'datacash_reference': self._get_element_text(doc, 'datacash_reference'),
-                'merchant_reference': self._get_element_text(doc, 'merchantreference'),
-                'reason': self._get_element_text(doc, 'reason'),
-                'card_scheme': self._get_element_text(doc, 'card_scheme'),
-                'country': self._get_element_text(doc, 'country'),
-                'auth_code': self._get_element_text(doc, 'authcode')
-                }
-        return data
-
-    def _get_element_text(self, doc, tag):
-        try:
-            ele = doc.getElementsByTagName(tag)[0]
-        except IndexError:
-            return None
-        return ele.firstChild.data
+        self._elements = xmlutils.extract_text_fields(response_xml)
+        # First occurrence of each tag, wherever it is in the document
+        tags = {}
+        for path, text in self._elements.items():
+            tags.setdefault(path.rsplit('.', 1)[-1], text)
+        return dict((key, tags.get(tag))
+                    for key, tag in self.field_tags.items())
 
     def __getitem__(self, key):
         return self.data[key]
@@ -85,9 +115,23 @@ class Response(object):
         return self.data.get('status', None) == DECLINED
 
 
+class BatchResult(collections.namedtuple(
+        'BatchResult', 'index method kwargs response error')):
+    """
+    The outcome of one request submitted via ``Gateway.submit_many``.
+
+    Exactly one of ``response`` and ``error`` is set.
+    """
+
+    def is_successful(self):
+        return self.error is None and self.response.is_successful()
+
+
 class Gateway(object):
 
-    def __init__(self, host, path,  client, password, cv2avs=False, capturemethod='ecomm'):
+    def __init__(self, host, path,  client, password, cv2avs=False, capturemethod='ecomm',
+                 timeout=30, pool_size=10, pool_idle_timeout=60, pool_max_lifetime=300,
+                 use_ssl=True, ssl_context=None):
         if host.startswith('http'):
             raise RuntimeError("DATACASH_HOST should not include http")
         self._host = host
@@ -97,92 +141,123 @@ class Gateway(object):
         self._cv2avs = cv2avs
         self._capturemethod = capturemethod
 
+        # These fragments are the same for every request so are only
+        # serialised once
+        writer = xmlutils.XmlWriter(declaration=False)
+        writer.start('Authentication')
+        writer.element('client', client)
+        writer.element('password', password)
+        writer.end('Authentication')
+        self._authentication_xml = writer.getvalue()
+        writer = xmlutils.XmlWriter(declaration=False)
+        writer.element('capturemethod', capturemethod)
+        self._capturemethod_xml = writer.getvalue()
+        # Keep-alive connections are shared between all gateways for the same
+        # host
+        self._pool = self._create_pool(
+            timeout=timeout, maxsize=pool_size,
+            idle_timeout=pool_idle_timeout, max_lifetime=pool_max_lifetime,
+            secure=use_ssl, ssl_context=ssl_context)
+
+    def _create_pool(self, **kwargs):
+        return connection.get_pool(self._host, **kwargs)
+
+    @property
+    def pool_stats(self):
+        """
+        Return a dict of the connection pool counters (hits, misses, ...)
+        """
+        return self._pool.stats()
+
     def _fetch_response_xml(self, request_xml):
-        # Need to fill in HTTP request here
-        conn = http_client.HTTPSConnection(self._host, 443, timeout=30)
         headers = {"Content-type": "application/xml",
                    "Accept": ""}
-        conn.request("POST", self._path, request_xml.encode('utf8'), headers)
-        response = conn.getresponse()
-        response_xml = response.read()
-        if response.status != http_client.OK:
-            raise GatewayError("Unable to communicate with payment gateway (code: %s, response: %s)" % (response.status, response_xml))
-        conn.close()
+        status, response_xml = self._pool.request(
+            "POST", self._path, request_xml.encode('utf8'), headers)
+        if status != http_client.OK:
+            raise GatewayError("Unable to communicate with payment gateway (code: %s, response: %s)" % (status, response_xml))
         return response_xml
 
     def _build_request_xml(self, method_name, **kwargs):
         """
         Builds the XML for a transaction
         """
-        doc = Document()
-        req = self._create_element(doc, doc, 'Request')
+        writer = xmlutils.XmlWriter()
+        writer.start('Request')
 
         # Authentication
-        auth = self._create_element(doc, req, 'Authentication')
-        self._create_element(doc, auth, 'client', self._client)
-        self._create_element(doc, auth, 'password', self._password)
+        writer.raw(self._authentication_xml)
 
         # Transaction
-        txn = self._create_element(doc, req, 'Transaction')
+        writer.start('Transaction')
 
         # CardTxn
         if 'card_number' in kwargs or 'previous_txn_reference' in kwargs:
-            card_txn = self._create_element(doc, txn, 'CardTxn')
-            self._create_element(doc, card_txn, 'method', method_name)
+            writer.start('CardTxn')
+            writer.element('method', method_name)
 
             if 'card_number' in kwargs:
-                card = self._create_element(doc, card_txn, 'Card')
-                self._create_element(doc, card, 'pan', kwargs['card_number'])
-                self._create_element(doc, card, 'expirydate', kwargs['expiry_date'])
+                writer.start('Card')
+                writer.element('pan', kwargs['card_number'])
+                writer.element('expirydate', kwargs['expiry_date'])
 
                 if 'start_date' in kwargs:
-                    self._create_element(doc, card, 'startdate', kwargs['start_date'])
+                    writer.element('startdate', kwargs['start_date'])
                 if 'issue_number' in kwargs:
-                    self._create_element(doc, card, 'issuenumber', kwargs['issue_number'])
+                    writer.element('issuenumber', kwargs['issue_number'])
                 if 'auth_code' in kwargs:
-                    self._create_element(doc, card, 'authcode', kwargs['auth_code'])
+                    writer.element('authcode', kwargs['auth_code'])
                 if self._cv2avs:
-                    self._add_cv2avs_elements(doc, card, kwargs)
+                    self._add_cv2avs_elements(writer, kwargs)
+                writer.end('Card')
 
             elif 'previous_txn_reference' in kwargs:
-                self._create_element(doc, card_txn, 'card_details', kwargs['previous_txn_reference'],
-                                     attributes={'type': 'preregistered'})
+                writer.element('card_details', kwargs['previous_txn_reference'],
+                               attributes={'type': 'preregistered'})
+            writer.end('CardTxn')
 
         # HistoricTxn
         is_historic = False
         if 'txn_reference' in kwargs:
             is_historic = True
-            historic_txn = self._create_element(doc, txn, 'HistoricTxn')
-            self._create_element(doc, historic_txn, 'reference', kwargs['txn_reference'])
-            self._create_element(doc, historic_txn, 'method', method_name)
+            writer.start('HistoricTxn')
+            writer.element('reference', kwargs['txn_reference'])
+            writer.element('method', method_name)
             if 'auth_code' in kwargs:
-                self._create_element(doc, historic_txn, 'authcode', kwargs['auth_code'])
+                writer.element('authcode', kwargs['auth_code'])
+            writer.end('HistoricTxn')
 
         # TxnDetails
-        txn_details = self._create_element(doc, txn, 'TxnDetails')
+        writer.start('TxnDetails')
         if 'merchant_reference' in kwargs:
-            self._create_element(
-                doc, txn_details, 'merchantreference',
-                kwargs['merchant_reference'])
+            writer.element('merchantreference', kwargs['merchant_reference'])
         if 'amount' in kwargs:
             if is_historic:
-                self._create_element(doc, txn_details, 'amount',
-                                     str(kwargs['amount']))
+                writer.element('amount', str(kwargs['amount']))
             else:
-                self._create_element(
-                    doc, txn_details, 'amount', str(kwargs['amount']),
-                    {'currency': kwargs['currency']})
-        self._create_element(
-            doc, txn_details, 'capturemethod', self._capturemethod)
+                writer.element('amount', str(kwargs['amount']),
+                               {'currency': kwargs['currency']})
+        writer.raw(self._capturemethod_xml)
 
         # The3rdMan
         if 'the3rdman_data' in kwargs and kwargs['the3rdman_data']:
-            the3rdman.add_fraud_fields(
-                doc, txn_details, **kwargs['the3rdman_data'])
+            the3rdman.write_fraud_fields(writer, **kwargs['the3rdman_data'])
+        writer.end('TxnDetails')
 
-        return doc.toxml()
+        writer.end('Transaction')
+        writer.end('Request')
+        return writer.getvalue()
 
     def _do_request(self, method, **kwargs):
+        request_xml = self._prepare_request(method, **kwargs)
+        response_xml = self._fetch_response_xml(request_xml)
+        return self._process_response(method, request_xml, response_xml,
+                                      **kwargs)
+
+    def _prepare_request(self, method, **kwargs):
+        """
+        Log and build the request XML for a transaction
+        """
         amount = kwargs.get('amount', '')
         merchant_ref = kwargs.get('merchant_reference', '')
         logger.info("Merchant ref %s - performing %s request for amount: %s",
@@ -191,8 +266,13 @@ class Gateway(object):
         request_xml = self._build_request_xml(method, **kwargs)
         logger.debug("Merchant ref %s - request:\n %s",
                      merchant_ref, request_xml)
+        return request_xml
 
-        response_xml = self._fetch_response_xml(request_xml)
+    def _process_response(self, method, request_xml, response_xml, **kwargs):
+        """
+        Log and wrap the response XML for a transaction
+        """
+        merchant_ref = kwargs.get('merchant_reference', '')
         logger.debug("Merchant ref %s - received response:\n %s",
                      merchant_ref, response_xml)
 
@@ -205,28 +285,22 @@ class Gateway(object):
                            merchant_ref, response.datacash_reference)
         return response
 
-    def _add_cv2avs_elements(self, doc, card, kwargs):
+    def _add_cv2avs_elements(self, writer, kwargs):
         """
         Add CV2AVS anti-fraud elements.  Extended policy isn't
         handled yet.
         """
-        cv2avs = self._create_element(doc, card, 'Cv2Avs')
+        writer.start('Cv2Avs')
         for n in range(1, 5):
             key = 'address_line%d' % n
             if key in kwargs:
-                self._create_element(doc, cv2avs, 'street_address%d' % n, kwargs[key])
+                writer.element('street_address%d' % n, kwargs[key])
         if 'postcode' in kwargs:
             # Restrict size of postcode submitted
-            self._create_element(doc, cv2avs, 'postcode',
-                                 kwargs['postcode'][:9])
+            writer.element('postcode', kwargs['postcode'][:9])
         if 'ccv' in kwargs:
-            self._create_element(doc, cv2avs, 'cv2', kwargs['ccv'])
-
-    def _create_element(self, doc, parent, tag, value=None, attributes=None):
-        """
-        Creates an XML element
-        """
-        return xmlutils.create_element(doc, parent, tag, value, attributes)
+            writer.element('cv2', kwargs['ccv'])
+        writer.end('Cv2Avs')
 
     def _check_kwargs(self, kwargs, required_keys):
         for key in required_keys:
@@ -251,10 +325,93 @@ class Gateway(object):
             if key == 'merchant_reference' and not (6 <= len(value) <= 32):
                 raise ValueError("Merchant reference must be between 6 and 32 characters")
 
+    def _check_batch(self, requests):
+        """
+        Split batch ``requests`` into a list of valid ``(index, method,
+        kwargs)`` tuples and a dict of ``BatchResult`` errors by index
+        """
+        pending = []
+        invalid = {}
+        for index, (method, kwargs) in enumerate(requests):
+            kwargs = dict(kwargs)
+            try:
+                if method not in REQUIRED_KWARGS:
+                    raise ValueError("Unknown method '%s'" % method)
+                self._check_kwargs(kwargs, REQUIRED_KWARGS[method])
+            except ValueError as e:
+                invalid[index] = BatchResult(index, method, kwargs, None, e)
+            else:
+                pending.append((index, method, kwargs))
+        return pending, invalid
+
+    def _do_batch_request(self, index, method, kwargs):
+        try:
+            response = self._do_request(method, **kwargs)
+        except Exception as e:
+            logger.error("Batch request %d (%s) failed: %s", index, method, e,
+                         exc_info=True)
+            return BatchResult(index, method, kwargs, None, e)
+        return BatchResult(index, method, kwargs, response, None)
+
     # ===
     # API
     # ===
 
+    def submit_many(self, requests, max_workers=4, ordered=True):
+        """
+        Submit many transactions concurrently.
+
+        ``requests`` is an iterable of ``(method, kwargs)`` pairs, eg
+        ``('fulfill', {'amount': ..., 'txn_reference': ...})``.  All requests
+        are validated before any are sent.  They are then performed by
+        ``max_workers`` threads which share this gateway's connection pool.
+
+        This is a generator of ``BatchResult`` instances, yielded in input
+        order if ``ordered`` is true, otherwise as they complete.  A request
+        which is invalid or raises an exception is reported via the
+        ``error`` attribute of its result and doesn't affect the others.
+        """
+        pending, invalid = self._check_batch(requests)
+        num_requests = len(pending) + len(invalid)
+
+        tasks = queue.Queue()
+        for task in pending:
+            tasks.put(task)
+        results = queue.Queue()
+        stop = threading.Event()
+
+        def worker():
+            while not stop.is_set():
+                try:
+                    index, method, kwargs = tasks.get_nowait()
+                except queue.Empty:
+                    return
+                results.put(self._do_batch_request(index, method, kwargs))
+
+        threads = [threading.Thread(target=worker)
+                   for i in range(min(max_workers, len(pending)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            if not ordered:
+                for result in invalid.values():
+                    yield result
+                for i in range(len(pending)):
+                    yield results.get()
+                return
+            completed = invalid
+            for index in range(num_requests):
+                while index not in completed:
+                    result = results.get()
+                    completed[result.index] = result
+                yield completed.pop(index)
+        finally:
+            # Don't start any further requests if the caller stops iterating
+            # early
+            stop.set()
+
     # "Initial" transaction types
 
     def auth(self, **kwargs):
@@ -264,7 +421,7 @@ class Gateway(object):
 
         Note that currency should be ISO 4217 Alphabetic format.
         """
-        self._check_kwargs(kwargs, ['amount', 'currency', 'merchant_reference'])
+        self._check_kwargs(kwargs, REQUIRED_KWARGS[AUTH])
         return self._do_request(AUTH, **kwargs)
 
     def pre(self, **kwargs):
@@ -272,18 +429,18 @@ class Gateway(object):
         Performs an 'pre' request, which is to ring-fence the requested money
         so it can be fulfilled at a later time.
         """
-        self._check_kwargs(kwargs, ['amount', 'currency', 'merchant_reference'])
+        self._check_kwargs(kwargs, REQUIRED_KWARGS[PRE])
         return self._do_request(PRE, **kwargs)
 
     def refund(self, **kwargs):
         """
         Refund against a card
         """
-        self._check_kwargs(kwargs, ['amount', 'currency', 'merchant_reference'])
+        self._check_kwargs(kwargs, REQUIRED_KWARGS[REFUND])
         return self._do_request(REFUND, **kwargs)
 
     def erp(self, **kwargs):
-        self._check_kwargs(kwargs, ['amount', 'currency', 'merchant_reference'])
+        self._check_kwargs(kwargs, REQUIRED_KWARGS[ERP])
         return self._do_request(ERP, **kwargs)
 
     # "Historic" transaction types
@@ -302,12 +459,12 @@ class Gateway(object):
         Settle a previous PRE transaction.  The actual settlement will take place
         the next working day.
         """
-        self._check_kwargs(kwargs, ['amount', 'currency', 'txn_reference', 'auth_code'])
+        self._check_kwargs(kwargs, REQUIRED_KWARGS[FULFILL])
         return self._do_request(FULFILL, **kwargs)
 
     def txn_refund(self, **kwargs):
         """
         Refund against a specific transaction
         """
-        self._check_kwargs(kwargs, ['amount', 'currency', 'txn_reference'])
+        self._check_kwargs(kwargs, REQUIRED_KWARGS[TXN_REFUND])
         return self._do_request(TXN_REFUND, **kwargs)
@@ -0,0 +1,374 @@
+"""
+End-to-end load testing of the facade payment flows.
+
+Payments are driven through ``datacash.facade.Facade`` by a number of worker
+threads, including the ``OrderTransaction`` audit writes, against a local
+``datacash.simulator.Simulator`` (or the configured ``DATACASH_HOST``).  Each
+payment is timed in four phases:
+
+* build - creating the request XML
+* network - sending the request and reading the response
+* parse - parsing the response XML
+* db - writing the audit trail
+
+Run it with the ``datacash_loadtest`` management command.
+"""
+import collections
+import itertools
+import math
+import random
+import threading
+import time
+from decimal import Decimal as D
+
+from django.db import connection
+from six.moves import queue
+
+from datacash import gateway
+from datacash.facade import Facade
+from datacash.models import OrderTransaction
+
+try:
+    from django.test.utils import CaptureQueriesContext
+except ImportError:
+    # Django 1.5
+    CaptureQueriesContext = None
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+PHASES = ('build', 'network', 'parse', 'db')
+
+# Methods which act on a previous pre-auth rather than a bankcard
+HISTORIC_METHODS = ('fulfill', 'cancel', 'refund')
+METHODS = ('pre', 'auth') + HISTORIC_METHODS
+
+ORDER_NUMBER_PREFIX = 'LOADTEST'
+
+Bankcard = collections.namedtuple('Bankcard', 'number expiry_date ccv')
+
+_local = threading.local()
+
+
+def _record(phase, start):
+    phases = getattr(_local, 'phases', None)
+    if phases is not None:
+        phases[phase] += time.time() - start
+
+
+class InstrumentedGateway(gateway.Gateway):
+    """
+    A gateway which times the build, network and parse phases of each request
+    """
+
+    def _build_request_xml(self, method_name, **kwargs):
+        start = time.time()
+        try:
+            return super(InstrumentedGateway, self)._build_request_xml(
+                method_name, **kwargs)
+        finally:
+            _record('build', start)
+
+    def _fetch_response_xml(self, request_xml):
+        start = time.time()
+        try:
+            return super(InstrumentedGateway, self)._fetch_response_xml(
+                request_xml)
+        finally:
+            _record('network', start)
+
+    def _process_response(self, method, request_xml, response_xml, **kwargs):
+        start = time.time()
+        try:
+            response = super(InstrumentedGateway, self)._process_response(
+                method, request_xml, response_xml, **kwargs)
+            # Force the (lazy) parse so it is counted in this phase
+            response.data
+            return response
+        finally:
+            _record('parse', start)
+
+
+class InstrumentedFacade(Facade):
+    """
+    A facade which times its audit trail writes
+    """
+    gateway_class = InstrumentedGateway
+
+    def record_txn(self, method, order_number, amount, currency, response):
+        self.last_response = response
+        start = time.time()
+        try:
+            return super(InstrumentedFacade, self).record_txn(
+                method, order_number, amount, currency, response)
+        finally:
+            _record('db', start)
+
+
+class Sample(object):
+    """
+    The timings of a single payment
+    """
+
+    def __init__(self, method, phases, total, num_queries, error=None):
+        self.method = method
+        self.phases = phases
+        self.total = total
+        self.num_queries = num_queries
+        self.error = error
+
+
+def percentile(values, pct):
+    """
+    Return the ``pct`` percentile of a list of values (nearest rank)
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+def parse_mix(value):
+    """
+    Parse a method mix such as ``pre=3,fulfill=2,auth=1`` into a dict of
+    weights
+    """
+    mix = {}
+    for item in value.split(','):
+        method, _, weight = item.partition('=')
+        method = method.strip()
+        if method not in METHODS:
+            raise ValueError("Unknown method '%s' (choose from %s)" % (
+                method, ', '.join(METHODS)))
+        try:
+            mix[method] = float(weight) if weight else 1.0
+        except ValueError:
+            raise ValueError("Invalid weight for '%s': %s" % (method, weight))
+    return mix
+
+
+class LoadTest(object):
+    """
+    Drive ``num_requests`` payments through the facade from ``concurrency``
+    worker threads.
+
+    Historic methods (fulfill, cancel and refund) act on a pre-auth made
+    earlier by the same worker, making one first if necessary.
+    """
+    facade_class = InstrumentedFacade
+
+    def __init__(self, num_requests=1000, concurrency=4, mix=None,
+                 amount=D('10.00'), card_number='1000011000000005',
+                 trace_memory=False):
+        self.num_requests = num_requests
+        self.concurrency = concurrency
+        self.mix = mix or {'pre': 1}
+        self.amount = amount
+        self.bankcard = Bankcard(card_number, '12/30', '123')
+        self.trace_memory = trace_memory
+        self.samples = []
+        self.elapsed = None
+        self.peak_traced_memory = None
+        self._order_numbers = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def next_order_number(self):
+        with self._lock:
+            return '%s-%d' % (ORDER_NUMBER_PREFIX, next(self._order_numbers))
+
+    def methods(self):
+        methods, weights = zip(*sorted(self.mix.items()))
+        total = sum(weights)
+        for i in range(self.num_requests):
+            threshold, cumulative = random.random() * total, 0
+            for method, weight in zip(methods, weights):
+                cumulative += weight
+                if threshold < cumulative:
+                    break
+            yield method
+
+    def run(self):
+        jobs = queue.Queue()
+        for method in self.methods():
+            jobs.put(method)
+
+        tracemalloc = None
+        if self.trace_memory:
+            import tracemalloc
+            tracemalloc.start()
+        start = time.time()
+        if self.concurrency == 1:
+            # Run in this thread so the current database connection is used
+            self.worker(jobs)
+        else:
+            threads = [threading.Thread(target=self.thread_worker,
+                                        args=(jobs,))
+                       for i in range(self.concurrency)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.elapsed = time.time() - start
+        if tracemalloc is not None:
+            self.peak_traced_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return self
+
+    def thread_worker(self, jobs):
+        try:
+            self.worker(jobs)
+        finally:
+            connection.close()
+
+    def worker(self, jobs):
+        facade = self.facade_class()
+        preauths = collections.deque()
+        while True:
+            try:
+                method = jobs.get_nowait()
+            except queue.Empty:
+                return
+            if method in HISTORIC_METHODS and not preauths:
+                self.payment(facade, 'pre', preauths)
+            self.payment(facade, method, preauths)
+
+    def payment(self, facade, method, preauths):
+        _local.phases = dict.fromkeys(PHASES, 0.0)
+        error = None
+        capture = None
+        if CaptureQueriesContext is not None:
+            capture = CaptureQueriesContext(connection)
+            capture.__enter__()
+        start = time.time()
+        try:
+            self.call(facade, method, preauths)
+        except Exception as e:
+            error = e.__class__.__name__
+        finally:
+            total = time.time() - start
+            if capture is not None:
+                capture.__exit__(None, None, None)
+            phases, _local.phases = _local.phases, None
+        num_queries = len(capture) if capture is not None else None
+        sample = Sample(method, phases, total, num_queries, error)
+        with self._lock:
+            self.samples.append(sample)
+        return sample
+
+    def call(self, facade, method, preauths):
+        if method in ('pre', 'auth'):
+            order_number = self.next_order_number()
+            api = (facade.pre_authorise if method == 'pre'
+                   else facade.authorise)
+            reference = api(order_number, self.amount,
+                            bankcard=self.bankcard)
+            if method == 'pre':
+                preauths.append((order_number, reference,
+                                 facade.last_response['auth_code']))
+            return
+
+        order_number, reference, auth_code = preauths.popleft()
+        if method == 'fulfill':
+            facade.fulfill_transaction(order_number, self.amount, reference,
+                                       auth_code)
+        elif method == 'cancel':
+            facade.cancel_transaction(order_number, reference)
+        else:
+            facade.refund_transaction(order_number, self.amount, reference)
+
+    # Reporting
+
+    @property
+    def throughput(self):
+        return len(self.samples) / self.elapsed if self.elapsed else 0
+
+    def errors(self):
+        return collections.Counter(s.error for s in self.samples if s.error)
+
+    def phase_timings(self, samples=None):
+        """
+        Return a list of ``(phase, timings)`` pairs, in seconds
+        """
+        samples = self.samples if samples is None else samples
+        rows = [(phase, [s.phases[phase] for s in samples])
+                for phase in PHASES]
+        rows.append(('total', [s.total for s in samples]))
+        return rows
+
+    def queries_per_payment(self):
+        counts = [s.num_queries for s in self.samples
+                  if s.num_queries is not None]
+        if not counts:
+            return None
+        return float(sum(counts)) / len(counts), max(counts)
+
+    def peak_rss(self):
+        """
+        Return the peak resident set size of this process in bytes
+        """
+        if resource is None:
+            return None
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS bytes
+        return rss if rss > 1 << 30 else rss * 1024
+
+    def report(self):
+        lines = ["%d payments in %.2fs: %.1f payments/s with %d threads" % (
+            len(self.samples), self.elapsed, self.throughput,
+            self.concurrency)]
+        errors = self.errors()
+        if errors:
+            lines.append("Errors: %s" % ', '.join(
+                '%s x %d' % item for item in sorted(errors.items())))
+
+        lines.append("")
+        lines.extend(self._latency_table(self.phase_timings()))
+
+        by_method = collections.defaultdict(list)
+        for sample in self.samples:
+            by_method[sample.method].append(sample)
+        lines.append("")
+        lines.append("%-10s %8s %9s %9s %9s" % (
+            'method', 'count', 'p50 ms', 'p95 ms', 'p99 ms'))
+        for method in METHODS:
+            if method not in by_method:
+                continue
+            totals = [s.total for s in by_method[method]]
+            lines.append("%-10s %8d %s" % (
+                method, len(totals), self._percentiles(totals)))
+
+        lines.append("")
+        queries = self.queries_per_payment()
+        if queries is not None:
+            lines.append("DB queries per payment: %.2f (max %d)" % queries)
+        rss = self.peak_rss()
+        if rss is not None:
+            lines.append("Peak RSS: %.1f MiB" % (rss / 1048576.0))
+        if self.peak_traced_memory is not None:
+            lines.append("Peak traced memory: %.1f MiB" % (
+                self.peak_traced_memory / 1048576.0))
+        return '\n'.join(lines)
+
+    def _latency_table(self, rows):
+        lines = ["%-10s %9s %9s %9s %9s" % (
+            'phase', 'mean ms', 'p50 ms', 'p95 ms', 'p99 ms')]
+        for phase, timings in rows:
+            mean = sum(timings) / len(timings) if timings else 0
+            lines.append("%-10s %9.2f %s" % (
+                phase, mean * 1000, self._percentiles(timings)))
+        return lines
+
+    def _percentiles(self, timings):
+        return ' '.join('%9.2f' % ((percentile(timings, pct) or 0) * 1000)
+                        for pct in (50, 95, 99))
+
+    def cleanup(self):
+        """
+        Delete the transactions created by the load test
+        """
+        OrderTransaction.objects.filter(
+            order_number__startswith='%s-' % ORDER_NUMBER_PREFIX).delete()
@@ -0,0 +1,58 @@
+import os
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from datacash import archive
+from datacash.models import OrderTransaction, FraudResponse
+
+
+class Command(BaseCommand):
+    help = ("Archive old transactions and fraud responses to gzipped JSON "
+            "lines files, or restore an order's archived history")
+    option_list = BaseCommand.option_list + (
+        make_option('--dir',
+                    help="Archive directory (defaults to the "
+                         "DATACASH_ARCHIVE_DIR setting)"),
+        make_option('--days', type='int',
+                    help="Archive rows older than this many days (defaults "
+                         "to the DATACASH_ARCHIVE_AFTER_DAYS setting or 365)"),
+        make_option('--mode', choices=archive.MODES, default=archive.DELETE,
+                    help="'delete' archived rows (the default) or 'blank' "
+                         "their raw XML"),
+        make_option('--batch-size', type='int', default=500,
+                    help="Number of rows to archive per transaction"),
+        make_option('--pause', type='float', default=0.5,
+                    help="Seconds to wait between batches"),
+        make_option('--restore', metavar='ORDER_NUMBER',
+                    help="Restore the archived rows for an order"),
+    )
+
+    def handle(self, *args, **options):
+        directory = options['dir'] or getattr(
+            settings, 'DATACASH_ARCHIVE_DIR', None)
+        if not directory:
+            raise CommandError("Please specify an archive directory with "
+                               "--dir or DATACASH_ARCHIVE_DIR")
+        if not os.path.isdir(directory):
+            raise CommandError("%s is not a directory" % directory)
+
+        if options['restore']:
+            counts = archive.restore(directory, options['restore'])
+            self.stdout.write(
+                "Restored %d transactions and %d fraud responses for order "
+                "%s" % (counts[OrderTransaction], counts[FraudResponse],
+                        options['restore']))
+            return
+
+        days = options['days']
+        if days is None:
+            days = getattr(settings, 'DATACASH_ARCHIVE_AFTER_DAYS', 365)
+        counts = archive.archive(
+            directory, days, mode=options['mode'],
+            batch_size=options['batch_size'], pause=options['pause'])
+        self.stdout.write(
+            "Archived %d transactions and %d fraud responses older than %d "
+            "days to %s" % (counts[OrderTransaction], counts[FraudResponse],
+                            days, directory))
@@ -0,0 +1,67 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from datacash import fields
+from datacash.models import OrderTransaction
+from datacash.scrubber import scrub
+
+
+class Command(BaseCommand):
+    help = ("Compress (or decompress) the request and response XML of "
+            "existing transactions")
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=500,
+                    help="Number of transactions to load at once"),
+        make_option('--decompress', action='store_true', default=False,
+                    help="Convert compressed transactions back to plain text"),
+    )
+
+    def handle(self, *args, **options):
+        if options['decompress'] and fields.compression_enabled():
+            raise CommandError("Disable DATACASH_COMPRESS_XML before "
+                               "decompressing transactions")
+        queryset = OrderTransaction.objects.order_by('pk')
+        num_converted = bytes_before = bytes_after = 0
+        last_pk = 0
+        while True:
+            # values_list returns the stored (possibly compressed) values
+            rows = list(queryset.filter(pk__gt=last_pk).values_list(
+                'pk', 'request_xml', 'response_xml')[:options['batch_size']])
+            if not rows:
+                break
+            for pk, request_xml, response_xml in rows:
+                converted = [
+                    self.convert(request_xml, options['decompress'], scrub),
+                    self.convert(response_xml, options['decompress'])]
+                if converted == [request_xml, response_xml]:
+                    continue
+                self.save(pk, *converted)
+                num_converted += 1
+                bytes_before += self.size(request_xml, response_xml)
+                bytes_after += self.size(*converted)
+            last_pk = rows[-1][0]
+
+        self.stdout.write("Converted %d transactions: %d bytes to %d bytes "
+                          "(%d bytes saved)" % (
+                              num_converted, bytes_before, bytes_after,
+                              bytes_before - bytes_after))
+
+    def size(self, *values):
+        return sum(len(value.encode('utf8')) for value in values)
+
+    def convert(self, value, decompress, clean=None):
+        # Values are cleaned (ie the request XML scrubbed) before being
+        # compressed, as it can't be done afterwards without decompressing
+        if decompress:
+            value = fields.decompress(value)
+            return clean(value) if clean else value
+        if not value or fields.is_compressed(value):
+            return value
+        return fields.compress(clean(value) if clean else value)
+
+    def save(self, pk, request_xml, response_xml):
+        # Stored values are written as is: CompressedTextField won't compress
+        # a value twice.
+        OrderTransaction.objects.filter(pk=pk).update(
+            request_xml=request_xml, response_xml=response_xml)
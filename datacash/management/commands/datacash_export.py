@@ -0,0 +1,70 @@
+import io
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from datacash import export
+from datacash.dashboard import forms
+from datacash.models import OrderTransaction, FraudResponse
+
+EXPORTS = {
+    'transactions': (OrderTransaction, forms.TransactionSearchForm),
+    'fraud-responses': (FraudResponse, forms.FraudResponseSearchForm),
+}
+
+
+class Command(BaseCommand):
+    args = '<%s>' % '|'.join(sorted(EXPORTS))
+    help = ("Export transactions or fraud responses as CSV or JSON lines, "
+            "streaming rows so any number can be exported")
+    option_list = BaseCommand.option_list + (
+        make_option('--format', choices=export.FORMATS, default=export.CSV,
+                    help="csv (the default) or jsonl"),
+        make_option('--include-xml', action='store_true', default=False,
+                    help="Include the raw XML"),
+        make_option('--filter', action='append', default=[],
+                    metavar='NAME=VALUE',
+                    help="Filter as in the dashboard search form, eg "
+                         "--filter method=auth --filter date_from=2014-01-01"),
+        make_option('--batch-size', type='int', default=1000,
+                    help="Number of rows to load at once"),
+        make_option('-o', '--output',
+                    help="File to write to (defaults to standard output)"),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or args[0] not in EXPORTS:
+            raise CommandError("Please specify one of: %s" % ', '.join(
+                sorted(EXPORTS)))
+        model, form_class = EXPORTS[args[0]]
+
+        data = {}
+        for item in options['filter']:
+            name, sep, value = item.partition('=')
+            if not sep:
+                raise CommandError("Filters must be NAME=VALUE: %s" % item)
+            data[name] = value
+        form = form_class(data)
+        unknown = set(data) - set(form.fields)
+        if unknown:
+            raise CommandError("Unknown filters: %s" % ', '.join(
+                sorted(unknown)))
+        if not form.is_valid():
+            raise CommandError("Invalid filters: %s" % ', '.join(
+                '%s (%s)' % (name, ' '.join(errors))
+                for name, errors in sorted(form.errors.items())))
+
+        lines = export.export(
+            form.filter(model._default_manager.all()), options['format'],
+            include_payload=options['include_xml'],
+            batch_size=options['batch_size'])
+        if options['output']:
+            with io.open(options['output'], 'w', encoding='utf8',
+                         newline='') as f:
+                self.write(f, lines)
+        else:
+            self.write(self.stdout, lines)
+
+    def write(self, f, lines):
+        for line in lines:
+            f.write(line)
@@ -0,0 +1,64 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from datacash import connection, loadtest
+from datacash.simulator import Simulator
+
+
+class Command(BaseCommand):
+    help = ("Measure the throughput and latency of facade payments, "
+            "including the audit trail writes")
+    option_list = BaseCommand.option_list + (
+        make_option('-n', '--requests', type='int', default=1000,
+                    help="Number of payments to make (default: 1000)"),
+        make_option('-c', '--concurrency', type='int', default=4,
+                    help="Number of worker threads (default: 4)"),
+        make_option('--mix', default='pre',
+                    help="Weighted mix of methods, eg 'pre=3,fulfill=2,auth=1'"
+                         " (default: pre).  Choose from %s" % ', '.join(
+                             loadtest.METHODS)),
+        make_option('--external', action='store_true', default=False,
+                    help="Use DATACASH_HOST rather than a local simulator"),
+        make_option('--latency', type='float', default=0,
+                    help="Latency of the local simulator in seconds"),
+        make_option('--jitter', type='float', default=0,
+                    help="Jitter of the local simulator in seconds"),
+        make_option('--trace-memory', action='store_true', default=False,
+                    help="Report peak Python memory use (slower; needs "
+                         "Python 3.4+)"),
+        make_option('--keep', action='store_true', default=False,
+                    help="Keep the transactions created by the load test"),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            mix = loadtest.parse_mix(options['mix'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        if options['requests'] < 1 or options['concurrency'] < 1:
+            raise CommandError("--requests and --concurrency must be positive")
+
+        test = loadtest.LoadTest(
+            num_requests=options['requests'],
+            concurrency=options['concurrency'], mix=mix,
+            trace_memory=options['trace_memory'])
+
+        simulator = None
+        overrides = {}
+        if not options['external']:
+            simulator = Simulator(latency=options['latency'],
+                                  jitter=options['jitter']).start()
+            overrides = {'DATACASH_HOST': simulator.host,
+                         'DATACASH_USE_SSL': False}
+        try:
+            with override_settings(**overrides):
+                test.run()
+        finally:
+            if simulator is not None:
+                connection.clear_pools()
+                simulator.stop()
+            if not options['keep']:
+                test.cleanup()
+        self.stdout.write(test.report())
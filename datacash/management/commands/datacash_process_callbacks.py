@@ -0,0 +1,45 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from datacash.the3rdman import inbox
+
+
+class Command(BaseCommand):
+    help = ("Create the fraud responses for The3rdMan callbacks stored in "
+            "ack-first mode (DATACASH_3RDMAN_ACK_FIRST)")
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=100,
+                    help="Number of callbacks to load at once"),
+        make_option('--max-attempts', type='int', default=inbox.MAX_ATTEMPTS,
+                    help="Mark a callback as failed after this many attempts"),
+        make_option('--retry-delay', type='int', default=inbox.RETRY_DELAY,
+                    help="Seconds before the first retry of a callback "
+                         "(doubling for each one after that)"),
+        make_option('--interval', type='float',
+                    help="Keep running, checking for new callbacks every "
+                         "INTERVAL seconds"),
+        make_option('--batch', action='store_true', default=False,
+                    help="Create each batch of fraud responses with one "
+                         "INSERT and send responses_received once per batch "
+                         "(instead of response_received for each)"),
+        make_option('--retry-failed', action='store_true', default=False,
+                    help="Queue failed callbacks to be processed again "
+                         "first"),
+    )
+
+    def handle(self, *args, **options):
+        if options['retry_failed']:
+            self.stdout.write("Queued %d failed callbacks" %
+                              inbox.retry_failed())
+        while True:
+            num_processed, num_failed = inbox.drain(
+                options['batch_size'], options['max_attempts'],
+                options['retry_delay'], options['batch'])
+            if num_processed or num_failed or not options['interval']:
+                self.stdout.write("Processed %d callbacks (%d failed)" % (
+                    num_processed, num_failed))
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,63 @@
+import io
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from datacash import export, reconcile
+
+
+class Command(BaseCommand):
+    args = '<settlement.csv>'
+    help = ("Reconcile a Datacash settlement report (CSV, sorted by datacash "
+            "reference) against the transaction audit trail and write a CSV "
+            "report of the mismatches")
+    option_list = BaseCommand.option_list + (
+        make_option('--column', action='append', default=[],
+                    metavar='FIELD=HEADER',
+                    help="Settlement file header for reference, amount, "
+                         "method or status, eg --column 'reference=DC Ref'"),
+        make_option('--batch-size', type='int', default=5000,
+                    help="Number of transactions to load at once"),
+        make_option('-o', '--output',
+                    help="File to write the report to (defaults to standard "
+                         "output)"),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Please specify a settlement file")
+        columns = {}
+        for item in options['column']:
+            name, sep, header = item.partition('=')
+            if not sep or name not in reconcile.COLUMNS:
+                raise CommandError(
+                    "Columns must be FIELD=HEADER where FIELD is one of: %s"
+                    % ', '.join(sorted(reconcile.COLUMNS)))
+            columns[name] = header
+
+        start = time.time()
+        with reconcile.open_settlement_file(args[0]) as f:
+            reconciler = reconcile.Reconciler(
+                reconcile.read_settlement(f, columns),
+                reconcile.read_audit_trail(batch_size=options['batch_size']))
+            lines = export.csv_lines(reconciler, reconcile.Mismatch._fields)
+            try:
+                if options['output']:
+                    with io.open(options['output'], 'w', encoding='utf8',
+                                 newline='') as out:
+                        for line in lines:
+                            out.write(line)
+                else:
+                    for line in lines:
+                        self.stdout.write(line)
+            except reconcile.ReconciliationError as e:
+                raise CommandError(str(e))
+
+        self.stderr.write(
+            "Reconciled %d settled transactions against %d in the audit "
+            "trail in %.1fs: %d mismatches (%s)" % (
+                reconciler.num_settled, reconciler.num_transactions,
+                time.time() - start, sum(reconciler.counts.values()),
+                ', '.join('%s: %d' % (kind, reconciler.counts[kind])
+                          for kind in reconcile.KINDS)))
@@ -0,0 +1,39 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from datacash import stats
+
+
+class Command(BaseCommand):
+    help = ("Add transactions recorded since the last run to the payment "
+            "statistics shown on the dashboard")
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=1000,
+                    help="Number of transactions to load at once"),
+        make_option('--lag', type='int', default=60,
+                    help="Leave transactions from the last LAG seconds for "
+                         "the next run"),
+        make_option('--rebuild', action='store_true', default=False,
+                    help="Recalculate the statistics from every transaction "
+                         "(DATACASH_STATS_REALTIME must be off)"),
+    )
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            try:
+                num_added = stats.rebuild(options['batch_size'])
+            except stats.StatisticsError as e:
+                raise CommandError(str(e))
+        elif stats.realtime_enabled():
+            raise CommandError(
+                "DATACASH_STATS_REALTIME is enabled so the statistics are "
+                "already up to date")
+        else:
+            try:
+                num_added = stats.catch_up(options['batch_size'],
+                                           options['lag'])
+            except stats.StatisticsError as e:
+                raise CommandError("%s (use --rebuild)" % e)
+        self.stdout.write("Added %d transactions to the statistics" %
+                          num_added)
@@ -0,0 +1,42 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from datacash import fields
+from datacash.models import OrderTransaction
+from datacash.scrubber import scrub
+
+
+class Command(BaseCommand):
+    help = ("Mask card numbers, CV2s and passwords in the request XML of "
+            "existing transactions")
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=500,
+                    help="Number of transactions to load at once"),
+        make_option('--dry-run', action='store_true', default=False,
+                    help="Only report how many transactions need masking"),
+    )
+
+    def handle(self, *args, **options):
+        queryset = OrderTransaction.objects.order_by('pk')
+        num_checked = num_scrubbed = 0
+        last_pk = 0
+        while True:
+            # values_list returns the stored (possibly compressed) values
+            rows = list(queryset.filter(pk__gt=last_pk).values_list(
+                'pk', 'request_xml')[:options['batch_size']])
+            if not rows:
+                break
+            for pk, request_xml in rows:
+                request_xml = fields.decompress(request_xml)
+                scrubbed = scrub(request_xml)
+                if scrubbed != request_xml:
+                    num_scrubbed += 1
+                    if not options['dry_run']:
+                        # Compressed again if DATACASH_COMPRESS_XML is on
+                        queryset.filter(pk=pk).update(request_xml=scrubbed)
+            num_checked += len(rows)
+            last_pk = rows[-1][0]
+        self.stdout.write("%d of %d transactions %s masking" % (
+            num_scrubbed, num_checked,
+            'need' if options['dry_run'] else 'needed'))
@@ -0,0 +1,69 @@
+import tempfile
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from datacash import simulator
+
+
+class Command(BaseCommand):
+    help = "Run a local stand-in for the Datacash XML endpoint"
+    option_list = BaseCommand.option_list + (
+        make_option('--host', default='127.0.0.1',
+                    help="Interface to listen on (default: 127.0.0.1)"),
+        make_option('--port', type='int', default=8443,
+                    help="Port to listen on (default: 8443)"),
+        make_option('--path', default='/Transaction',
+                    help="Path of the XML endpoint (default: /Transaction)"),
+        make_option('--https', action='store_true', default=False,
+                    help="Serve over HTTPS.  A self-signed certificate is "
+                         "generated unless --cert is given"),
+        make_option('--cert', help="Certificate file for HTTPS"),
+        make_option('--key', help="Private key file for HTTPS"),
+        make_option('--client',
+                    help="Only accept requests using this client"),
+        make_option('--password',
+                    help="Only accept requests using this password"),
+        make_option('--latency', type='float', default=0,
+                    help="Seconds to wait before responding"),
+        make_option('--jitter', type='float', default=0,
+                    help="Random extra latency of up to this many seconds"),
+        make_option('--error-rate', type='float', default=0,
+                    help="Fraction of requests answered with a HTTP 500"),
+        make_option('--reset-rate', type='float', default=0,
+                    help="Fraction of connections to reset"),
+        make_option('--drip-delay', type='float', default=0,
+                    help="Seconds to wait between each chunk of the "
+                         "response body"),
+        make_option('--drip-size', type='int', default=16,
+                    help="Size of each dripped chunk in bytes"),
+    )
+
+    def handle(self, *args, **options):
+        certfile, keyfile = options['cert'], options['key']
+        if certfile and not options['https']:
+            raise CommandError("--cert requires --https")
+        if options['https'] and not certfile:
+            certfile, keyfile = simulator.generate_certificate(
+                tempfile.mkdtemp())
+            self.stdout.write("Generated self-signed certificate %s" %
+                              certfile)
+
+        server = simulator.Simulator(
+            host=options['host'], port=options['port'], path=options['path'],
+            client=options['client'], password=options['password'],
+            certfile=certfile, keyfile=keyfile,
+            latency=options['latency'], jitter=options['jitter'],
+            error_rate=options['error_rate'],
+            reset_rate=options['reset_rate'],
+            drip_delay=options['drip_delay'],
+            drip_size=options['drip_size'])
+        server.start()
+        self.stdout.write("Listening on %s://%s%s" % (
+            'https' if server.use_ssl else 'http', server.host, options['path']))
+        self.stdout.write("Set DATACASH_HOST = '%s' and "
+                          "DATACASH_USE_SSL = %s" % (server.host,
+                                                     server.use_ssl))
+        if server.use_ssl:
+            self.stdout.write("and DATACASH_SSL_CAFILE = '%s'" % certfile)
+        server.serve_forever()
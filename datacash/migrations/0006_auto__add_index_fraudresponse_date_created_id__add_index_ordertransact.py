@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding index on 'FraudResponse', fields ['date_created', u'id']
+        db.create_index(u'datacash_fraudresponse', ['date_created', u'id'])
+
+        # Adding index on 'OrderTransaction', fields ['date_created', u'id']
+        db.create_index(u'datacash_ordertransaction', ['date_created', u'id'])
+
+
+    def backwards(self, orm):
+        # Removing index on 'OrderTransaction', fields ['date_created', u'id']
+        db.delete_index(u'datacash_ordertransaction', ['date_created', u'id'])
+
+        # Removing index on 'FraudResponse', fields ['date_created', u'id']
+        db.delete_index(u'datacash_fraudresponse', ['date_created', u'id'])
+
+
+    models = {
+        u'datacash.fraudresponse': {
+            'Meta': {'ordering': "('-date_created',)", 'object_name': 'FraudResponse', 'index_together': "[('date_created', 'id')]"},
+            'aggregator_identifier': ('django.db.models.fields.CharField', [], {'max_length': '15', 'blank': 'True'}),
+            'date_created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'merchant_identifier': ('django.db.models.fields.CharField', [], {'max_length': '15'}),
+            'merchant_order_ref': ('django.db.models.fields.CharField', [], {'max_length': '250', 'db_index': 'True'}),
+            'message_digest': ('django.db.models.fields.CharField', [], {'max_length': '128', 'blank': 'True'}),
+            'raw_response': ('django.db.models.fields.TextField', [], {}),
+            'recommendation': ('django.db.models.fields.IntegerField', [], {}),
+            'score': ('django.db.models.fields.IntegerField', [], {}),
+            't3m_id': ('django.db.models.fields.CharField', [], {'max_length': '128', 'db_index': 'True'})
+        },
+        u'datacash.ordertransaction': {
+            'Meta': {'ordering': "('-date_created',)", 'object_name': 'OrderTransaction', 'index_together': "[('date_created', 'id')]"},
+            'amount': ('django.db.models.fields.DecimalField', [], {'null': 'True', 'max_digits': '12', 'decimal_places': '2', 'blank': 'True'}),
+            'auth_code': ('django.db.models.fields.CharField', [], {'max_length': '128', 'null': 'True', 'blank': 'True'}),
+            'currency': ('django.db.models.fields.CharField', [], {'default': "'GBP'", 'max_length': '12'}),
+            'datacash_reference': ('django.db.models.fields.CharField', [], {'max_length': '128', 'null': 'True', 'blank': 'True'}),
+            'date_created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'merchant_reference': ('django.db.models.fields.CharField', [], {'max_length': '128', 'null': 'True', 'blank': 'True'}),
+            'method': ('django.db.models.fields.CharField', [], {'max_length': '12'}),
+            'order_number': ('django.db.models.fields.CharField', [], {'max_length': '128', 'db_index': 'True'}),
+            'reason': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'request_xml': ('datacash.fields.CompressedTextField', [], {}),
+            'response_xml': ('datacash.fields.CompressedTextField', [], {}),
+            'status': ('django.db.models.fields.PositiveIntegerField', [], {})
+        }
+    }
+
+    complete_apps = ['datacash']
\ No newline at end of file
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'FraudCallback'
+        db.create_table(u'datacash_fraudcallback', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('raw_body', self.gf('django.db.models.fields.TextField')()),
+            ('attempts', self.gf('django.db.models.fields.PositiveIntegerField')(default=0)),
+            ('last_error', self.gf('django.db.models.fields.TextField')(blank=True)),
+            ('failed', self.gf('django.db.models.fields.BooleanField')(default=False)),
+            ('next_attempt', self.gf('django.db.models.fields.DateTimeField')(default=datetime.datetime.now)),
+            ('date_received', self.gf('django.db.models.fields.DateTimeField')(auto_now_add=True, blank=True)),
+        ))
+        db.send_create_signal(u'datacash', ['FraudCallback'])
+
+        # Adding index on 'FraudCallback', fields ['failed', 'next_attempt', u'id']
+        db.create_index(u'datacash_fraudcallback', ['failed', 'next_attempt', u'id'])
+
+
+    def backwards(self, orm):
+        # Removing index on 'FraudCallback', fields ['failed', 'next_attempt', u'id']
+        db.delete_index(u'datacash_fraudcallback', ['failed', 'next_attempt', u'id'])
+
+        # Deleting model 'FraudCallback'
+        db.delete_table(u'datacash_fraudcallback')
+
+
+    models = {
+        u'datacash.fraudcallback': {
+            'Meta': {'ordering': "('id',)", 'object_name': 'FraudCallback', 'index_together': "[('failed', 'next_attempt', 'id')]"},
+            'attempts': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'date_received': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'failed': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_error': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'next_attempt': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'raw_body': ('django.db.models.fields.TextField', [], {})
+        },
+        u'datacash.fraudresponse': {
+            'Meta': {'ordering': "('-date_created',)", 'object_name': 'FraudResponse', 'index_together': "[('date_created', 'id')]"},
+            'aggregator_identifier': ('django.db.models.fields.CharField', [], {'max_length': '15', 'blank': 'True'}),
+            'date_created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'merchant_identifier': ('django.db.models.fields.CharField', [], {'max_length': '15'}),
+            'merchant_order_ref': ('django.db.models.fields.CharField', [], {'max_length': '250', 'db_index': 'True'}),
+            'message_digest': ('django.db.models.fields.CharField', [], {'max_length': '128', 'blank': 'True'}),
+            'raw_response': ('django.db.models.fields.TextField', [], {}),
+            'recommendation': ('django.db.models.fields.IntegerField', [], {}),
+            'score': ('django.db.models.fields.IntegerField', [], {}),
+            't3m_id': ('django.db.models.fields.CharField', [], {'max_length': '128', 'db_index': 'True'})
+        },
+        u'datacash.ordertransaction': {
+            'Meta': {'ordering': "('-date_created',)", 'object_name': 'OrderTransaction', 'index_together': "[('date_created', 'id'), ('method', 'date_created', 'id'), ('status', 'date_created', 'id'), ('currency', 'date_created', 'id')]"},
+            'amount': ('django.db.models.fields.DecimalField', [], {'db_index': 'True', 'null': 'True', 'max_digits': '12', 'decimal_places': '2', 'blank': 'True'}),
+            'auth_code': ('django.db.models.fields.CharField', [], {'max_length': '128', 'null': 'True', 'blank': 'True'}),
+            'currency': ('django.db.models.fields.CharField', [], {'default': "'GBP'", 'max_length': '12'}),
+            'datacash_reference': ('django.db.models.fields.CharField', [], {'db_index': 'True', 'max_length': '128', 'null': 'True', 'blank': 'True'}),
+            'date_created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'merchant_reference': ('django.db.models.fields.CharField', [], {'db_index': 'True', 'max_length': '128', 'null': 'True', 'blank': 'True'}),
+            'method': ('django.db.models.fields.CharField', [], {'max_length': '12'}),
+            'order_number': ('django.db.models.fields.CharField', [], {'max_length': '128', 'db_index': 'True'}),
+            'reason': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'request_xml': ('datacash.fields.CompressedTextField', [], {}),
+            'response_xml': ('datacash.fields.CompressedTextField', [], {}),
+            'status': ('django.db.models.fields.PositiveIntegerField', [], {})
+        },
+        u'datacash.paymentstatistic': {
+            'Meta': {'ordering': "('-hour',)", 'unique_together': "(('hour', 'method', 'currency', 'card_scheme', 'status'),)", 'object_name': 'PaymentStatistic'},
+            'card_scheme': ('django.db.models.fields.CharField', [], {'max_length': '128', 'blank': 'True'}),
+            'currency': ('django.db.models.fields.CharField', [], {'max_length': '12'}),
+            'hour': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'method': ('django.db.models.fields.CharField', [], {'max_length': '12'}),
+            'num_transactions': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'status': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'total_amount': ('django.db.models.fields.DecimalField', [], {'default': '0', 'max_digits': '16', 'decimal_places': '2'})
+        },
+        u'datacash.paymentstatisticmark': {
+            'Meta': {'object_name': 'PaymentStatisticMark'},
+            'date_updated': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_transaction_id': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'})
+        }
+    }
+
+    complete_apps = ['datacash']
\ No newline at end of file
@@ -1,19 +1,102 @@
-import re
-from xml.dom.minidom import parseString
-from six.moves.urllib.parse import parse_qs
-
-from django.db import models
+import base64
+import contextlib
+import hashlib
+import sys
+from xml.parsers.expat import ExpatError
+import six
+
+from django.db import models, transaction, IntegrityError
 from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
 
-from .the3rdman import signals
+from . import xmlutils
+from .fields import CompressedTextField
+from .scrubber import scrub
+from .the3rdman import parsing, signals
+
+try:
+    savepoint = transaction.atomic
+except AttributeError:
+    # Django < 1.6, where nesting commit_on_success would commit (or roll
+    # back) the caller's transaction
+    @contextlib.contextmanager
+    def savepoint():
+        sid = transaction.savepoint()
+        try:
+            yield
+        except Exception:
+            transaction.savepoint_rollback(sid)
+            raise
+        transaction.savepoint_commit(sid)
+
+# Pretty-printed XML is cached by content so never needs invalidating
+PRETTY_XML_CACHE_TIMEOUT = 60 * 60 * 24 * 30
 
 
 def prettify_xml(xml_str):
-    xml_str = re.sub(r'\s*\n\s*', '', xml_str)
-    ugly = parseString(xml_str.encode('utf8')).toprettyxml(indent='    ')
-    regex = re.compile(r'>\n\s+([^<>\s].*?)\n\s+</', re.DOTALL)
-    return regex.sub('>\g<1></', ugly)
+    """
+    Return ``xml_str`` indented for display, or unchanged if it isn't
+    well-formed (eg it was truncated)
+    """
+    if not xml_str:
+        return xml_str
+    try:
+        return xmlutils.pretty_print(xml_str)
+    except ExpatError:
+        return xml_str
+
+
+def cached_prettify_xml(xml_str):
+    if not xml_str:
+        return xml_str
+    key = 'datacash:pretty-xml:%s' % hashlib.md5(
+        xml_str.encode('utf8')).hexdigest()
+    pretty = cache.get(key)
+    if pretty is None:
+        pretty = prettify_xml(xml_str)
+        cache.set(key, pretty, PRETTY_XML_CACHE_TIMEOUT)
+    return pretty
+
+
+class OrderTransactionQuerySet(models.query.QuerySet):
+    """
+    Ensures sensitive data is masked on bulk write paths, which bypass
+    ``OrderTransaction.save``
+    """
+
+    def without_payload(self):
+        """
+        Defer the (large) request and response XML, so only the narrow
+        columns are read.  They are loaded when first accessed.
+        """
+        return self.defer(*OrderTransaction.PAYLOAD_FIELDS)
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        for obj in objs:
+            obj.redact()
+        return super(OrderTransactionQuerySet, self).bulk_create(
+            objs, *args, **kwargs)
+
+    def update(self, **kwargs):
+        request_xml = kwargs.get('request_xml')
+        if isinstance(request_xml, (six.text_type, bytes)):
+            kwargs['request_xml'] = scrub(request_xml)
+        return super(OrderTransactionQuerySet, self).update(**kwargs)
+
+
+class OrderTransactionManager(models.Manager):
+
+    def get_queryset(self):
+        return OrderTransactionQuerySet(self.model, using=self._db)
+
+    # Django < 1.6
+    get_query_set = get_queryset
+
+    def without_payload(self):
+        return self.get_queryset().without_payload()
 
 
 @python_2_unicode_compatible
@@ -26,47 +109,65 @@ class OrderTransaction(models.Model):
     # The 'method' of the transaction - one of 'auth', 'pre', 'cancel', ...
     method = models.CharField(max_length=12)
     amount = models.DecimalField(
-        decimal_places=2, max_digits=12, blank=True, null=True)
+        decimal_places=2, max_digits=12, blank=True, null=True, db_index=True)
     currency = models.CharField(
         max_length=12, default=settings.DATACASH_CURRENCY)
     merchant_reference = models.CharField(
-        max_length=128, blank=True, null=True)
+        max_length=128, blank=True, null=True, db_index=True)
 
     # Response fields
-    datacash_reference = models.CharField(max_length=128, blank=True, null=True)
+    datacash_reference = models.CharField(
+        max_length=128, blank=True, null=True, db_index=True)
     auth_code = models.CharField(max_length=128, blank=True, null=True)
     status = models.PositiveIntegerField()
     reason = models.CharField(max_length=255)
 
-    # Store full XML for debugging purposes
-    request_xml = models.TextField()
-    response_xml = models.TextField()
+    # Store full XML for debugging purposes.  These are compressed when
+    # DATACASH_COMPRESS_XML is enabled.
+    request_xml = CompressedTextField()
+    response_xml = CompressedTextField()
 
     date_created = models.DateTimeField(auto_now_add=True)
+    # Set when the row is restored from an archive (see datacash.archive)
+    date_restored = models.DateTimeField(blank=True, null=True)
+
+    objects = OrderTransactionManager()
+
+    PAYLOAD_FIELDS = ('request_xml', 'response_xml')
 
     class Meta:
         ordering = ('-date_created',)
-
-    def _replace_credit_card_number(self, matchobj):
-        """ Credit card number can be from 13 to 19 digits long. Shown only
-        last 4 of them and replace others with 'X' still keeping
-        number of digits """
-        return "<%(element)s>%(hidden)s%(last4)s</%(element)s>" % {
-            'element': matchobj.group(1),
-            'hidden': "X" * len(matchobj.group(2)),
-            'last4': matchobj.group(3),
-        }
+        # Support keyset pagination of the dashboard list, optionally
+        # filtered by one of the low-cardinality columns
+        index_together = [('date_created', 'id'),
+                          ('method', 'date_created', 'id'),
+                          ('status', 'date_created', 'id'),
+                          ('currency', 'date_created', 'id')]
+
+    def load_payload(self):
+        """
+        Load any deferred XML fields using a single query
+        """
+        missing = [name for name in self.PAYLOAD_FIELDS
+                   if name not in self.__dict__]
+        if not missing or self.pk is None:
+            return
+        values = self.__class__._base_manager.filter(
+            pk=self.pk).values_list(*missing)[0]
+        for name, value in zip(missing, values):
+            self.__dict__[name] = self._meta.get_field(name).to_python(value)
+
+    def redact(self):
+        """
+        Remove sensitive data (card numbers, CV2s and passwords) from the
+        request XML
+        """
+        self.request_xml = scrub(self.request_xml)
 
     def save(self, *args, **kwargs):
         # Ensure sensitive data isn't saved
         if not self.pk:
-            cc_regex = re.compile(r'<(pan|alt_pan)>(\d+)(\d{4})</\1>')
-            self.request_xml = cc_regex.sub(self._replace_credit_card_number,
-                                            self.request_xml)
-            ccv_regex = re.compile(r'<cv2>\d+</cv2>')
-            self.request_xml = ccv_regex.sub('<cv2>XXX</cv2>', self.request_xml)
-            pw_regex = re.compile(r'<password>.*</password>')
-            self.request_xml = pw_regex.sub('<password>XXX</password>', self.request_xml)
+            self.redact()
         super(OrderTransaction, self).save(*args, **kwargs)
 
     def __str__(self):
@@ -76,13 +177,21 @@ class OrderTransaction(models.Model):
             self.datacash_reference,
             self.status)
 
+    def _pretty_xml(self, name):
+        # Memoized so templates can use these repeatedly
+        pretty = self.__dict__.setdefault('_pretty_xml_cache', {})
+        if name not in pretty:
+            self.load_payload()
+            pretty[name] = cached_prettify_xml(getattr(self, name))
+        return pretty[name]
+
     @property
     def pretty_request_xml(self):
-        return prettify_xml(self.request_xml)
+        return self._pretty_xml('request_xml')
 
     @property
     def pretty_response_xml(self):
-        return prettify_xml(self.response_xml)
+        return self._pretty_xml('response_xml')
 
     @property
     def accepted(self):
@@ -104,8 +213,14 @@ class FraudResponse(models.Model):
     RELEASE, HOLD, REJECT, UNDER_INVESTIGATION = 0, 1, 2, 9
     recommendation = models.IntegerField()
     message_digest = models.CharField(max_length=128, blank=True)
+    # A digest of ``repeat_key``, as an index of the fields themselves would
+    # be too long for MySQL
+    repeat_digest = models.CharField(max_length=40, unique=True,
+                                     editable=False)
     raw_response = models.TextField()
     date_created = models.DateTimeField(auto_now_add=True)
+    # Set when the row is restored from an archive (see datacash.archive)
+    date_restored = models.DateTimeField(blank=True, null=True)
 
     def __str__(self):
         return u"t3m ID %s (score: %s, recommendation: %s)" % (
@@ -113,54 +228,118 @@ class FraudResponse(models.Model):
 
     class Meta:
         ordering = ('-date_created',)
+        index_together = [('date_created', 'id')]
+
+    @classmethod
+    def create_from_body(cls, body):
+        """
+        Create a fraud response instance from a callback request body
+        """
+        return cls.build_from_body(body).save_callback()
 
     @classmethod
     def create_from_xml(cls, xml_string):
         """
         Create a fraud response instance from an XML payload
         """
-        # Helper function for text extraction
-        def tag_text(doc, tag_name):
-            try:
-                ele = doc.getElementsByTagName(tag_name)[0]
-            except IndexError:
-                return ''
-            if ele.firstChild:
-                return ele.firstChild.data
-            return ''
-
-        doc = parseString(xml_string)
-        return cls.create_from_payload(xml_string, doc, tag_text)
+        return cls.build_from_xml(xml_string).save_callback()
 
     @classmethod
     def create_from_querystring(cls, query):
         """
         Create a fraud response instance from a querystring payload
         """
-        def extract(data, key):
-            return data.get(key, [""])[0]
-
-        data = parse_qs(query)
-        return cls.create_from_payload(query, data, extract)
+        return cls.build_from_querystring(query).save_callback()
 
     @classmethod
     def create_from_payload(cls, raw, payload, extract_fn):
-        response = cls.objects.create(
-            aggregator_identifier=extract_fn(payload, 'aggregator_identifier'),
-            merchant_identifier=extract_fn(payload, 'merchant_identifier'),
-            merchant_order_ref=extract_fn(payload, 'merchant_order_ref'),
-            t3m_id=extract_fn(payload, 't3m_id'),
-            score=int(extract_fn(payload, 'score')),
-            recommendation=int(extract_fn(payload, 'recommendation')),
-            message_digest=extract_fn(payload, 'message_digest'),
-            raw_response=raw)
-
-        # Raise signal so other processes can update orders based on this fraud
-        # response.
-        signals.response_received.send_robust(sender=cls, response=response)
+        """
+        Create a fraud response from a callback payload, or return the
+        existing one if the callback is a repeat
+        """
+        return cls.build_from_payload(raw, payload, extract_fn).save_callback()
+
+    @classmethod
+    def build_from_body(cls, body):
+        """
+        Return an unsaved fraud response instance for a callback request body
+        """
+        return cls.build_from_fields(body, parsing.parse_callback(body))
+
+    @classmethod
+    def build_from_xml(cls, xml_string):
+        return cls.build_from_fields(xml_string, parsing.parse_xml(xml_string))
+
+    @classmethod
+    def build_from_querystring(cls, query):
+        return cls.build_from_fields(query, parsing.parse_querystring(query))
+
+    @classmethod
+    def build_from_payload(cls, raw, payload, extract_fn):
+        return cls.build_from_fields(raw, dict(
+            (name, extract_fn(payload, name)) for name in parsing.FIELDS))
+
+    @classmethod
+    def build_from_fields(cls, raw, fields):
+        return cls(
+            aggregator_identifier=fields['aggregator_identifier'],
+            merchant_identifier=fields['merchant_identifier'],
+            merchant_order_ref=fields['merchant_order_ref'],
+            t3m_id=fields['t3m_id'],
+            score=int(fields['score']),
+            recommendation=int(fields['recommendation']),
+            message_digest=fields['message_digest'],
+            raw_response=raw).set_repeat_digest()
 
+    @property
+    def repeat_key(self):
+        """
+        The fields which identify a repeat of the same callback
+        """
+        return (self.t3m_id, self.recommendation, self.message_digest)
+
+    def set_repeat_digest(self):
+        # Datacash can send the same callback more than once
+        key = u'%s\n%s\n%s' % self.repeat_key
+        self.repeat_digest = hashlib.sha1(key.encode('utf8')).hexdigest()
+        return self
+
+    def save(self, *args, **kwargs):
+        self.set_repeat_digest()
+        super(FraudResponse, self).save(*args, **kwargs)
+
+    def save_callback(self):
+        """
+        Save a new fraud response and raise ``response_received``, or return
+        the existing response if this is a repeat callback
+        """
+        response, created = self.save_unless_repeat()
+        if created:
+            # Raise signal so other processes can update orders based on this
+            # fraud response.
+            signals.response_received.send_robust(sender=self.__class__,
+                                                  response=response)
         return response
 
+    def save_unless_repeat(self):
+        """
+        Save a new fraud response, returning it and True, or return the
+        existing response and False if this is a repeat callback
+        """
+        # Insert first rather than look for a repeat, as repeats are rare
+        try:
+            with savepoint():
+                self.save(force_insert=True)
+        except IntegrityError:
+            exc_info = sys.exc_info()
+            existing = list(self.__class__.objects.filter(
+                repeat_digest=self.repeat_digest)[:1])
+            if not existing:
+                six.reraise(*exc_info)
+            # Receivers have already handled this callback
+            return existing[0], False
+        return self, True
+
     @property
     def on_hold(self):
         return self.recommendation == self.HOLD
@@ -202,3 +381,89 @@ class FraudResponse(models.Model):
         host = 'cnpanalyst.com' if is_live else 'test.cnpanalyst.com'
         return 'https://%s/TransactionDetails.aspx?TID=%s' % (
             host, self.t3m_id)
+
+
+@python_2_unicode_compatible
+class PaymentStatistic(models.Model):
+    """
+    The number and total value of transactions for each hour, method,
+    currency, card scheme and status.  These are maintained by
+    ``datacash.stats`` so the dashboard needn't aggregate the transactions
+    themselves.
+    """
+    hour = models.DateTimeField(db_index=True)
+    method = models.CharField(max_length=12)
+    currency = models.CharField(max_length=12)
+    card_scheme = models.CharField(max_length=128, blank=True)
+    status = models.PositiveIntegerField()
+
+    num_transactions = models.PositiveIntegerField(default=0)
+    total_amount = models.DecimalField(
+        decimal_places=2, max_digits=16, default=0)
+
+    class Meta:
+        ordering = ('-hour',)
+        unique_together = ('hour', 'method', 'currency', 'card_scheme',
+                           'status')
+
+    def __str__(self):
+        return u'%s %s %s %s (status %s): %d' % (
+            self.hour, self.method.upper(), self.currency, self.card_scheme,
+            self.status, self.num_transactions)
+
+
+class PaymentStatisticMark(models.Model):
+    """
+    The last transaction included in the statistics by the catch-up command
+    """
+    last_transaction_id = models.PositiveIntegerField(default=0)
+    # Set when transactions have been added in realtime, so later ones may
+    # already be counted
+    realtime = models.BooleanField(default=False)
+    date_updated = models.DateTimeField(auto_now=True)
+
+
+@python_2_unicode_compatible
+class FraudCallback(models.Model):
+    """
+    A The3rdMan callback stored by the callback view in ack-first mode, until
+    ``datacash.the3rdman.inbox`` creates its fraud response
+    """
+    raw_body = models.TextField()
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    # Callbacks which have used up their attempts are kept for inspection
+    failed = models.BooleanField(default=False)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    date_received = models.DateTimeField(auto_now_add=True)
+
+    # Bodies which aren't valid UTF-8 are stored base 64 encoded after this
+    # marker, which can't begin an XML document or a callback query string
+    BASE64_MARKER = u'base64:'
+
+    class Meta:
+        ordering = ('id',)
+        index_together = [('failed', 'next_attempt', 'id')]
+
+    def __str__(self):
+        return u"Callback %s received %s (%d attempts)" % (
+            self.pk, self.date_received, self.attempts)
+
+    @classmethod
+    def encode_body(cls, body):
+        """
+        Return the text to store for a request body (bytes)
+        """
+        try:
+            return body.decode('utf8')
+        except UnicodeDecodeError:
+            return cls.BASE64_MARKER + base64.b64encode(body).decode('ascii')
+
+    @property
+    def body(self):
+        """
+        The original request body (bytes)
+        """
+        if self.raw_body.startswith(self.BASE64_MARKER):
+            return base64.b64decode(self.raw_body[len(self.BASE64_MARKER):])
+        return self.raw_body.encode('utf8')
@@ -0,0 +1,276 @@
+"""
+Reconciliation of a Datacash settlement report against the ``OrderTransaction``
+audit trail.
+
+Both inputs are read in ``datacash_reference`` order and merge-joined, so only
+the rows for one reference are held in memory at a time.  The settlement file
+must already be sorted by reference (eg with ``sort``); the audit trail is
+read from the database in batches using the ``datacash_reference`` index.
+
+Each mismatch is one of:
+
+* ``missing`` - settled by Datacash but not in the audit trail
+* ``unsettled`` - accepted in the audit trail but not settled
+* ``amount differs`` - settled for a different amount
+* ``status differs`` - settled although the audit trail has it as not
+  accepted, or the settlement status disagrees with ours
+* ``unexpected fulfil`` - a fulfil was settled for a reference we never
+  successfully fulfilled
+"""
+import collections
+import csv
+import io
+import itertools
+from decimal import Decimal, InvalidOperation
+
+import six
+
+from . import gateway
+from .models import OrderTransaction
+
+MISSING = 'missing'
+UNSETTLED = 'unsettled'
+AMOUNT_DIFFERS = 'amount differs'
+STATUS_DIFFERS = 'status differs'
+UNEXPECTED_FULFIL = 'unexpected fulfil'
+KINDS = (MISSING, UNSETTLED, AMOUNT_DIFFERS, STATUS_DIFFERS,
+         UNEXPECTED_FULFIL)
+
+ACCEPTED = 1
+
+CENTS = Decimal('0.01')
+
+# Methods which move money and so should appear in a settlement report
+SETTLED_METHODS = (gateway.AUTH, gateway.FULFILL, gateway.REFUND,
+                   gateway.TXN_REFUND, gateway.ERP)
+
+# Default settlement file headers for each field.  Only the reference and
+# amount are required.
+COLUMNS = {
+    'reference': 'datacash_reference',
+    'amount': 'amount',
+    'method': 'method',
+    'status': 'status',
+}
+
+# Settlement method names which differ from ours
+METHOD_ALIASES = {
+    'fulfil': gateway.FULFILL,
+}
+
+SettlementRecord = collections.namedtuple(
+    'SettlementRecord', 'line reference amount method status')
+AuditRecord = collections.namedtuple(
+    'AuditRecord', 'pk reference amount method status')
+Mismatch = collections.namedtuple(
+    'Mismatch', 'kind reference method settled_amount audit_amount detail')
+
+
+class ReconciliationError(Exception):
+    pass
+
+
+def open_settlement_file(path):
+    # The Python 2 csv module only reads bytes
+    if six.PY2:
+        return open(path, 'rb')
+    return io.open(path, 'r', encoding='utf8', newline='')
+
+
+def read_settlement(f, columns=None):
+    """
+    Yield a ``SettlementRecord`` for each line of a settlement CSV file, which
+    must be sorted by reference
+    """
+    headers = dict(COLUMNS, **(columns or {}))
+    reader = csv.DictReader(f)
+    fieldnames = reader.fieldnames or []
+    for name in ('reference', 'amount'):
+        if headers[name] not in fieldnames:
+            raise ReconciliationError(
+                "The settlement file has no '%s' column" % headers[name])
+    method_header = headers['method'] if headers['method'] in fieldnames \
+        else None
+    status_header = headers['status'] if headers['status'] in fieldnames \
+        else None
+
+    previous = None
+    for row in reader:
+        line = reader.line_num
+        reference = row[headers['reference']].strip()
+        if previous is not None and reference < previous:
+            raise ReconciliationError(
+                "The settlement file isn't sorted by %s (line %d)" % (
+                    headers['reference'], line))
+        previous = reference
+        try:
+            amount = Decimal(row[headers['amount']].strip())
+        except InvalidOperation:
+            raise ReconciliationError("Invalid amount on line %d: %s" % (
+                line, row[headers['amount']]))
+        method = None
+        if method_header:
+            method = row[method_header].strip().lower()
+            method = METHOD_ALIASES.get(method, method)
+        status = None
+        if status_header and row[status_header].strip():
+            try:
+                status = int(row[status_header])
+            except ValueError:
+                raise ReconciliationError("Invalid status on line %d: %s" % (
+                    line, row[status_header]))
+        yield SettlementRecord(line, reference, amount, method, status)
+
+
+def _audit_record(pk, reference, amount, method, status):
+    # Some databases (SQLite) drop trailing zeroes
+    if amount is not None:
+        amount = amount.quantize(CENTS)
+    return AuditRecord(pk, reference, amount, method, status)
+
+
+def read_audit_trail(queryset=None, batch_size=5000):
+    """
+    Yield an ``AuditRecord`` for each transaction with a Datacash reference,
+    in reference order
+    """
+    if queryset is None:
+        queryset = OrderTransaction.objects.all()
+    queryset = queryset.exclude(datacash_reference__isnull=True).exclude(
+        datacash_reference='').order_by('datacash_reference', 'pk')
+    fields = ('pk', 'datacash_reference', 'amount', 'method', 'status')
+
+    last_reference = None
+    while True:
+        batch = queryset
+        if last_reference is not None:
+            batch = batch.filter(datacash_reference__gt=last_reference)
+        rows = list(batch.values_list(*fields)[:batch_size])
+        if len(rows) < batch_size:
+            for row in rows:
+                yield _audit_record(*row)
+            return
+        # The last reference may continue into the next batch, so read all
+        # of its rows separately
+        last_reference = rows[-1][1]
+        for row in rows:
+            if row[1] == last_reference:
+                break
+            yield _audit_record(*row)
+        for row in queryset.filter(
+                datacash_reference=last_reference).values_list(*fields):
+            yield _audit_record(*row)
+
+
+def _grouped(records, source):
+    previous = None
+    for reference, group in itertools.groupby(
+            records, key=lambda record: record.reference):
+        # The merge relies on both inputs using the same ordering (which a
+        # database collation might not)
+        if previous is not None and reference <= previous:
+            raise ReconciliationError(
+                "The %s isn't in datacash reference order" % source)
+        previous = reference
+        yield reference, list(group)
+
+
+class Reconciler(object):
+    """
+    Merge-join settlement records and audit records (both in reference order)
+    and yield a ``Mismatch`` for each discrepancy.
+
+    Counts of the rows read and mismatches found are kept as attributes.
+    """
+
+    def __init__(self, settlement, audit_trail):
+        self.settlement = settlement
+        self.audit_trail = audit_trail
+        self.num_settled = 0
+        self.num_transactions = 0
+        self.counts = dict((kind, 0) for kind in KINDS)
+
+    def __iter__(self):
+        settled = _grouped(self.settlement, 'settlement file')
+        audited = _grouped(self.audit_trail, 'audit trail')
+        settled_group = next(settled, None)
+        audited_group = next(audited, None)
+        while settled_group is not None or audited_group is not None:
+            if audited_group is None or (
+                    settled_group is not None and
+                    settled_group[0] < audited_group[0]):
+                reference, records, txns = settled_group + ([],)
+                settled_group = next(settled, None)
+            elif settled_group is None or audited_group[0] < settled_group[0]:
+                reference, txns, records = audited_group + ([],)
+                audited_group = next(audited, None)
+            else:
+                reference, records = settled_group
+                txns = audited_group[1]
+                settled_group = next(settled, None)
+                audited_group = next(audited, None)
+            self.num_settled += len(records)
+            self.num_transactions += len(txns)
+            for mismatch in self.compare(reference, records, txns):
+                self.counts[mismatch.kind] += 1
+                yield mismatch
+
+    def compare(self, reference, records, txns):
+        """
+        Compare the settlement records and transactions for one reference
+        """
+        cancelled = any(txn.method == gateway.CANCEL and
+                        txn.status == ACCEPTED for txn in txns)
+        unmatched = [txn for txn in txns if txn.method in SETTLED_METHODS]
+        for record in records:
+            txn = self.match(record, unmatched)
+            if txn is None:
+                if record.method == gateway.FULFILL:
+                    yield Mismatch(UNEXPECTED_FULFIL, reference,
+                                   record.method, record.amount, None,
+                                   "No accepted fulfil in the audit trail")
+                else:
+                    yield Mismatch(MISSING, reference, record.method,
+                                   record.amount, None,
+                                   "Not in the audit trail")
+                continue
+            unmatched.remove(txn)
+            if cancelled:
+                yield Mismatch(STATUS_DIFFERS, reference, txn.method,
+                               record.amount, txn.amount,
+                               "Cancelled in the audit trail")
+            elif txn.status != ACCEPTED:
+                yield Mismatch(STATUS_DIFFERS, reference, txn.method,
+                               record.amount, txn.amount,
+                               "Status %s in the audit trail" % txn.status)
+            elif record.status is not None and record.status != txn.status:
+                yield Mismatch(STATUS_DIFFERS, reference, txn.method,
+                               record.amount, txn.amount,
+                               "Status %s in the settlement file" %
+                               record.status)
+            if txn.amount is not None and record.amount != txn.amount:
+                yield Mismatch(AMOUNT_DIFFERS, reference, txn.method,
+                               record.amount, txn.amount, "")
+
+        if not cancelled:
+            for txn in unmatched:
+                if txn.status == ACCEPTED:
+                    yield Mismatch(UNSETTLED, reference, txn.method, None,
+                                   txn.amount, "Not in the settlement file")
+
+    def match(self, record, txns):
+        """
+        Return the transaction a settlement record corresponds to, preferring
+        an accepted transaction of the same method
+        """
+        candidates = [txn for txn in txns
+                      if record.method is None or txn.method == record.method]
+        accepted = [txn for txn in candidates if txn.status == ACCEPTED]
+        if accepted:
+            return accepted[0]
+        if record.method == gateway.FULFILL:
+            # A failed fulfil doesn't explain a settled one
+            return None
+        if candidates:
+            return candidates[0]
+        return None
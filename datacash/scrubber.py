@@ -0,0 +1,63 @@
+"""
+Masking of sensitive data in request XML before it is stored.
+
+Card numbers (``pan`` and ``alt_pan``) keep their last four digits, eg
+``<pan>XXXXXXXXXXXX0007</pan>``.  CV2s and passwords are replaced entirely
+with ``XXX``.  All elements are masked in a single pass using a pattern which
+is compiled once, and both text and bytes are supported.
+"""
+import re
+
+import six
+
+CARD_ELEMENTS = ('pan', 'alt_pan')
+SECRET_ELEMENTS = ('cv2', 'password')
+
+MASK = 'XXX'
+
+
+class Scrubber(object):
+
+    def __init__(self, card_elements=CARD_ELEMENTS,
+                 secret_elements=SECRET_ELEMENTS, mask=MASK):
+        # Card numbers are 13 to 19 digits long but anything with more than
+        # four digits is masked.
+        pattern = r'<(%s)>(\d+)(\d{4})</\1>|<(%s)>[^<]*</\4>' % (
+            '|'.join(card_elements), '|'.join(secret_elements))
+        self.text_pattern = re.compile(six.text_type(pattern))
+        self.bytes_pattern = re.compile(pattern.encode('ascii'))
+        self.text_mask = six.text_type(mask)
+        self.bytes_mask = mask.encode('ascii')
+
+    def scrub(self, data):
+        """
+        Return ``data`` (text or bytes) with sensitive elements masked
+        """
+        if isinstance(data, bytes):
+            return self.bytes_pattern.sub(self._mask_bytes, data)
+        return self.text_pattern.sub(self._mask_text, data)
+
+    def _mask_text(self, match):
+        element, digits, last4, secret = match.groups()
+        if secret is not None:
+            return u'<%s>%s</%s>' % (secret, self.text_mask, secret)
+        return u'<%s>%s%s</%s>' % (element, u'X' * len(digits), last4,
+                                   element)
+
+    def _mask_bytes(self, match):
+        element, digits, last4, secret = match.groups()
+        if secret is not None:
+            return b''.join((b'<', secret, b'>', self.bytes_mask, b'</',
+                             secret, b'>'))
+        return b''.join((b'<', element, b'>', b'X' * len(digits), last4,
+                         b'</', element, b'>'))
+
+
+default_scrubber = Scrubber()
+
+
+def scrub(data):
+    """
+    Mask sensitive elements using the default scrubber
+    """
+    return default_scrubber.scrub(data)
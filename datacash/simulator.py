@@ -0,0 +1,343 @@
+"""
+A local stand-in for the Datacash XML transaction endpoint.
+
+The simulator understands the request documents built by
+``datacash.gateway.Gateway`` and answers with realistic responses, so the
+real HTTP path (connection pooling, timeouts, error handling) can be
+exercised offline.  Faults such as latency, HTTP errors, slowly dripped
+response bodies and connection resets can be injected to test throughput and
+tail latency.
+
+Outcomes are keyed off the card number and the pence of the amount:
+
+* Cards in ``DECLINED_CARDS`` are declined
+* Amounts ending in .02 are declined
+* Amounts ending in .19, .56 or .59 return the corresponding Datacash error
+  status
+* Everything else is accepted
+
+Run it with the ``datacash_simulator`` management command or start it from
+code::
+
+    simulator = Simulator(port=0)
+    simulator.start()
+    gateway = Gateway(simulator.host, '/Transaction', 'client', 'password',
+                      use_ssl=False)
+"""
+import itertools
+import logging
+import os
+import random
+import socket
+import ssl
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import urlencode
+from six.moves.urllib.request import Request, urlopen
+
+from . import gateway, xmlutils
+
+logger = logging.getLogger('datacash.simulator')
+
+DECLINED_CARDS = ('4444333322221111', '1000010000000015')
+
+# Datacash statuses returned for amounts ending in these pence
+ERROR_AMOUNTS = {
+    '19': (19, 'Unable to fulfill transaction'),
+    '56': (56, 'Transaction submitted too soon after previous one'),
+    '59': (59, 'This combination of currency, card type and environment is '
+               'not supported by the client\'s configuration'),
+}
+
+HISTORIC_REASONS = {
+    gateway.FULFILL: 'FULFILLED OK',
+    gateway.CANCEL: 'CANCELLED OK',
+    gateway.TXN_REFUND: 'ACCEPTED',
+}
+
+
+def card_scheme(pan):
+    if pan.startswith('4'):
+        return 'VISA'
+    if pan[:2] in ('51', '52', '53', '54', '55'):
+        return 'Mastercard'
+    if pan.startswith(('34', '37')):
+        return 'American Express'
+    return 'Maestro'
+
+
+class Simulator(object):
+    """
+    A threaded HTTP(S) server speaking the Datacash XML API
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, path='/Transaction',
+                 client=None, password=None, certfile=None, keyfile=None,
+                 latency=0, jitter=0, error_rate=0, reset_rate=0,
+                 drip_delay=0, drip_size=16):
+        self.address = (host, port)
+        self.path = path
+        self.client = client
+        self.password = password
+        self.certfile = certfile
+        self.keyfile = keyfile
+
+        # Fault injection
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.reset_rate = reset_rate
+        self.drip_delay = drip_delay
+        self.drip_size = drip_size
+
+        self._references = itertools.count(4000000000000000)
+        self._lock = threading.Lock()
+        self.num_requests = 0
+        self.server = None
+        self._thread = None
+
+    @property
+    def host(self):
+        """
+        The value to use for DATACASH_HOST
+        """
+        return '%s:%s' % self.server.server_address[:2]
+
+    @property
+    def use_ssl(self):
+        return self.certfile is not None
+
+    def start(self):
+        self.server = ThreadedHTTPServer(self.address, RequestHandler)
+        self.server.simulator = self
+        if self.use_ssl:
+            context = ssl.SSLContext(
+                getattr(ssl, 'PROTOCOL_TLS_SERVER', ssl.PROTOCOL_SSLv23))
+            context.load_cert_chain(self.certfile, self.keyfile)
+            self.server.socket = context.wrap_socket(
+                self.server.socket, server_side=True)
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        logger.info("Datacash simulator listening on %s", self.host)
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self._thread.join()
+            self.server = None
+
+    def serve_forever(self):
+        if self.server is None:
+            self.start()
+        try:
+            while self._thread.is_alive():
+                self._thread.join(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def next_reference(self):
+        with self._lock:
+            self.num_requests += 1
+            return str(next(self._references))
+
+    def respond(self, request_xml):
+        """
+        Return the response XML for a request document
+        """
+        fields = xmlutils.extract_text_fields(request_xml)
+        reference = self.next_reference()
+        response = {
+            'datacash_reference': reference,
+            'merchantreference': fields.get(
+                'Transaction.TxnDetails.merchantreference') or reference,
+            'mode': 'TEST',
+            'time': str(int(time.time())),
+        }
+        if ((self.client is not None
+             and fields.get('Authentication.client') != self.client)
+                or (self.password is not None
+                    and fields.get('Authentication.password') != self.password)):
+            response.update(status=gateway.INVALID_CREDENTIALS,
+                            reason='Invalid CLIENT/PASS')
+            return build_response(response)
+
+        amount = fields.get('Transaction.TxnDetails.amount') or ''
+        pence = amount.rsplit('.', 1)[-1] if '.' in amount else ''
+        if 'Transaction.HistoricTxn.method' in fields:
+            method = fields['Transaction.HistoricTxn.method']
+            response['datacash_reference'] = fields[
+                'Transaction.HistoricTxn.reference']
+            if pence in ERROR_AMOUNTS:
+                response['status'], response['reason'] = ERROR_AMOUNTS[pence]
+            else:
+                response.update(status=gateway.ACCEPTED,
+                                reason=HISTORIC_REASONS.get(method, 'ACCEPTED'))
+            return build_response(response)
+
+        pan = fields.get('Transaction.CardTxn.Card.pan', '')
+        card = {'card_scheme': card_scheme(pan) if pan else 'VISA',
+                'country': 'United Kingdom'}
+        if pence in ERROR_AMOUNTS:
+            response['status'], response['reason'] = ERROR_AMOUNTS[pence]
+        elif pan in DECLINED_CARDS or pence == '02':
+            response.update(status=gateway.DECLINED, reason='DECLINED')
+            card['authcode'] = 'DECLINED'
+        else:
+            response.update(status=gateway.ACCEPTED, reason='ACCEPTED')
+            card['authcode'] = '%06d' % random.randint(0, 999999)
+        return build_response(response, card)
+
+
+def build_response(fields, card=None):
+    writer = xmlutils.XmlWriter()
+    writer.start('Response')
+    if card:
+        writer.start('CardTxn')
+        for key in ('authcode', 'card_scheme', 'country'):
+            if key in card:
+                writer.element(key, card[key])
+        writer.end('CardTxn')
+    for key in ('datacash_reference', 'merchantreference', 'mode', 'reason',
+                'status', 'time'):
+        writer.element(key, fields[key])
+    writer.end('Response')
+    return writer.getvalue().encode('utf8')
+
+
+class ThreadedHTTPServer(socketserver.ThreadingMixIn,
+                         BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        # Clients closing connections (including mid TLS handshake or while
+        # a response is being written) are expected, eg when a pool discards
+        # an idle connection or an injected reset is tested.  Socket errors
+        # (which include SSL errors) are logged rather than printed.
+        error = sys.exc_info()[1]
+        if isinstance(error, socket.error):
+            logger.debug("Connection from %s closed: %r", client_address,
+                         error)
+            return
+        BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Support keep-alive
+    protocol_version = 'HTTP/1.1'
+    # The headers and body are written separately so Nagle's algorithm would
+    # otherwise hold the body back until the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def do_POST(self):
+        simulator = self.server.simulator
+        length = int(self.headers.get('Content-Length', 0))
+        request_xml = self.rfile.read(length)
+
+        delay = simulator.latency
+        if simulator.jitter:
+            delay += random.uniform(0, simulator.jitter)
+        if delay:
+            time.sleep(delay)
+
+        if random.random() < simulator.reset_rate:
+            self.reset_connection()
+            return
+        if self.path != simulator.path:
+            self.send_body(404, b'Not found')
+            return
+        if random.random() < simulator.error_rate:
+            self.send_body(500, b'Internal server error')
+            return
+        try:
+            response_xml = simulator.respond(request_xml)
+        except Exception:
+            logger.exception("Unable to handle request")
+            self.send_body(500, b'Unable to parse request')
+            return
+        self.send_body(200, response_xml)
+
+    def send_body(self, status, body):
+        simulator = self.server.simulator
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not simulator.drip_delay:
+            self.wfile.write(body)
+            return
+        # Slow-drip the body to exercise read timeouts
+        for i in range(0, len(body), simulator.drip_size):
+            self.wfile.write(body[i:i + simulator.drip_size])
+            self.wfile.flush()
+            time.sleep(simulator.drip_delay)
+
+    def reset_connection(self):
+        # Closing with a zero linger timeout sends a RST rather than a FIN
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                   struct.pack('ii', 1, 0))
+        self.close_connection = True
+        self.connection.close()
+
+
+def generate_certificate(directory, hostname='localhost'):
+    """
+    Create a self-signed certificate using the openssl binary and return the
+    ``(certfile, keyfile)`` paths.
+    """
+    certfile = os.path.join(directory, 'simulator.crt')
+    keyfile = os.path.join(directory, 'simulator.key')
+    command = ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+               '-days', '365', '-subj', '/CN=%s' % hostname,
+               '-keyout', keyfile, '-out', certfile]
+    san = ['-addext', 'subjectAltName=DNS:%s,IP:127.0.0.1' % hostname]
+    with open(os.devnull, 'w') as devnull:
+        if subprocess.call(command + san, stdout=devnull, stderr=devnull):
+            # Older versions of openssl don't support -addext
+            subprocess.check_call(command, stdout=devnull, stderr=devnull)
+    return certfile, keyfile
+
+
+def send_fraud_callback(url, merchant_order_ref, t3m_id=None, score=0,
+                        recommendation=0, merchant_identifier='32217',
+                        message_digest='', format='XML', timeout=10):
+    """
+    POST a The3rdMan fraud callback to ``url`` in the same way as Datacash.
+
+    Returns the response body.
+    """
+    fields = [
+        ('aggregator_identifier', ''),
+        ('merchant_identifier', merchant_identifier),
+        ('merchant_order_ref', merchant_order_ref),
+        ('t3m_id', t3m_id or str(random.randint(10 ** 9, 10 ** 10 - 1))),
+        ('score', score),
+        ('recommendation', recommendation),
+        ('message_digest', message_digest),
+    ]
+    if format == 'XML':
+        writer = xmlutils.XmlWriter(declaration=False)
+        writer.start('RealTimeCallBack', {'xmlns': 'T3MCallback'})
+        for key, value in fields:
+            writer.element(key, u'%s' % value)
+        writer.end('RealTimeCallBack')
+        body = (u'<?xml version="1.0" encoding="utf-8"?>' +
+                writer.getvalue()).encode('utf8')
+    else:
+        body = urlencode(fields).encode('utf8')
+    # Datacash use the same content type for both formats
+    request = Request(url, body, {'Content-Type': 'text/xml'})
+    return urlopen(request, timeout=timeout).read()
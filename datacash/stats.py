@@ -0,0 +1,236 @@
+"""
+Hourly payment statistics.
+
+``PaymentStatistic`` rows hold the number and total value of transactions for
+each hour, method, currency, card scheme and status.  They are kept up to date
+in one of two ways:
+
+* With ``DATACASH_STATS_REALTIME`` enabled, ``Facade.record_txn`` adds each
+  transaction as it is recorded.
+* Otherwise the ``datacash_rollup_stats`` command adds the transactions
+  recorded since it last ran (its high-water mark is stored in
+  ``PaymentStatisticMark``).  Run it regularly, eg from cron.
+
+Realtime updates don't move the high-water mark (transactions aren't recorded
+in id order) but flag it instead.  Catching up from a flagged mark would count
+transactions twice, so after switching realtime updates off the statistics
+must be rebuilt.
+
+Both use ``UPDATE ... SET n = n + 1`` so concurrent writers don't lose counts.
+"""
+import collections
+import datetime
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from . import gateway
+from .models import OrderTransaction, PaymentStatistic, PaymentStatisticMark
+
+try:
+    atomic = transaction.atomic
+except AttributeError:
+    # Django < 1.6
+    atomic = transaction.commit_on_success
+
+ACCEPTED, DECLINED = 1, 7
+
+KEY_FIELDS = ('hour', 'method', 'currency', 'card_scheme', 'status')
+GROUP_BY_FIELDS = KEY_FIELDS
+
+CENTS = Decimal('0.01')
+
+
+class StatisticsError(Exception):
+    pass
+
+
+def realtime_enabled():
+    return getattr(settings, 'DATACASH_STATS_REALTIME', False)
+
+
+def truncate_to_hour(value):
+    return value.replace(minute=0, second=0, microsecond=0)
+
+
+def card_scheme_from_xml(response_xml):
+    if not response_xml:
+        return ''
+    try:
+        return gateway.Response('', response_xml)['card_scheme'] or ''
+    except Exception:
+        return ''
+
+
+class Counter(object):
+    """
+    Counts and totals transactions by statistic key, so a batch of
+    transactions can be written with one UPDATE per key
+    """
+
+    def __init__(self):
+        self.counts = collections.defaultdict(lambda: [0, Decimal('0.00')])
+
+    def add(self, date_created, method, currency, card_scheme, status,
+            amount):
+        key = (truncate_to_hour(date_created), method, currency or '',
+               (card_scheme or '')[:128], status)
+        totals = self.counts[key]
+        totals[0] += 1
+        if amount is not None:
+            totals[1] += amount
+
+    def save(self):
+        for key, (num, total) in self.counts.items():
+            _increment(dict(zip(KEY_FIELDS, key)), num, total)
+        self.counts.clear()
+
+
+def _increment(key, num, total):
+    queryset = PaymentStatistic.objects.filter(**key)
+    values = dict(num_transactions=F('num_transactions') + num,
+                  total_amount=F('total_amount') + total)
+    if queryset.update(**values):
+        return
+    try:
+        with atomic():
+            PaymentStatistic.objects.create(
+                num_transactions=num, total_amount=total, **key)
+    except IntegrityError:
+        # Created by another process in the meantime
+        queryset.update(**values)
+
+
+def record(txn, card_scheme=None):
+    """
+    Add a single transaction to the statistics
+    """
+    counter = Counter()
+    counter.add(txn.date_created or timezone.now(), txn.method, txn.currency,
+                card_scheme, txn.status, txn.amount)
+    with atomic():
+        counter.save()
+        _flag_realtime()
+
+
+def _flag_realtime():
+    marks = PaymentStatisticMark.objects.filter(pk=1)
+    # Usually already flagged, which only needs a read
+    if marks.filter(realtime=True).exists():
+        return
+    if not marks.update(realtime=True):
+        try:
+            with atomic():
+                PaymentStatisticMark.objects.create(pk=1, realtime=True)
+        except IntegrityError:
+            # Created by another process in the meantime
+            marks.update(realtime=True)
+
+
+def catch_up(batch_size=1000, lag=60):
+    """
+    Add transactions recorded since the last run, returning how many were
+    added.
+
+    Transactions from the last ``lag`` seconds are left for the next run, as
+    ones with lower ids may still be being written.
+
+    Raises ``StatisticsError`` if transactions have been added in realtime
+    since the last run.
+    """
+    mark = PaymentStatisticMark.objects.get_or_create(pk=1)[0]
+    if mark.realtime:
+        raise StatisticsError(
+            "Transactions after %d may already have been added in realtime, "
+            "so the statistics need rebuilding" % mark.last_transaction_id)
+    cutoff = timezone.now() - datetime.timedelta(seconds=lag)
+    to_python = OrderTransaction._meta.get_field('response_xml').to_python
+    num_added = 0
+    finished = False
+    while not finished:
+        rows = list(OrderTransaction.objects.filter(
+            pk__gt=mark.last_transaction_id).order_by('pk').values_list(
+                'pk', 'date_created', 'method', 'currency', 'status',
+                'amount', 'response_xml')[:batch_size])
+        finished = len(rows) < batch_size
+        counter = Counter()
+        for (pk, date_created, method, currency, status, amount,
+             response_xml) in rows:
+            if date_created >= cutoff:
+                finished = True
+                break
+            counter.add(date_created, method, currency,
+                        card_scheme_from_xml(to_python(response_xml)),
+                        status, amount)
+            mark.last_transaction_id = pk
+            num_added += 1
+        with atomic():
+            counter.save()
+            # Leave the realtime flag as it is in the database
+            mark.save(update_fields=['last_transaction_id', 'date_updated'])
+    return num_added
+
+
+def rebuild(batch_size=1000):
+    """
+    Recalculate the statistics from every transaction.
+
+    Realtime updates must be off (in every process) while this runs, or the
+    transactions they add would be counted twice, so ``StatisticsError`` is
+    raised if they are enabled or turn out to have happened meanwhile.
+    """
+    if realtime_enabled():
+        raise StatisticsError("DATACASH_STATS_REALTIME must be disabled while "
+                              "the statistics are rebuilt")
+    with atomic():
+        PaymentStatistic.objects.all().delete()
+        PaymentStatisticMark.objects.filter(pk=1).delete()
+    num_added = catch_up(batch_size, lag=0)
+    if PaymentStatisticMark.objects.filter(pk=1, realtime=True).exists():
+        raise StatisticsError("Transactions were added in realtime during "
+                              "the rebuild, so it needs running again")
+    return num_added
+
+
+def summarise(date_from, date_to, group_by='method'):
+    """
+    Return a row of counts, rates and totals for each value of ``group_by``
+    (and currency, so amounts aren't mixed) for hours in
+    ``[date_from, date_to)``
+    """
+    if group_by not in GROUP_BY_FIELDS:
+        raise ValueError("Can't group statistics by %s" % group_by)
+    fields = [group_by] if group_by == 'currency' else [group_by, 'currency']
+    totals = PaymentStatistic.objects.filter(
+        hour__gte=date_from, hour__lt=date_to).values(
+            'status', *fields).annotate(
+                num=Sum('num_transactions'),
+                total=Sum('total_amount')).order_by(*fields)
+    rows = collections.OrderedDict()
+    for values in totals:
+        key = (values[group_by], values['currency'])
+        row = rows.setdefault(key, {
+            'value': key[0], 'currency': key[1], 'num_transactions': 0,
+            'num_accepted': 0, 'num_declined': 0, 'num_errors': 0,
+            'total_amount': Decimal('0.00'),
+            'accepted_amount': Decimal('0.00')})
+        # SQLite may return a float
+        amount = Decimal(str(values['total'] or 0)).quantize(CENTS)
+        row['num_transactions'] += values['num']
+        row['total_amount'] += amount
+        if values['status'] == ACCEPTED:
+            row['num_accepted'] += values['num']
+            row['accepted_amount'] += amount
+        elif values['status'] == DECLINED:
+            row['num_declined'] += values['num']
+        else:
+            row['num_errors'] += values['num']
+    for row in rows.values():
+        for name in ('accepted', 'declined', 'errors'):
+            row['%s_rate' % name] = (
+                100.0 * row['num_%s' % name] / row['num_transactions']
+                if row['num_transactions'] else 0)
+    return list(rows.values())
@@ -1,2 +1,2 @@
-from .document import add_fraud_fields
+from .document import add_fraud_fields, write_fraud_fields
 from .utils import build_data_dict
@@ -1,5 +1,5 @@
-from datacash.xmlutils import create_element
-from xml.dom.minidom import Document, parseString
+from datacash.xmlutils import DomWriter
+from xml.dom.minidom import Document
 
 
 def add_fraud_fields(doc=None, element=None, customer_info=None, delivery_info=None,
@@ -18,35 +18,44 @@ def add_fraud_fields(doc=None, element=None, customer_info=None, delivery_info=N
     # Build the request XML
     if doc is None:
         doc = Document()
-    if element is None:
-        element = doc
+    write_fraud_fields(DomWriter(doc, element), customer_info, delivery_info,
+                       billing_info, account_info, order_info, **kwargs)
+    return doc
+
 
-    envelope = create_element(
-        doc, element, 'The3rdMan', attributes={'type': 'realtime'})
+def write_fraud_fields(writer, customer_info=None, delivery_info=None,
+                       billing_info=None, account_info=None, order_info=None,
+                       **kwargs):
+    """
+    Write the The3rdMan fraud fields using an ``XmlWriter`` (or
+    ``DomWriter``)
+    """
+    writer.start('The3rdMan', attributes={'type': 'realtime'})
 
     if 'callback_url' in kwargs:
         callback_format = kwargs.get('callback_format', 'XML')
         callback_url = kwargs['callback_url']
-        add_realtime_information(doc, envelope, callback_format, callback_url)
+        add_realtime_information(writer, callback_format, callback_url)
 
-    add_customer_information(doc, envelope, customer_info)
-    add_delivery_address(doc, envelope, delivery_info)
-    add_billing_address(doc, envelope, billing_info)
-    add_account_information(doc, envelope, account_info)
-    add_order_information(doc, envelope, order_info)
-    return doc
+    add_customer_information(writer, customer_info)
+    add_delivery_address(writer, delivery_info)
+    add_billing_address(writer, billing_info)
+    add_account_information(writer, account_info)
+    add_order_information(writer, order_info)
+    writer.end('The3rdMan')
 
 
-def add_realtime_information(doc, ele, format, url):
-    rt_ele = create_element(doc, ele, 'Realtime')
-    create_element(doc, rt_ele, 'real_time_callback_format', format)
-    create_element(doc, rt_ele, 'real_time_callback', url)
+def add_realtime_information(writer, format, url):
+    writer.start('Realtime')
+    writer.element('real_time_callback_format', format)
+    writer.element('real_time_callback', url)
+    writer.end('Realtime')
 
 
-def add_xml_fields(doc, parent, fields, values):
+def add_xml_fields(writer, fields, values):
     for field in fields:
         if field in values and values[field] is not None:
-            create_element(doc, parent, field, values[field])
+            writer.element(field, values[field])
 
 
 def intersects(fields, values):
@@ -57,68 +66,75 @@ def intersects(fields, values):
     return len(overlap) > 0
 
 
-def add_customer_information(doc, envelope, customer_info):
+CUSTOMER_FIELDS = (
+    'alt_telephone', 'customer_dob', 'customer_reference',
+    'delivery_forename', 'delivery_phone_number', 'delivery_surname',
+    'delivery_title', 'driving_license_number', 'email',
+    'first_purchase_date', 'forename', 'introduced_by', 'ip_address',
+    'order_number', 'sales_channel', 'surname', 'telephone',
+    'time_zone', 'title')
+ADDRESS_FIELDS = (
+    'street_address_1', 'street_address_2', 'city',
+    'county', 'postcode', 'country')
+BANK_FIELDS = (
+    'account_number', 'bank_address', 'bank_country', 'bank_name',
+    'customer_name', 'sort_code')
+PURCHASE_FIELDS = ('avg', 'max', 'min')
+PRODUCT_FIELDS = ('code', 'prod_id', 'quantity', 'price', 'prod_category',
+                  'prod_description')
+
+
+def add_customer_information(writer, customer_info):
     if not customer_info:
         return
-    cust_ele = create_element(doc, envelope, 'CustomerInformation')
-    cust_fields = (
-        'alt_telephone', 'customer_dob', 'customer_reference',
-        'delivery_forename', 'delivery_phone_number', 'delivery_surname',
-        'delivery_title', 'driving_license_number', 'email',
-        'first_purchase_date', 'forename', 'introduced_by', 'ip_address',
-        'order_number', 'sales_channel', 'surname', 'telephone',
-        'time_zone', 'title')
-    add_xml_fields(doc, cust_ele, cust_fields, customer_info)
-
-
-def add_delivery_address(doc, envelope, delivery_info):
+    writer.start('CustomerInformation')
+    add_xml_fields(writer, CUSTOMER_FIELDS, customer_info)
+    writer.end('CustomerInformation')
+
+
+def add_delivery_address(writer, delivery_info):
     if not delivery_info:
         return
-    delivery_ele = create_element(doc, envelope, 'DeliveryAddress')
-    delivery_fields = (
-        'street_address_1', 'street_address_2', 'city',
-        'county', 'postcode', 'country')
-    add_xml_fields(doc, delivery_ele, delivery_fields, delivery_info)
+    writer.start('DeliveryAddress')
+    add_xml_fields(writer, ADDRESS_FIELDS, delivery_info)
+    writer.end('DeliveryAddress')
 
 
-def add_billing_address(doc, envelope, billing_info):
+def add_billing_address(writer, billing_info):
     if not billing_info:
         return
-    billing_ele = create_element(doc, envelope, 'BillingAddress')
-    billing_fields = (
-        'street_address_1', 'street_address_2', 'city', 'county',
-        'postcode', 'country')
-    add_xml_fields(doc, billing_ele, billing_fields, billing_info)
+    writer.start('BillingAddress')
+    add_xml_fields(writer, ADDRESS_FIELDS, billing_info)
+    writer.end('BillingAddress')
 
 
-def add_account_information(doc, envelope, account_info):
+def add_account_information(writer, account_info):
     if not account_info:
         return
-    account_ele = create_element(doc, envelope, 'AccountInformation')
+    writer.start('AccountInformation')
 
     # Bank information
-    bank_fields = (
-        'account_number', 'bank_address', 'bank_country', 'bank_name',
-        'customer_name', 'sort_code')
-    if intersects(bank_fields, account_info):
-        bank_ele = create_element(doc, account_ele, 'BankInformation')
-        add_xml_fields(doc, bank_ele, bank_fields, account_info)
+    if intersects(BANK_FIELDS, account_info):
+        writer.start('BankInformation')
+        add_xml_fields(writer, BANK_FIELDS, account_info)
+        writer.end('BankInformation')
 
-    purchase_fields = ('avg', 'max', 'min')
-    if intersects(purchase_fields, account_info):
-        purchase_ele = create_element(doc, account_ele, 'PurchaseInformation')
-        add_xml_fields(doc, purchase_ele, purchase_fields, account_info)
+    if intersects(PURCHASE_FIELDS, account_info):
+        writer.start('PurchaseInformation')
+        add_xml_fields(writer, PURCHASE_FIELDS, account_info)
+        writer.end('PurchaseInformation')
+    writer.end('AccountInformation')
 
 
-def add_order_information(doc, envelope, order_info):
+def add_order_information(writer, order_info):
     if not order_info or 'products' not in order_info:
         return
-    order_ele = create_element(doc, envelope, 'OrderInformation')
-    products_ele = create_element(
-        doc, order_ele, 'Products',
-        attributes={'count': len(order_info['products'])})
-    product_fields = ('code', 'prod_id', 'quantity', 'price', 'prod_category',
-                      'prod_description')
+    writer.start('OrderInformation')
+    writer.start('Products',
+                 attributes={'count': len(order_info['products'])})
     for product_info in order_info['products']:
-        product_ele = create_element(doc, products_ele, 'Product')
-        add_xml_fields(doc, product_ele, product_fields, product_info)
+        writer.start('Product')
+        add_xml_fields(writer, PRODUCT_FIELDS, product_info)
+        writer.end('Product')
+    writer.end('Products')
+    writer.end('OrderInformation')
@@ -0,0 +1,239 @@
+"""
+Deferred processing of The3rdMan callbacks.
+
+Datacash only waits a second for the callback view to respond, which leaves
+little time for ``response_received`` receivers.  With
+``DATACASH_3RDMAN_ACK_FIRST`` enabled the view just stores the request body
+as a ``FraudCallback`` and responds, and ``drain`` (run by
+``./manage.py datacash_process_callbacks``) creates the fraud responses and
+raises the signal afterwards.
+
+A callback which can't be processed is retried with an increasing delay, and
+after ``max_attempts`` it is marked as failed and left for inspection.
+
+The signals are sent once the fraud response has been committed and the
+callback deleted, so slow receivers don't hold locks and a rolled back
+transaction can't make them run twice.  Errors raised by receivers are logged
+(``send_robust``) and don't re-queue the callback: its fraud response has
+been saved, so processing it again would only find a repeat.
+
+When a large backlog arrives (eg Datacash replaying callbacks after an
+outage), ``drain(batch=True)`` creates each batch of fraud responses with a
+single INSERT and sends ``responses_received`` once with all of them, so
+receivers can update orders with one query rather than one per callback.
+``response_received`` isn't sent for responses created this way.
+"""
+import collections
+import datetime
+import logging
+import traceback
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.db.models import F
+from django.utils import timezone
+
+from datacash.models import FraudCallback, FraudResponse
+from datacash.the3rdman import parsing, signals
+
+try:
+    atomic = transaction.atomic
+except AttributeError:
+    # Django < 1.6
+    atomic = transaction.commit_on_success
+
+logger = logging.getLogger('datacash.the3rdman')
+
+MAX_ATTEMPTS = 5
+# Seconds before the first retry, doubling for each one after that
+RETRY_DELAY = 60
+
+# Returned by ``process`` for a callback another worker has already processed
+SKIPPED = object()
+
+
+def ack_first_enabled():
+    return getattr(settings, 'DATACASH_3RDMAN_ACK_FIRST', False)
+
+
+def store(body):
+    """
+    Store a callback request body for processing later
+    """
+    parsing.check_size(body)
+    return FraudCallback.objects.create(
+        raw_body=FraudCallback.encode_body(body))
+
+
+def process(callback, max_attempts=MAX_ATTEMPTS, retry_delay=RETRY_DELAY):
+    """
+    Create the fraud response for a stored callback and delete it.
+
+    Returns the fraud response, None if processing failed or ``SKIPPED`` if
+    another worker has already processed the callback.
+    """
+    try:
+        with atomic():
+            # Lock the callback so concurrent workers can't both process it
+            if not list(FraudCallback.objects.select_for_update().filter(
+                    pk=callback.pk, failed=False).values_list('pk')):
+                return SKIPPED
+            response, created = FraudResponse.build_from_body(
+                callback.body).save_unless_repeat()
+            FraudCallback.objects.filter(pk=callback.pk).delete()
+    except Exception:
+        _record_failure(callback, traceback.format_exc(), max_attempts,
+                        retry_delay)
+        return None
+    if created:
+        _send_robust(signals.response_received, response=response)
+    logger.info("Callback %s processed with merchant ref %s", callback.pk,
+                response.merchant_order_ref)
+    return response
+
+
+def _send_robust(signal, **kwargs):
+    for receiver, result in signal.send_robust(sender=FraudResponse,
+                                               **kwargs):
+        if isinstance(result, Exception):
+            logger.error("Error raised by receiver %r: %r", receiver, result)
+
+
+def _record_failure(callback, error, max_attempts, retry_delay):
+    callback.attempts += 1
+    callback.last_error = error
+    callback.failed = callback.attempts >= max_attempts
+    callback.next_attempt = timezone.now() + datetime.timedelta(
+        seconds=retry_delay * 2 ** (callback.attempts - 1))
+    FraudCallback.objects.filter(pk=callback.pk).update(
+        attempts=F('attempts') + 1, last_error=callback.last_error,
+        failed=callback.failed, next_attempt=callback.next_attempt)
+    if callback.failed:
+        logger.error("Callback %s failed after %d attempts:\n%s\n%s",
+                     callback.pk, callback.attempts, callback.raw_body, error)
+    else:
+        logger.warning("Error raised processing callback %s (attempt %d):\n%s",
+                       callback.pk, callback.attempts, error)
+
+
+def process_batch(callbacks, max_attempts=MAX_ATTEMPTS,
+                  retry_delay=RETRY_DELAY):
+    """
+    Create the fraud responses for a batch of stored callbacks with one
+    INSERT, send ``responses_received`` for the new ones and delete the
+    callbacks.
+
+    Returns the numbers processed and failed.
+    """
+    for attempt in (1, 2):
+        failures = []
+        try:
+            with atomic():
+                responses, num_processed = _create_responses(
+                    callbacks, failures)
+            break
+        except IntegrityError:
+            # A response was created by something else in the meantime (eg
+            # the callback view), which the next attempt will see as a repeat
+            if attempt == 2:
+                logger.warning("Conflict processing a batch of callbacks "
+                               "again, processing them one at a time",
+                               exc_info=True)
+                return _process_each(callbacks, max_attempts, retry_delay)
+            logger.warning("Conflict processing a batch of callbacks",
+                           exc_info=True)
+    if responses:
+        _send_robust(signals.responses_received, responses=responses)
+    for callback, error in failures:
+        _record_failure(callback, error, max_attempts, retry_delay)
+    logger.info("Processed %d callbacks in a batch (%d new responses)",
+                num_processed, len(responses))
+    return num_processed, len(failures)
+
+
+def _process_each(callbacks, max_attempts, retry_delay):
+    num_processed = num_failed = 0
+    for callback in callbacks:
+        response = process(callback, max_attempts, retry_delay)
+        if response is None:
+            num_failed += 1
+        elif response is not SKIPPED:
+            num_processed += 1
+    return num_processed, num_failed
+
+
+def _create_responses(callbacks, failures):
+    # Lock the callbacks so concurrent workers can't process them too
+    locked = set(FraudCallback.objects.select_for_update().filter(
+        pk__in=[callback.pk for callback in callbacks],
+        failed=False).values_list('pk', flat=True))
+    responses = collections.OrderedDict()
+    processed = []
+    for callback in callbacks:
+        if callback.pk not in locked:
+            # Processed elsewhere
+            continue
+        try:
+            response = FraudResponse.build_from_body(
+                callback.body)
+        except Exception:
+            failures.append((callback, traceback.format_exc()))
+            continue
+        processed.append(callback.pk)
+        # Repeats are dropped, whether in this batch or already saved
+        responses.setdefault(response.repeat_key, response)
+
+    t3m_ids = set(key[0] for key in responses)
+    for key in FraudResponse.objects.filter(t3m_id__in=t3m_ids).values_list(
+            't3m_id', 'recommendation', 'message_digest'):
+        responses.pop(key, None)
+
+    if responses:
+        FraudResponse.objects.bulk_create(responses.values())
+        # bulk_create doesn't set primary keys (on most databases)
+        for response in FraudResponse.objects.filter(t3m_id__in=t3m_ids):
+            if response.repeat_key in responses:
+                responses[response.repeat_key] = response
+    FraudCallback.objects.filter(pk__in=processed).delete()
+    return list(responses.values()), len(processed)
+
+
+def drain(batch_size=100, max_attempts=MAX_ATTEMPTS, retry_delay=RETRY_DELAY,
+          batch=False):
+    """
+    Process the callbacks which are due, in the order they were received,
+    returning the numbers processed and failed.
+
+    With ``batch``, each batch of callbacks is processed with
+    ``process_batch``.
+    """
+    num_processed = num_failed = 0
+    last_pk = 0
+    while True:
+        callbacks = list(FraudCallback.objects.filter(
+            failed=False, next_attempt__lte=timezone.now(),
+            pk__gt=last_pk).order_by('pk')[:batch_size])
+        if batch and callbacks:
+            counts = process_batch(callbacks, max_attempts, retry_delay)
+            num_processed += counts[0]
+            num_failed += counts[1]
+            last_pk = callbacks[-1].pk
+        else:
+            for callback in callbacks:
+                response = process(callback, max_attempts, retry_delay)
+                if response is None:
+                    num_failed += 1
+                elif response is not SKIPPED:
+                    num_processed += 1
+                last_pk = callback.pk
+        if len(callbacks) < batch_size:
+            return num_processed, num_failed
+
+
+def retry_failed():
+    """
+    Queue the failed callbacks to be processed again, returning how many
+    there were
+    """
+    return FraudCallback.objects.filter(failed=True).update(
+        failed=False, attempts=0, next_attempt=timezone.now())
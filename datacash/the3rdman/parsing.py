@@ -0,0 +1,116 @@
+"""
+Parsing of The3rdMan callbacks.
+
+Datacash send the callback either as XML or as a query string (with the same
+content type), so ``parse_callback`` checks for XML syntax.  Both formats are
+read in a single pass which only keeps the fields a fraud response needs.
+
+Callbacks are small, so larger bodies are rejected before being parsed, as
+are XML documents with a DTD (which could declare entities that expand to
+an enormous document).
+"""
+from xml.parsers import expat
+
+import six
+
+try:
+    from urllib.parse import unquote_to_bytes
+except ImportError:
+    # Python 2
+    from urllib import unquote as unquote_to_bytes
+
+FIELDS = ('aggregator_identifier', 'merchant_identifier', 'merchant_order_ref',
+          't3m_id', 'score', 'recommendation', 'message_digest')
+
+_QUERY_NAMES = dict((name.encode('ascii'), name) for name in FIELDS)
+
+# A real callback is well under 1KB
+MAX_SIZE = 16 * 1024
+
+
+class InvalidCallback(ValueError):
+    pass
+
+
+def check_size(body, max_size=MAX_SIZE):
+    if len(body) > max_size:
+        raise InvalidCallback("Callback is too large (%d bytes)" % len(body))
+
+
+def parse_callback(body, max_size=MAX_SIZE):
+    """
+    Return a dict of the fraud response fields in a callback body, with
+    missing fields as empty strings
+    """
+    if isinstance(body, six.text_type):
+        body = body.encode('utf8')
+    check_size(body, max_size)
+    if b'<?xml' in body:
+        return parse_xml(body, max_size)
+    return parse_querystring(body, max_size)
+
+
+class _XmlCallbackParser(object):
+
+    def __init__(self):
+        self.fields = dict((name, u'') for name in FIELDS)
+        self.seen = set()
+        # The field whose text is being read
+        self.current = None
+        self.text = []
+
+    def start(self, name, attrs):
+        # Like getElementsByTagName, use the first element with each name
+        self.current = None
+        if name in self.fields and name not in self.seen:
+            self.current = name
+            self.seen.add(name)
+            del self.text[:]
+
+    def end(self, name):
+        if name == self.current:
+            self.fields[name] = u''.join(self.text)
+            self.current = None
+
+    def character_data(self, data):
+        if self.current is not None:
+            self.text.append(data)
+
+    def reject_doctype(self, *args):
+        raise InvalidCallback("Callbacks can't contain a DTD")
+
+    def parse(self, xml_str):
+        parser = expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = self.start
+        parser.EndElementHandler = self.end
+        parser.CharacterDataHandler = self.character_data
+        parser.StartDoctypeDeclHandler = self.reject_doctype
+        parser.EntityDeclHandler = self.reject_doctype
+        parser.ExternalEntityRefHandler = self.reject_doctype
+        parser.Parse(xml_str, True)
+        return self.fields
+
+
+def parse_xml(xml_str, max_size=MAX_SIZE):
+    check_size(xml_str, max_size)
+    return _XmlCallbackParser().parse(xml_str)
+
+
+def parse_querystring(query, max_size=MAX_SIZE):
+    if isinstance(query, six.text_type):
+        query = query.encode('utf8')
+    check_size(query, max_size)
+    fields = dict((name, u'') for name in FIELDS)
+    seen = set()
+    for pair in query.split(b'&'):
+        name, sep, value = pair.partition(b'=')
+        name = _QUERY_NAMES.get(name)
+        # Like parse_qs, use the first value for each name
+        if name is None or name in seen:
+            continue
+        seen.add(name)
+        if b'%' in value or b'+' in value:
+            value = unquote_to_bytes(value.replace(b'+', b' '))
+        fields[name] = value.decode('utf8')
+    return fields
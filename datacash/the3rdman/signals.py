@@ -1,3 +1,6 @@
 import django.dispatch
 
 response_received = django.dispatch.Signal(providing_args=["response"])
+
+# Sent instead of response_received when callbacks are processed in batches
+responses_received = django.dispatch.Signal(providing_args=["responses"])
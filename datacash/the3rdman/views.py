@@ -4,6 +4,7 @@ from django.views import generic
 from django import http
 
 from datacash import models
+from datacash.the3rdman import inbox
 
 logger = logging.getLogger('datacash.the3rdman')
 
@@ -13,20 +14,20 @@ class CallbackView(generic.View):
     Datacash will POST to this view when they have a fraud score
     for a transaction.  This view must respond with a simple string
     response within 1 second for it to be acknowledged.
+
+    With ``DATACASH_3RDMAN_ACK_FIRST`` enabled the body is only stored, and
+    the fraud response is created (and the signal raised) later by
+    ``./manage.py datacash_process_callbacks``.
     """
 
     def post(self, request, *args, **kwargs):
+        if inbox.ack_first_enabled():
+            return self.store(request)
         # Create a fraud response object.  Other processes should listen
         # to the post create signal in order to hook fraud processing into
         # this order pipeline.
         try:
-            # Datacash send both XML and query string with the same content
-            # type header :( so we have to check for XML syntax.
-            if b'<?xml' in request.body:
-                response = models.FraudResponse.create_from_xml(request.body)
-            else:
-                response = models.FraudResponse.create_from_querystring(
-                    request.body)
+            response = models.FraudResponse.create_from_body(request.body)
         except Exception:
             logger.error("Error raised handling response:\n%s", request.body,
                          exc_info=True)
@@ -35,3 +36,14 @@ class CallbackView(generic.View):
             logger.info("Successful response received with merchant ref %s",
                         response.merchant_order_ref)
             return http.HttpResponse(b"ok")
+
+    def store(self, request):
+        try:
+            callback = inbox.store(request.body)
+        except Exception:
+            logger.error("Error raised storing response:\n%s", request.body,
+                         exc_info=True)
+            return http.HttpResponseServerError("error")
+        else:
+            logger.info("Response stored as callback %s", callback.pk)
+            return http.HttpResponse(b"ok")
@@ -1,3 +1,12 @@
+import collections
+import re
+from xml.parsers import expat
+
+# Whitespace used to lay out a document, which isn't treated as text when
+# pretty-printing
+_LAYOUT_WHITESPACE = re.compile(r'\s*\n\s*')
+
+
 def create_element(doc, parent, tag, value=None, attributes=None):
     """
     Creates an XML element
@@ -10,3 +19,216 @@ def create_element(doc, parent, tag, value=None, attributes=None):
     if attributes:
         [ele.setAttribute(k, str(v)) for k, v in attributes.items()]
     return ele
+
+
+def escape(data):
+    """
+    Escape text or an attribute value in the same way as minidom
+    """
+    if u'&' in data:
+        data = data.replace(u'&', u'&amp;')
+    if u'<' in data:
+        data = data.replace(u'<', u'&lt;')
+    if u'"' in data:
+        data = data.replace(u'"', u'&quot;')
+    if u'>' in data:
+        data = data.replace(u'>', u'&gt;')
+    return data
+
+
+def format_attributes(attributes):
+    if not attributes:
+        return u''
+    return u''.join(u' %s="%s"' % (k, escape(str(v)))
+                    for k, v in attributes.items())
+
+
+class XmlWriter(object):
+    """
+    Serialise XML straight to a string without building a DOM.
+
+    The output is identical to building the same document with
+    ``create_element`` and calling ``toxml()``: elements without content are
+    written as ``<tag/>`` and values are only written if they are truthy.
+    """
+    declaration = u'<?xml version="1.0" ?>'
+
+    def __init__(self, declaration=True):
+        self._parts = [self.declaration] if declaration else []
+        # Whether the last start tag is still open (ie missing its '>')
+        self._open = False
+
+    def _close_start_tag(self):
+        if self._open:
+            self._parts.append(u'>')
+            self._open = False
+
+    def start(self, tag, attributes=None):
+        self._close_start_tag()
+        self._parts.append(u'<' + tag + format_attributes(attributes))
+        self._open = True
+
+    def end(self, tag):
+        if self._open:
+            self._parts.append(u'/>')
+            self._open = False
+        else:
+            self._parts.append(u'</' + tag + u'>')
+
+    def element(self, tag, value=None, attributes=None):
+        self._close_start_tag()
+        if value:
+            self._parts.append(u'<%s%s>%s</%s>' % (
+                tag, format_attributes(attributes), escape(u"%s" % value),
+                tag))
+        else:
+            self._parts.append(u'<%s%s/>' % (
+                tag, format_attributes(attributes)))
+
+    def raw(self, fragment):
+        """
+        Append an already serialised fragment
+        """
+        self._close_start_tag()
+        self._parts.append(fragment)
+
+    def getvalue(self):
+        return u''.join(self._parts)
+
+
+class DomWriter(object):
+    """
+    Adapter giving a minidom document the same interface as ``XmlWriter``
+    """
+
+    def __init__(self, doc, element=None):
+        self.doc = doc
+        self._stack = [doc if element is None else element]
+
+    def start(self, tag, attributes=None):
+        self._stack.append(
+            create_element(self.doc, self._stack[-1], tag, None, attributes))
+
+    def end(self, tag):
+        self._stack.pop()
+
+    def element(self, tag, value=None, attributes=None):
+        create_element(self.doc, self._stack[-1], tag, value, attributes)
+
+
+def extract_text_fields(xml_str):
+    """
+    Return an ordered dict mapping element paths to their text for every
+    element in the document that has no child elements.
+
+    Paths exclude the root element and use dots as separators, eg
+    ``CardTxn.authcode``.  The document is parsed in a single streaming pass
+    without building a DOM.
+    """
+    fields = collections.OrderedDict()
+    stack = []
+    text = []
+    # Whether the current element has child elements
+    has_children = [False]
+
+    def start(name, attrs):
+        if stack:
+            has_children[-1] = True
+        stack.append(name)
+        has_children.append(False)
+        del text[:]
+
+    def end(name):
+        if not has_children.pop() and len(stack) > 1:
+            path = '.'.join(stack[1:])
+            if path not in fields:
+                fields[path] = u''.join(text) or None
+        stack.pop()
+        del text[:]
+
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    parser.CharacterDataHandler = text.append
+    parser.Parse(xml_str, True)
+    return fields
+
+
+class _PrettyPrinter(object):
+
+    def __init__(self, indent):
+        self.indent = indent
+        self.out = [u'<?xml version="1.0" ?>\n']
+        self.text = []
+        self.depth = 0
+        # Whether the last start tag is still missing its '>'
+        self.open = False
+
+    def take_text(self):
+        data = u''.join(self.text)
+        del self.text[:]
+        if u'\n' in data:
+            data = _LAYOUT_WHITESPACE.sub(u'', data)
+        return data
+
+    def start_node(self):
+        # Called before writing a child node of the current element
+        if self.open:
+            self.out.append(u'>\n')
+            self.open = False
+        if self.text:
+            data = self.take_text()
+            if data:
+                self.out.append(self.indent * self.depth + escape(data) +
+                                u'\n')
+
+    def start(self, name, attrs):
+        self.start_node()
+        if attrs:
+            name += u''.join(
+                u' %s="%s"' % (attrs[i], escape(attrs[i + 1]))
+                for i in range(0, len(attrs), 2))
+        self.out.append(self.indent * self.depth + u'<' + name)
+        self.open = True
+        self.depth += 1
+
+    def end(self, name):
+        if self.open:
+            self.open = False
+            self.depth -= 1
+            data = self.take_text() if self.text else None
+            if data:
+                self.out.append(u'>%s</%s>\n' % (escape(data), name))
+            else:
+                self.out.append(u'/>\n')
+        else:
+            # Write any text following the last child
+            self.start_node()
+            self.depth -= 1
+            self.out.append(u'%s</%s>\n' % (self.indent * self.depth, name))
+
+    def comment(self, data):
+        self.start_node()
+        self.out.append(u'%s<!--%s-->\n' % (self.indent * self.depth, data))
+
+
+def pretty_print(xml_str, indent=u'    '):
+    """
+    Return ``xml_str`` indented with one element per line.
+
+    The output is the same as minidom's ``toprettyxml`` once elements that
+    only contain text are put on a single line, but the document is streamed
+    through expat rather than built into a DOM.  Raises ``ExpatError`` if the
+    document isn't well-formed.
+    """
+    printer = _PrettyPrinter(indent)
+    # The document is always parsed as UTF-8, whatever it declares
+    parser = expat.ParserCreate('utf-8')
+    parser.ordered_attributes = True
+    parser.buffer_text = True
+    parser.StartElementHandler = printer.start
+    parser.EndElementHandler = printer.end
+    parser.CharacterDataHandler = printer.text.append
+    parser.CommentHandler = printer.comment
+    parser.Parse(xml_str.encode('utf8'), True)
+    return u''.join(printer.out)
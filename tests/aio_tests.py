@@ -0,0 +1,383 @@
+from decimal import Decimal as D
+from unittest import skipIf
+
+from mock import Mock, patch
+
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+from django.test.utils import override_settings
+from oscar.apps.payment.utils import Bankcard
+
+from datacash.models import FraudCallback, FraudResponse, OrderTransaction
+from datacash.the3rdman import parsing, signals
+
+from . import XmlTestingMixin, fixtures
+from .the3rdman_callback_tests import HOLD_RESPONSE
+
+try:
+    import asyncio
+    from datacash.aio import client
+    from datacash.aio.gateway import AsyncGateway
+    from datacash.aio.facade import AsyncFacade
+    from datacash.aio import callback
+    from . import async_receivers
+except (ImportError, SyntaxError):
+    # Python < 3.5
+    asyncio = None
+
+
+def completed(value):
+    future = asyncio.Future()
+    future.set_result(value)
+    return future
+
+
+def run_sync_inline(fn, *args, **kwargs):
+    # The test database isn't visible from worker threads
+    return completed(fn(*args, **kwargs))
+
+
+class StubServerProtocol(object):
+    """
+    asyncio protocol which answers each request with a canned response, or
+    closes the connection for a response of ``None``
+    """
+    responses = []
+    connections = 0
+    close_after_writing = False
+
+    def connection_made(self, transport):
+        StubServerProtocol.connections += 1
+        self.transport = transport
+        self.buffer = b''
+
+    def data_received(self, data):
+        self.buffer += data
+        head, sep, body = self.buffer.partition(b'\r\n\r\n')
+        if not sep:
+            return
+        length = 0
+        for line in head.split(b'\r\n'):
+            if line.lower().startswith(b'content-length:'):
+                length = int(line.split(b':')[1])
+        if len(body) < length:
+            return
+        self.buffer = body[length:]
+        response = self.responses.pop(0)
+        if response is None:
+            self.transport.close()
+        else:
+            self.transport.write(response)
+            if self.close_after_writing:
+                self.transport.close()
+
+    def connection_lost(self, exc):
+        pass
+
+    def eof_received(self):
+        pass
+
+    def pause_writing(self):
+        pass
+
+    def resume_writing(self):
+        pass
+
+
+@skipIf(asyncio is None, "Requires Python 3.5+")
+class AsyncClientTests(TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        StubServerProtocol.connections = 0
+        StubServerProtocol.close_after_writing = False
+        self.server = self.loop.run_until_complete(self.loop.create_server(
+            StubServerProtocol, '127.0.0.1', 0))
+        port = self.server.sockets[0].getsockname()[1]
+        self.pool = client.AsyncConnectionPool(
+            '127.0.0.1', port, secure=False, timeout=5)
+
+    def tearDown(self):
+        self.pool.clear()
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def request(self):
+        return self.loop.run_until_complete(self.pool.request(
+            'POST', '/Transaction', b'<Request/>', {}))
+
+    def test_reads_content_length_response(self):
+        StubServerProtocol.responses = [
+            b'HTTP/1.1 200 OK\r\nContent-Length: 11\r\n\r\n<Response/>']
+        self.assertEqual((200, b'<Response/>'), self.request())
+
+    def test_reads_chunked_response(self):
+        StubServerProtocol.responses = [
+            b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+            b'5\r\n<Resp\r\n6\r\nonse/>\r\n0\r\n\r\n']
+        self.assertEqual((200, b'<Response/>'), self.request())
+
+    def test_connection_is_kept_alive(self):
+        StubServerProtocol.responses = [
+            b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok'] * 3
+        for i in range(3):
+            self.request()
+        self.assertEqual(1, StubServerProtocol.connections)
+        self.assertEqual(2, self.pool.hits)
+
+    def test_request_is_retried_when_no_response_is_received(self):
+        ok = b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok'
+        StubServerProtocol.responses = [ok, None, ok]
+        self.request()
+        self.assertEqual((200, b'ok'), self.request())
+        self.assertEqual(2, StubServerProtocol.connections)
+        self.assertEqual(1, self.pool.retries)
+
+    def test_request_isnt_retried_after_part_of_the_response(self):
+        StubServerProtocol.responses = [
+            b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok',
+            b'HTTP/1.1 200 OK\r\nContent-Length: 11\r\n\r\n<Resp']
+        self.request()
+        StubServerProtocol.close_after_writing = True
+        with self.assertRaises(asyncio.IncompleteReadError):
+            self.request()
+        self.assertEqual(1, StubServerProtocol.connections)
+        self.assertEqual(0, self.pool.retries)
+
+    def test_connections_with_unread_data_arent_reused(self):
+        StubServerProtocol.responses = [
+            b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nokjunk',
+            b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok']
+        self.request()
+        self.assertEqual((200, b'ok'), self.request())
+        self.assertEqual(2, StubServerProtocol.connections)
+        self.assertEqual(0, self.pool.hits)
+        self.assertEqual(1, self.pool.discarded)
+
+
+@skipIf(asyncio is None, "Requires Python 3.5+")
+class AsyncGatewayTests(TestCase, XmlTestingMixin):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.gateway = AsyncGateway('example.com', '/Transaction',
+                                    'dummyclient', 'dummypassword')
+        self.gateway._fetch_response_xml = Mock(
+            return_value=completed(fixtures.SAMPLE_RESPONSE))
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_auth_returns_response(self):
+        response = self.loop.run_until_complete(self.gateway.auth(
+            amount=D('10.00'), currency='GBP', card_number='1000350000000007',
+            expiry_date='10/12', merchant_reference='TEST_132473839018'))
+        self.assertTrue(response.is_successful())
+        self.assertXmlElementEquals(response.request_xml, 'auth',
+                                    'Request.Transaction.CardTxn.method')
+
+    def test_kwargs_are_validated(self):
+        with self.assertRaises(ValueError):
+            self.loop.run_until_complete(self.gateway.auth(
+                amount=D('10.00'), currency='GBP'))
+
+    def test_cancel(self):
+        response = self.loop.run_until_complete(
+            self.gateway.cancel('4500203021916406'))
+        self.assertXmlElementEquals(response.request_xml, '4500203021916406',
+                                    'Request.Transaction.HistoricTxn.reference')
+
+    def fulfill(self, **kwargs):
+        kwargs.update(amount=D('10.00'), currency='GBP',
+                      txn_reference='4500203021916406', auth_code='123456')
+        return ('fulfill', kwargs)
+
+    def test_submit_many_sends_requests(self):
+        requests = [self.fulfill() for i in range(5)]
+        requests.insert(2, ('fulfill', {'amount': D('10.00')}))
+        results = self.loop.run_until_complete(
+            self.gateway.submit_many(requests))
+        self.assertEqual(list(range(6)), [r.index for r in results])
+        self.assertIsInstance(results[2].error, ValueError)
+        self.assertTrue(all(r.is_successful() for r in results
+                            if r.index != 2))
+        self.assertEqual(5, self.gateway._fetch_response_xml.call_count)
+
+    def test_submit_many_limits_requests_in_flight(self):
+        in_flight = []
+        peak = []
+
+        def fetch(request_xml):
+            in_flight.append(request_xml)
+            peak.append(len(in_flight))
+            future = asyncio.Future()
+
+            def respond():
+                in_flight.pop()
+                future.set_result(fixtures.SAMPLE_RESPONSE)
+            self.loop.call_later(0.01, respond)
+            return future
+
+        self.gateway._fetch_response_xml = fetch
+        results = self.loop.run_until_complete(self.gateway.submit_many(
+            [self.fulfill() for i in range(10)], max_workers=3,
+            ordered=False))
+        self.assertEqual(10, len(results))
+        self.assertEqual(3, max(peak))
+
+    def test_submit_many_reports_failures(self):
+        future = asyncio.Future()
+        future.set_exception(IOError("Connection reset"))
+        self.gateway._fetch_response_xml = Mock(side_effect=[
+            completed(fixtures.SAMPLE_RESPONSE), future])
+        results = self.loop.run_until_complete(self.gateway.submit_many(
+            [self.fulfill(), self.fulfill()], max_workers=1))
+        self.assertIsNone(results[0].error)
+        self.assertIsInstance(results[1].error, IOError)
+
+    def test_no_blocking_pool_is_created(self):
+        with patch('datacash.gateway.connection.get_pool') as get_pool:
+            gateway = AsyncGateway('example.com', '/Transaction',
+                                   'dummyclient', 'dummypassword',
+                                   max_connections=5)
+        self.assertFalse(get_pool.called)
+        self.assertEqual(5, gateway._async_pool_kwargs['max_connections'])
+
+
+@skipIf(asyncio is None, "Requires Python 3.5+")
+class AsyncFacadeTests(TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.facade = AsyncFacade()
+        self.facade.gateway._fetch_response_xml = Mock(
+            return_value=completed(fixtures.SAMPLE_RESPONSE))
+        self.patcher = patch('datacash.aio.facade.run_sync', run_sync_inline)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_authorise_creates_txn_model(self):
+        card = Bankcard('1000350000000007', '10/13', cvv='345')
+        ref = self.loop.run_until_complete(
+            self.facade.authorise('100001', D('123.22'), card))
+        self.assertEqual('3000000088888888', ref)
+        txn = OrderTransaction.objects.get(order_number='100001')
+        self.assertEqual('auth', txn.method)
+
+
+@skipIf(asyncio is None, "Requires Python 3.5+")
+class CallbackApplicationTests(TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.patcher = patch('datacash.aio.callback.run_sync',
+                             run_sync_inline)
+        self.patcher.start()
+        self.received = []
+        signals.response_received.connect(self.receiver)
+
+    def tearDown(self):
+        signals.response_received.disconnect(self.receiver)
+        self.patcher.stop()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def receiver(self, sender, response, **kwargs):
+        self.received.append(('sync', response.t3m_id))
+
+    def request(self, body, method='POST', path=None, chunk_size=None,
+                application=None, root_path=''):
+        scope = {'type': 'http', 'method': method, 'root_path': root_path,
+                 'path': path or reverse('datacash-3rdman-callback')}
+        chunk_size = chunk_size or len(body) or 1
+        messages = [
+            {'type': 'http.request', 'body': body[i:i + chunk_size],
+             'more_body': i + chunk_size < len(body)}
+            for i in range(0, len(body) or 1, chunk_size)]
+        sent = []
+
+        def receive():
+            return completed(messages.pop(0))
+
+        def send(message):
+            sent.append(message)
+            return completed(None)
+
+        self.loop.run_until_complete(
+            callback.CallbackApplication(application)(scope, receive, send))
+        return sent[0]['status'], sent[1]['body']
+
+    def test_creates_fraud_response(self):
+        self.assertEqual((200, b"ok"), self.request(HOLD_RESPONSE,
+                                                    chunk_size=100))
+        self.assertEqual(1, FraudResponse.objects.count())
+        self.assertEqual([('sync', '1815120370')], self.received)
+
+    def test_awaits_coroutine_receivers(self):
+        async_receiver = async_receivers.recording_receiver(self.received)
+        signals.response_received.connect(async_receiver)
+        try:
+            self.request(HOLD_RESPONSE)
+        finally:
+            signals.response_received.disconnect(async_receiver)
+        self.assertEqual([('sync', '1815120370'), ('async', '1815120370')],
+                         self.received)
+
+    def test_receiver_errors_are_not_raised(self):
+        failing_receiver = async_receivers.failing_receiver
+        signals.response_received.connect(failing_receiver)
+        try:
+            self.assertEqual((200, b"ok"), self.request(HOLD_RESPONSE))
+        finally:
+            signals.response_received.disconnect(failing_receiver)
+
+    def test_repeats_dont_raise_the_signal_again(self):
+        self.request(HOLD_RESPONSE)
+        self.request(HOLD_RESPONSE)
+        self.assertEqual(1, FraudResponse.objects.count())
+        self.assertEqual(1, len(self.received))
+
+    def test_invalid_bodies_are_rejected(self):
+        self.assertEqual((500, b"error"), self.request(b'<?xml <'))
+        self.assertEqual((500, b"error"), self.request(
+            b'x' * (parsing.MAX_SIZE + 1), chunk_size=1024))
+        self.assertEqual(0, FraudResponse.objects.count())
+
+    @override_settings(DATACASH_3RDMAN_ACK_FIRST=True)
+    def test_ack_first_stores_the_body(self):
+        self.assertEqual((200, b"ok"), self.request(HOLD_RESPONSE))
+        self.assertEqual(1, FraudCallback.objects.count())
+        self.assertEqual([], self.received)
+
+    def test_only_accepts_posts(self):
+        self.assertEqual(405, self.request(b'', method='GET')[0])
+
+    def test_handles_callbacks_when_mounted_below_the_root(self):
+        path = '/shop' + reverse('datacash-3rdman-callback')
+        self.assertEqual((200, b"ok"), self.request(
+            HOLD_RESPONSE, path=path, root_path='/shop'))
+        self.assertEqual(1, FraudResponse.objects.count())
+
+    def test_passes_other_requests_on(self):
+        scopes = []
+
+        def application(scope, receive, send):
+            scopes.append(scope)
+            return asyncio.gather(
+                send({'type': 'http.response.start', 'status': 204}),
+                send({'type': 'http.response.body', 'body': b''}))
+
+        self.assertEqual((204, b''), self.request(
+            b'', path='/other/', application=application))
+        self.assertEqual(['/other/'], [scope['path'] for scope in scopes])
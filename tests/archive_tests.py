@@ -0,0 +1,240 @@
+import datetime
+import os
+import re
+import shutil
+import tempfile
+from decimal import Decimal as D
+
+import mock
+import six
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from datacash import archive
+from datacash.models import OrderTransaction, FraudResponse
+
+from . import fixtures
+
+NOW = datetime.datetime.now()
+
+
+def archive_files(directory):
+    # The file names without the time of the run which wrote them
+    return sorted(re.sub(r'-\d{8}T\d{12}-', '-', name)
+                  for name in os.listdir(directory))
+
+
+def create_txn(order_number, days_old, **kwargs):
+    txn = OrderTransaction.objects.create(
+        order_number=order_number, method='auth', amount=D('10.00'),
+        status=1, reason='ACCEPTED', request_xml=fixtures.SAMPLE_REQUEST,
+        response_xml=fixtures.SAMPLE_RESPONSE, **kwargs)
+    date_created = NOW - datetime.timedelta(days=days_old)
+    OrderTransaction.objects.filter(pk=txn.pk).update(
+        date_created=date_created)
+    return txn
+
+
+def create_fraud_response(order_number, days_old):
+    response = FraudResponse.objects.create(
+        merchant_identifier='1', merchant_order_ref='%s_AUTH' % order_number,
+        t3m_id='123', score=0, recommendation=0,
+        raw_response='<Response>...</Response>')
+    FraudResponse.objects.filter(pk=response.pk).update(
+        date_created=NOW - datetime.timedelta(days=days_old))
+    return response
+
+
+class ArchiveTests(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.old = [create_txn('1000', 400), create_txn('1000', 399),
+                    create_txn('1001', 398)]
+        self.new = create_txn('1002', 10)
+        self.fraud = create_fraud_response('1000', 400)
+
+    def archive(self, **kwargs):
+        kwargs.setdefault('batch_size', 2)
+        return archive.archive(self.dir, 365, **kwargs)
+
+    def test_archives_and_deletes_old_rows_in_batches(self):
+        counts = self.archive()
+        self.assertEqual(3, counts[OrderTransaction])
+        self.assertEqual(1, counts[FraudResponse])
+        self.assertEqual([self.new.pk], list(
+            OrderTransaction.objects.values_list('pk', flat=True)))
+        self.assertEqual(0, FraudResponse.objects.count())
+        self.assertEqual(
+            ['fraudresponse-%010d-%010d.jsonl.gz' % (self.fraud.pk,
+                                                    self.fraud.pk),
+             'ordertransaction-%010d-%010d.jsonl.gz' % (self.old[0].pk,
+                                                       self.old[1].pk),
+             'ordertransaction-%010d-%010d.jsonl.gz' % (self.old[2].pk,
+                                                       self.old[2].pk)],
+            archive_files(self.dir))
+
+    def test_blank_mode_keeps_rows(self):
+        self.archive(mode=archive.BLANK)
+        self.assertEqual(4, OrderTransaction.objects.count())
+        txn = OrderTransaction.objects.get(pk=self.old[0].pk)
+        self.assertEqual('', txn.request_xml)
+        self.assertEqual('', txn.response_xml)
+        self.assertEqual(fixtures.SAMPLE_RESPONSE, OrderTransaction.objects.get(
+            pk=self.new.pk).response_xml)
+        # Blanked rows aren't archived again
+        self.assertEqual(0, self.archive(mode=archive.BLANK)[OrderTransaction])
+
+    def test_interrupted_runs_can_be_resumed(self):
+        original_write = archive.Archiver.write
+        calls = []
+
+        def write(archiver, rows, filename):
+            calls.append(filename)
+            if len(calls) > 1:
+                raise IOError("Disk full")
+            original_write(archiver, rows, filename)
+
+        with mock.patch.object(archive.Archiver, 'write', write):
+            with self.assertRaises(IOError):
+                self.archive()
+        self.assertEqual(2, OrderTransaction.objects.count())
+        self.assertFalse(any(name.endswith('.tmp')
+                             for name in os.listdir(self.dir)))
+
+        self.archive()
+        self.assertEqual(1, OrderTransaction.objects.count())
+        restored = archive.restore(self.dir, '1001')
+        self.assertEqual(1, restored[OrderTransaction])
+
+    def test_restore_recreates_deleted_rows(self):
+        self.archive()
+        counts = archive.restore(self.dir, '1000')
+        self.assertEqual(2, counts[OrderTransaction])
+        self.assertEqual(1, counts[FraudResponse])
+
+        txn = OrderTransaction.objects.get(pk=self.old[0].pk)
+        self.assertEqual('1000', txn.order_number)
+        self.assertEqual(D('10.00'), txn.amount)
+        self.assertEqual(fixtures.SAMPLE_RESPONSE, txn.response_xml)
+        self.assertTrue('XXXXXXXXXXXX0004' in txn.request_xml)
+        self.assertEqual(NOW - datetime.timedelta(days=400),
+                         txn.date_created)
+        self.assertEqual(self.fraud.pk, FraudResponse.objects.get().pk)
+        self.assertFalse(OrderTransaction.objects.filter(
+            order_number='1001').exists())
+
+    def test_existing_files_arent_replaced(self):
+        path = os.path.join(self.dir, 'ordertransaction-0000000001-'
+                            '0000000001.jsonl.gz')
+        for contents in (b'first', b'second'):
+            with open(path + '.tmp', 'wb') as f:
+                f.write(contents)
+            moved_to = archive._move_to_unused_path(path + '.tmp', path)
+        self.assertEqual(path.replace('.jsonl.gz', '-1.jsonl.gz'), moved_to)
+        with open(path, 'rb') as f:
+            self.assertEqual(b'first', f.read())
+        self.assertFalse(os.path.exists(path + '.tmp'))
+
+    def test_latest_archive_is_restored(self):
+        # All three rows are archived in one file, then two of them in a
+        # file whose name sorts first
+        self.archive(batch_size=3)
+        archive.restore(self.dir, '1000')
+        # As if they were restored a long time ago
+        OrderTransaction.objects.update(date_restored=None)
+        OrderTransaction.objects.filter(pk=self.old[0].pk).update(
+            reason='DECLINED')
+        self.archive(batch_size=3)
+        self.assertEqual(
+            ['ordertransaction-%010d-%010d.jsonl.gz' % (self.old[0].pk,
+                                                       self.old[1].pk),
+             'ordertransaction-%010d-%010d.jsonl.gz' % (self.old[0].pk,
+                                                       self.old[2].pk)],
+            [name for name in archive_files(self.dir)
+             if name.startswith('ordertransaction')])
+        archive.restore(self.dir, '1000')
+        self.assertEqual('DECLINED', OrderTransaction.objects.get(
+            pk=self.old[0].pk).reason)
+
+    def test_files_from_before_runs_were_named_sort_first(self):
+        self.assertEqual(
+            ['ordertransaction-0000000300-0000000800.jsonl.gz',
+             'ordertransaction-0000000300-0000000800-1.jsonl.gz',
+             'ordertransaction-20140101T000000000000-0000000300-'
+             '0000000300.jsonl.gz'],
+            sorted(['ordertransaction-20140101T000000000000-0000000300-'
+                    '0000000300.jsonl.gz',
+                    'ordertransaction-0000000300-0000000800-1.jsonl.gz',
+                    'ordertransaction-0000000300-0000000800.jsonl.gz'],
+                   key=archive._archive_order))
+
+    def test_restored_rows_arent_archived_again(self):
+        self.archive()
+        archive.restore(self.dir, '1000')
+        txn = OrderTransaction.objects.get(pk=self.old[0].pk)
+        self.assertIsNotNone(txn.date_restored)
+        self.assertEqual(0, self.archive()[OrderTransaction])
+        self.assertEqual(3, OrderTransaction.objects.count())
+
+        # ...until they've been restored for as long as the cut-off
+        OrderTransaction.objects.update(
+            date_restored=NOW - datetime.timedelta(days=366))
+        self.assertEqual(2, self.archive()[OrderTransaction])
+
+    def test_restored_payloads_arent_blanked_again(self):
+        self.archive(mode=archive.BLANK)
+        archive.restore(self.dir, '1000')
+        self.assertEqual(0, self.archive(mode=archive.BLANK)[OrderTransaction])
+        txn = OrderTransaction.objects.get(pk=self.old[1].pk)
+        self.assertEqual(fixtures.SAMPLE_RESPONSE, txn.response_xml)
+
+    def test_restore_fills_blanked_payloads(self):
+        self.archive(mode=archive.BLANK)
+        archive.restore(self.dir, '1000')
+        txn = OrderTransaction.objects.get(pk=self.old[1].pk)
+        self.assertEqual(fixtures.SAMPLE_RESPONSE, txn.response_xml)
+
+    @override_settings(DATACASH_COMPRESS_XML=True)
+    def test_compressed_xml_is_archived_as_text(self):
+        OrderTransaction.objects.filter(pk=self.old[0].pk).update(
+            response_xml=fixtures.SAMPLE_RESPONSE)
+        self.archive()
+        record = next(archive.read_archive(self.dir, OrderTransaction))
+        self.assertEqual(fixtures.SAMPLE_RESPONSE, record['response_xml'])
+
+
+class ArchiveCommandTests(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        create_txn('1000', 40)
+
+    def call(self, *args, **kwargs):
+        out = six.StringIO()
+        call_command('datacash_archive', *args, stdout=out, pause=0,
+                     **kwargs)
+        return out.getvalue()
+
+    def test_archive_and_restore(self):
+        with self.settings(DATACASH_ARCHIVE_DIR=self.dir):
+            self.assertTrue(self.call(days=30).startswith(
+                'Archived 1 transactions and 0 fraud responses'))
+            self.assertEqual(0, OrderTransaction.objects.count())
+            self.assertTrue(self.call(restore='1000').startswith(
+                'Restored 1 transactions'))
+        self.assertEqual(1, OrderTransaction.objects.count())
+
+    def test_default_age(self):
+        self.call(dir=self.dir)
+        self.assertEqual(1, OrderTransaction.objects.count())
+
+    def test_requires_a_directory(self):
+        with self.assertRaises(CommandError):
+            self.call()
+        with self.assertRaises(CommandError):
+            self.call(dir=os.path.join(self.dir, 'missing'))
@@ -0,0 +1,16 @@
+"""
+Coroutine signal receivers for the asyncio tests (kept apart as the syntax
+needs Python 3.5+)
+"""
+import asyncio
+
+
+def recording_receiver(received):
+    async def receiver(sender, response, **kwargs):
+        await asyncio.sleep(0)
+        received.append(('async', response.t3m_id))
+    return receiver
+
+
+async def failing_receiver(sender, response, **kwargs):
+    raise ValueError
@@ -0,0 +1,167 @@
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+from decimal import Decimal as D
+
+import mock
+from django.test import TestCase
+from django.test.utils import override_settings
+from oscar.apps.payment.utils import Bankcard
+
+from datacash import audit
+from datacash.facade import Facade
+from datacash.models import OrderTransaction
+
+from . import fixtures
+
+
+def create_txn(order_number='100001', request_xml=''):
+    return OrderTransaction(order_number=order_number, method='auth',
+                            amount=D('10.00'), status=1, reason='ACCEPTED',
+                            request_xml=request_xml, response_xml='')
+
+
+class AuditWriterTests(TestCase):
+
+    def setUp(self):
+        self.writer = audit.AuditWriter(maxsize=10, batch_size=4,
+                                        autostart=False)
+
+    def test_queues_transactions(self):
+        self.writer.write(create_txn())
+        self.assertEqual(0, OrderTransaction.objects.count())
+        self.assertEqual(1, self.writer.stats()['queued'])
+
+    def test_flush_saves_in_batches(self):
+        for i in range(10):
+            self.writer.write(create_txn(str(i)))
+        with self.assertNumQueries(3):
+            self.writer.flush()
+        self.assertEqual(10, OrderTransaction.objects.count())
+        self.assertEqual(3, self.writer.stats()['batches'])
+
+    def test_redacts_before_queueing(self):
+        txn = create_txn(request_xml=fixtures.SAMPLE_REQUEST)
+        self.writer.write(txn)
+        self.assertTrue('<password>XXX</password>' in txn.request_xml)
+        self.assertTrue('<pan>XXXXXXXXXXXX0004</pan>' in txn.request_xml)
+
+    def test_saves_synchronously_when_queue_is_full(self):
+        for i in range(11):
+            self.writer.write(create_txn(str(i)))
+        self.assertEqual(1, OrderTransaction.objects.count())
+        self.assertEqual(1, self.writer.stats()['sync_writes'])
+
+    def test_close_saves_queued_transactions(self):
+        self.writer.write(create_txn())
+        self.writer.close()
+        self.assertEqual(1, OrderTransaction.objects.count())
+
+        # Later writes are saved immediately
+        self.writer.write(create_txn())
+        self.assertEqual(2, OrderTransaction.objects.count())
+
+    def test_close_waits_for_a_write_in_progress(self):
+        saved = []
+        self.writer._save_batch = saved.extend
+        closer = threading.Thread(target=self.writer.close)
+        put_nowait = self.writer.queue.put_nowait
+
+        def put_while_closing(instance):
+            closer.start()
+            closer.join(0.1)
+            put_nowait(instance)
+
+        txn = create_txn()
+        with mock.patch.object(self.writer.queue, 'put_nowait',
+                               put_while_closing):
+            self.writer.write(txn)
+        closer.join()
+        self.assertEqual([txn], saved)
+
+    def test_saves_individually_if_batch_fails(self):
+        for i in range(3):
+            self.writer.write(create_txn(str(i)))
+        with mock.patch.object(OrderTransaction.objects, 'bulk_create',
+                               side_effect=Exception):
+            self.writer.flush()
+        self.assertEqual(3, OrderTransaction.objects.count())
+
+
+@override_settings(DATACASH_AUDIT_ASYNC=True)
+class FacadeTests(TestCase):
+
+    def test_record_txn_uses_audit_writer(self):
+        writer = audit.AuditWriter(autostart=False)
+        facade = Facade()
+        facade.gateway._fetch_response_xml = mock.Mock(
+            return_value=fixtures.SAMPLE_RESPONSE)
+        card = Bankcard('1000350000000007', '10/13', cvv='345')
+        with mock.patch.object(audit, 'get_writer', return_value=writer):
+            facade.authorise('100001', D('123.22'), card)
+        self.assertEqual(0, OrderTransaction.objects.count())
+
+        writer.flush()
+        txn = OrderTransaction.objects.get(order_number='100001')
+        self.assertTrue('<cv2>XXX</cv2>' in txn.request_xml)
+
+
+EXIT_SCRIPT = """
+import sys
+import django
+from django.conf import settings
+settings.configure(
+    DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3',
+                           'NAME': sys.argv[1]}},
+    INSTALLED_APPS=['datacash'], DATACASH_CURRENCY='GBP',
+    DATACASH_AUDIT_FLUSH_INTERVAL=60)
+if hasattr(django, 'setup'):
+    django.setup()
+
+from django.core.management.color import no_style
+from django.db import connection
+from datacash import audit
+from datacash.models import OrderTransaction
+
+cursor = connection.cursor()
+for sql in connection.creation.sql_create_model(OrderTransaction,
+                                                no_style())[0]:
+    cursor.execute(sql)
+connection.close()
+
+writer = audit.get_writer()
+for i in range(int(sys.argv[2])):
+    writer.write(OrderTransaction(order_number=str(i), method='auth',
+                                  status=1, reason='', request_xml='',
+                                  response_xml=''))
+"""
+
+
+class ProcessExitTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_nothing_is_lost_on_normal_exit(self):
+        db_path = os.path.join(self.directory, 'audit.db')
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        env.pop('DJANGO_SETTINGS_MODULE', None)
+        subprocess.check_call(
+            [sys.executable, '-c', EXIT_SCRIPT, db_path, '2500'],
+            cwd=root, env=env)
+
+        db = sqlite3.connect(db_path)
+        try:
+            count = db.execute(
+                'SELECT COUNT(*) FROM datacash_ordertransaction').fetchone()[0]
+        finally:
+            db.close()
+        self.assertEqual(2500, count)
@@ -0,0 +1,253 @@
+import errno
+import re
+import socket
+import struct
+import threading
+
+from mock import Mock, patch
+from six.moves import http_client
+
+from django.test import TestCase
+from oscar.apps.payment.exceptions import GatewayError
+
+from datacash import connection
+from datacash.connection import STALE_CONNECTION_ERRORS
+from datacash.gateway import Gateway
+
+
+def stub_connection(status=200, body=b'<Response/>', will_close=False,
+                    request_side_effect=None, send_side_effect=None,
+                    response_side_effect=None):
+    conn = Mock()
+    conn.sock = Mock()
+    conn.endheaders = Mock(side_effect=request_side_effect)
+    conn.send = Mock(side_effect=send_side_effect)
+    response = Mock()
+    response.status = status
+    response.will_close = will_close
+    response.read = Mock(return_value=body)
+    conn.getresponse = Mock(return_value=response,
+                            side_effect=response_side_effect)
+    return conn
+
+
+def http_response(body):
+    return (b'HTTP/1.1 200 OK\r\nContent-Length: ' +
+            str(len(body)).encode('ascii') + b'\r\n\r\n' + body)
+
+
+class ResettingServer(threading.Thread):
+    """
+    Answers the first request on a connection, then reads the second and
+    resets the connection without responding
+    """
+
+    def __init__(self):
+        super(ResettingServer, self).__init__()
+        self.daemon = True
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(5)
+        self.port = self.listener.getsockname()[1]
+        self.requests = []
+
+    def read_request(self, sock):
+        data = b''
+        while b'\r\n\r\n' not in data:
+            data += sock.recv(4096)
+        head, body = data.split(b'\r\n\r\n', 1)
+        length = int(re.search(br'Content-Length: (\d+)', head).group(1))
+        while len(body) < length:
+            body += sock.recv(4096)
+        self.requests.append(body)
+
+    def run(self):
+        while True:
+            try:
+                sock = self.listener.accept()[0]
+            except socket.error:
+                return
+            self.read_request(sock)
+            sock.sendall(http_response(b'<Response/>'))
+            self.read_request(sock)
+            # Close with a RST rather than a FIN
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                            struct.pack('ii', 1, 0))
+            sock.close()
+
+
+class ConnectionPoolTests(TestCase):
+
+    def setUp(self):
+        self.pool = connection.ConnectionPool('example.com', maxsize=2)
+        self.is_broken = patch.object(connection.PooledConnection,
+                                      'is_broken', return_value=False)
+        self.is_broken.start()
+
+    def tearDown(self):
+        self.is_broken.stop()
+
+    def request(self):
+        return self.pool.request('POST', '/Transaction', b'<Request/>', {})
+
+    def test_connection_is_reused_for_second_request(self):
+        conn = stub_connection()
+        self.pool._new_connection = Mock(return_value=conn)
+        self.request()
+        self.request()
+        self.assertEqual(1, self.pool._new_connection.call_count)
+        self.assertEqual(1, self.pool.hits)
+        self.assertEqual(1, self.pool.misses)
+
+    def test_returns_status_and_body(self):
+        self.pool._new_connection = Mock(
+            return_value=stub_connection(body=b'<Response>ok</Response>'))
+        self.assertEqual((200, b'<Response>ok</Response>'), self.request())
+
+    def test_idle_connections_are_bounded(self):
+        conns = [stub_connection() for i in range(3)]
+        pooled = [connection.PooledConnection(c) for c in conns]
+        for p in pooled:
+            self.pool.release(p)
+        self.assertEqual(2, self.pool.num_idle)
+        self.assertTrue(conns[2].close.called)
+
+    def test_idle_connection_is_evicted(self):
+        self.pool.idle_timeout = 10
+        pooled = connection.PooledConnection(stub_connection())
+        pooled.last_used -= 20
+        self.pool._idle.append(pooled)
+        self.pool._new_connection = Mock(return_value=stub_connection())
+        self.request()
+        self.assertTrue(pooled.conn.close.called)
+        self.assertEqual(0, self.pool.hits)
+
+    def test_old_connection_is_recycled(self):
+        self.pool.max_lifetime = 100
+        pooled = connection.PooledConnection(stub_connection())
+        pooled.created -= 200
+        self.pool._idle.append(pooled)
+        self.pool._new_connection = Mock(return_value=stub_connection())
+        self.request()
+        self.assertTrue(pooled.conn.close.called)
+
+    def test_connection_closed_by_server_is_not_returned_to_pool(self):
+        self.pool._new_connection = Mock(
+            return_value=stub_connection(will_close=True))
+        self.request()
+        self.assertEqual(0, self.pool.num_idle)
+
+    def reuse(self, conn):
+        self.pool._idle.append(connection.PooledConnection(conn))
+        fresh = stub_connection()
+        self.pool._new_connection = Mock(return_value=fresh)
+        return fresh
+
+    def test_stale_connection_is_retried_on_fresh_connection(self):
+        stale = stub_connection(
+            request_side_effect=socket.error(errno.EPIPE, 'Broken pipe'))
+        fresh = self.reuse(stale)
+        self.assertEqual(200, self.request()[0])
+        self.assertTrue(stale.close.called)
+        self.assertTrue(fresh.send.called)
+        self.assertEqual(1, self.pool.retries)
+
+    def test_stale_connection_closed_without_response_is_retried(self):
+        stale = stub_connection(
+            response_side_effect=http_client.BadStatusLine(''))
+        self.reuse(stale)
+        self.assertEqual(200, self.request()[0])
+        self.assertEqual(1, self.pool.retries)
+
+    def test_reset_after_sending_the_request_is_not_retried(self):
+        stale = stub_connection(response_side_effect=socket.error(
+            errno.ECONNRESET, 'Connection reset by peer'))
+        fresh = self.reuse(stale)
+        with self.assertRaises(socket.error):
+            self.request()
+        self.assertFalse(fresh.send.called)
+        self.assertEqual(0, self.pool.retries)
+
+    def test_error_sending_the_body_is_not_retried(self):
+        stale = stub_connection(
+            send_side_effect=socket.error(errno.EPIPE, 'Broken pipe'))
+        fresh = self.reuse(stale)
+        with self.assertRaises(socket.error):
+            self.request()
+        self.assertFalse(fresh.send.called)
+
+    def test_error_on_fresh_connection_is_not_retried(self):
+        self.pool._new_connection = Mock(return_value=stub_connection(
+            request_side_effect=socket.error(errno.EPIPE, 'Broken pipe')))
+        with self.assertRaises(socket.error):
+            self.request()
+        self.assertEqual(0, self.pool.retries)
+
+    def test_timeout_is_not_retried(self):
+        stale = stub_connection(request_side_effect=socket.timeout())
+        self.pool._idle.append(connection.PooledConnection(stale))
+        with self.assertRaises(socket.timeout):
+            self.request()
+
+
+class ResetAfterRequestTests(TestCase):
+
+    def test_request_read_by_the_server_is_not_resent(self):
+        server = ResettingServer()
+        server.start()
+        pool = connection.ConnectionPool('127.0.0.1', server.port,
+                                         timeout=5, secure=False)
+        try:
+            self.assertEqual((200, b'<Response/>'), pool.request(
+                'POST', '/Transaction', b'<Request>1</Request>', {}))
+            with self.assertRaises(STALE_CONNECTION_ERRORS):
+                pool.request('POST', '/Transaction', b'<Request>2</Request>',
+                             {})
+        finally:
+            pool.clear()
+            server.listener.close()
+        self.assertEqual([b'<Request>1</Request>', b'<Request>2</Request>'],
+                         server.requests)
+        self.assertEqual(0, pool.retries)
+
+
+class BrokenConnectionTests(TestCase):
+
+    def test_closed_socket_is_detected(self):
+        a, b = socket.socketpair()
+        conn = Mock()
+        conn.sock = a
+        pooled = connection.PooledConnection(conn)
+        self.assertFalse(pooled.is_broken())
+        b.close()
+        self.assertTrue(pooled.is_broken())
+        a.close()
+
+
+class GatewayPoolTests(TestCase):
+
+    def setUp(self):
+        connection.clear_pools()
+
+    def tearDown(self):
+        connection.clear_pools()
+
+    def test_gateways_share_a_pool_per_host(self):
+        g1 = Gateway('example.com', '/Transaction', 'client', 'password')
+        g2 = Gateway('example.com', '/Transaction', 'client', 'password')
+        self.assertIs(g1._pool, g2._pool)
+
+    def test_pool_stats_are_exposed(self):
+        gateway = Gateway('example.com', '/Transaction', 'client', 'password')
+        self.assertEqual(0, gateway.pool_stats['hits'])
+        self.assertEqual(0, gateway.pool_stats['misses'])
+
+    def test_non_200_response_raises_gateway_error(self):
+        gateway = Gateway('example.com', '/Transaction', 'client', 'password')
+        gateway._pool._new_connection = Mock(
+            return_value=stub_connection(status=500))
+        with self.assertRaises(GatewayError):
+            gateway.auth(amount=1, currency='GBP',
+                         merchant_reference='TEST_123456',
+                         card_number='1000350000000007',
+                         expiry_date='10/12')
@@ -0,0 +1,206 @@
+import datetime
+import re
+from decimal import Decimal as D
+import unittest
+
+from django.db import connection
+from django.http import Http404
+from django.template.loader import render_to_string
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from datacash.dashboard import forms, views
+from datacash.models import OrderTransaction, FraudResponse
+
+
+class KeysetPaginationTests(TestCase):
+
+    def setUp(self):
+        OrderTransaction.objects.bulk_create(
+            OrderTransaction(order_number=str(1000 + i), method='auth',
+                             amount=D('10.00'), status=1, reason='ACCEPTED',
+                             request_xml='', response_xml='')
+            for i in range(45))
+        # Include ties on date_created to check id breaks them
+        start = datetime.datetime(2014, 1, 1)
+        for i, txn in enumerate(OrderTransaction.objects.order_by('id')):
+            OrderTransaction.objects.filter(pk=txn.pk).update(
+                date_created=start + datetime.timedelta(minutes=i // 3))
+
+    def get_page(self, query='', view=views.TransactionListView):
+        request = RequestFactory().get('/' + query)
+        context = view.as_view()(request).context_data
+        return context['page_obj'], context[view.context_object_name]
+
+    def test_pages_through_all_transactions_newest_first(self):
+        expected = list(OrderTransaction.objects.order_by(
+            '-date_created', '-id').values_list('pk', flat=True))
+        seen, pages = [], []
+        query = ''
+        while query is not None:
+            page, transactions = self.get_page(query)
+            pages.append(page)
+            seen.extend(txn.pk for txn in transactions)
+            query = page.next_url
+        self.assertEqual(expected, seen)
+        self.assertEqual([20, 20, 5], [len(p.object_list) for p in pages])
+        self.assertFalse(pages[0].has_previous())
+        self.assertTrue(pages[-1].has_previous())
+
+    def test_previous_links_return_the_same_pages(self):
+        first, __ = self.get_page()
+        second, __ = self.get_page(first.next_url)
+        third, __ = self.get_page(second.next_url)
+
+        page, transactions = self.get_page(third.previous_url)
+        self.assertEqual(second.object_list, list(transactions))
+        self.assertTrue(page.has_next())
+        page, transactions = self.get_page(page.previous_url)
+        self.assertEqual(first.object_list, list(transactions))
+        self.assertFalse(page.has_previous())
+
+    def test_empty_previous_page_has_no_next_page(self):
+        newest = OrderTransaction.objects.order_by('-date_created', '-id')[0]
+        page, transactions = self.get_page('?before=%s_%d' % (
+            newest.date_created.isoformat(), newest.pk))
+        self.assertEqual([], list(transactions))
+        self.assertFalse(page.has_next())
+        self.assertFalse(page.has_other_pages())
+        self.assertEqual(None, page.next_url)
+
+    def test_does_not_count_transactions(self):
+        first, __ = self.get_page()
+        with CaptureQueriesContext(connection) as context:
+            self.get_page(first.next_url)
+        for query in context.captured_queries:
+            self.assertFalse('COUNT(' in query['sql'].upper())
+
+    def test_does_not_select_xml(self):
+        with CaptureQueriesContext(connection) as context:
+            self.get_page()
+        for query in context.captured_queries:
+            self.assertFalse('request_xml' in query['sql'])
+
+    def test_invalid_cursor_returns_404(self):
+        with self.assertRaises(Http404):
+            self.get_page('?after=nonsense')
+
+    def test_fraud_response_list_is_paginated(self):
+        for i in range(25):
+            FraudResponse.objects.create(
+                merchant_identifier='1', merchant_order_ref='1000_AUTH',
+                t3m_id=str(i), score=0, recommendation=0, raw_response='')
+        page, responses = self.get_page(view=views.FraudResponseListView)
+        self.assertEqual(20, len(responses))
+        self.assertTrue(page.has_next())
+
+    def test_pager_links(self):
+        page, __ = self.get_page()
+        html = render_to_string('datacash/dashboard/partials/pagination.html',
+                                {'page_obj': page})
+        self.assertTrue('href="%s"' % page.next_url.replace('&', '&amp;') in html)
+        self.assertFalse('class="previous"' in html)
+
+
+class TransactionSearchTests(TestCase):
+
+    def setUp(self):
+        self.txn = OrderTransaction.objects.create(
+            order_number='1000', method='auth', amount=D('10.00'),
+            currency='GBP', status=1, reason='ACCEPTED',
+            datacash_reference='3000000088888888',
+            merchant_reference='1000_AUTH_1', request_xml='', response_xml='')
+        OrderTransaction.objects.create(
+            order_number='1001', method='pre', amount=D('99.00'),
+            currency='EUR', status=7, reason='DECLINED', request_xml='',
+            response_xml='')
+
+    def search(self, **data):
+        request = RequestFactory().get('/', data)
+        context = views.TransactionListView.as_view()(request).context_data
+        return [txn.order_number for txn in context['transactions']]
+
+    def test_no_filters(self):
+        self.assertEqual(['1001', '1000'], self.search())
+
+    def test_exact_filters(self):
+        for data in [{'order_number': '1000'},
+                     {'datacash_reference': '3000000088888888'},
+                     {'merchant_reference': '1000_AUTH_1'},
+                     {'method': 'auth'},
+                     {'status': '1'},
+                     {'currency': 'gbp'}]:
+            self.assertEqual(['1000'], self.search(**data))
+
+    def test_amount_range(self):
+        self.assertEqual(['1000'], self.search(amount_to='50'))
+        self.assertEqual(['1001'], self.search(amount_from='50'))
+        self.assertEqual([], self.search(amount_from='11', amount_to='50'))
+
+    def test_date_range_includes_the_last_day(self):
+        today = datetime.date.today()
+        self.assertEqual(['1001', '1000'], self.search(
+            date_from=today.isoformat(), date_to=today.isoformat()))
+        self.assertEqual([], self.search(
+            date_to=(today - datetime.timedelta(days=1)).isoformat()))
+
+    def test_invalid_filters_are_ignored(self):
+        self.assertEqual(['1001', '1000'], self.search(amount_from='lots'))
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite',
+                     "Query plans are checked using SQLite")
+class TransactionSearchQueryPlanTests(TestCase):
+    """
+    Check each filter can be answered from an index rather than by scanning
+    the table
+    """
+
+    def query_plan(self, **data):
+        form = forms.TransactionSearchForm(data)
+        self.assertTrue(form.is_valid())
+        queryset = form.filter(OrderTransaction.objects.all()).order_by(
+            '-date_created', '-id')[:21]
+        sql, params = queryset.query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        return [row[-1] for row in cursor.fetchall()]
+
+    def assertUsesIndex(self, plan, column):
+        pattern = (r'^SEARCH (TABLE )?datacash_ordertransaction USING '
+                   r'(COVERING )?INDEX \S+ \(%s[=>]' % column)
+        self.assertTrue(any(re.match(pattern, step) for step in plan),
+                        "Expected an index search on %s: %s" % (column, plan))
+
+    def test_filters_use_indexes(self):
+        for column, data in [
+                ('order_number', {'order_number': '1000'}),
+                ('datacash_reference', {'datacash_reference': '3000'}),
+                ('merchant_reference', {'merchant_reference': '1000_AUTH'}),
+                ('method', {'method': 'auth'}),
+                ('status', {'status': '1'}),
+                ('currency', {'currency': 'GBP'}),
+                ('amount', {'amount_from': '1', 'amount_to': '5'}),
+                ('date_created', {'date_from': '2014-01-01',
+                                  'date_to': '2014-01-31'})]:
+            self.assertUsesIndex(self.query_plan(**data), column)
+
+    def test_low_cardinality_filters_need_no_sort(self):
+        for data in [{'method': 'auth'}, {'status': '1'},
+                     {'currency': 'GBP'}, {}]:
+            plan = self.query_plan(**data)
+            self.assertFalse(any('TEMP B-TREE' in step for step in plan),
+                             plan)
+
+
+class SearchFormTemplateTests(TestCase):
+
+    def test_export_links_keep_the_search(self):
+        request = RequestFactory().get('/', {'method': 'auth'})
+        context = views.TransactionListView.as_view()(request).context_data
+        context['export_url'] = '/export/'
+        html = render_to_string(
+            'datacash/dashboard/partials/search_form.html', context)
+        self.assertTrue('href="/export/?method=auth"' in html)
+        self.assertTrue('href="/export/?method=auth&amp;format=jsonl"' in html)
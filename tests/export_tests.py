@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+import csv
+import json
+import os
+import shutil
+import tempfile
+from decimal import Decimal as D
+
+import six
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+
+from datacash import export
+from datacash.dashboard import views
+from datacash.models import OrderTransaction, FraudResponse
+
+from . import fixtures
+
+
+def create_txn(order_number='1000', method='auth', **kwargs):
+    values = dict(order_number=order_number, method=method,
+                  amount=D('95.99'), status=1, reason=u'ACCEPTED – ok',
+                  request_xml=fixtures.SAMPLE_REQUEST,
+                  response_xml=fixtures.SAMPLE_RESPONSE)
+    values.update(kwargs)
+    return OrderTransaction.objects.create(**values)
+
+
+def parse_csv(lines):
+    data = u''.join(lines)
+    if six.PY2:
+        return [[value.decode('utf8') for value in row]
+                for row in csv.reader(six.BytesIO(data.encode('utf8')))]
+    return list(csv.reader(six.StringIO(data, newline='')))
+
+
+class ExportTests(TestCase):
+
+    def test_csv_has_a_header_and_one_line_per_row(self):
+        txn = create_txn()
+        rows = parse_csv(export.export(OrderTransaction.objects.all()))
+        self.assertEqual(list(export.FIELDS[OrderTransaction]), rows[0])
+        self.assertEqual(2, len(rows))
+        row = dict(zip(rows[0], rows[1]))
+        self.assertEqual(str(txn.pk), row['id'])
+        self.assertEqual('95.99', row['amount'])
+        self.assertEqual(u'ACCEPTED – ok', row['reason'])
+        self.assertEqual('', row['datacash_reference'])
+
+    def test_amounts_keep_their_decimal_places(self):
+        create_txn(amount=D('12'))
+        lines = list(export.export(OrderTransaction.objects.all(),
+                                   format=export.JSONL))
+        self.assertEqual('12.00', json.loads(lines[0])['amount'])
+
+    def test_xml_is_only_included_when_asked_for(self):
+        create_txn()
+        rows = parse_csv(export.export(OrderTransaction.objects.all()))
+        self.assertFalse('request_xml' in rows[0])
+        rows = parse_csv(export.export(OrderTransaction.objects.all(),
+                                       include_payload=True))
+        row = dict(zip(rows[0], rows[1]))
+        self.assertTrue('XXXXXXXXXXXX0004' in row['request_xml'])
+        self.assertEqual(fixtures.SAMPLE_RESPONSE, row['response_xml'])
+
+    @override_settings(DATACASH_COMPRESS_XML=True)
+    def test_compressed_xml_is_exported_as_text(self):
+        create_txn()
+        lines = list(export.export(OrderTransaction.objects.all(),
+                                   format=export.JSONL, include_payload=True))
+        self.assertEqual(fixtures.SAMPLE_RESPONSE,
+                         json.loads(lines[0])['response_xml'])
+
+    def test_jsonl_has_one_object_per_line(self):
+        for i in range(3):
+            create_txn(order_number=str(1000 + i))
+        lines = list(export.export(OrderTransaction.objects.all(),
+                                   format=export.JSONL))
+        self.assertEqual(3, len(lines))
+        data = json.loads(lines[0])
+        self.assertEqual('1000', data['order_number'])
+        self.assertEqual('95.99', data['amount'])
+
+    def test_rows_are_read_in_batches(self):
+        for i in range(5):
+            create_txn(order_number=str(1000 + i))
+        lines = export.export(OrderTransaction.objects.all(),
+                              format=export.JSONL, batch_size=2)
+        with self.assertNumQueries(3):
+            order_numbers = [json.loads(line)['order_number']
+                             for line in lines]
+        self.assertEqual(['1000', '1001', '1002', '1003', '1004'],
+                         order_numbers)
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            export.export(OrderTransaction.objects.all(), format='xls')
+
+
+class ExportViewTests(TestCase):
+
+    def get(self, view=views.TransactionExportView, **data):
+        request = RequestFactory().get('/', data)
+        return view.as_view()(request)
+
+    def test_streams_filtered_transactions(self):
+        create_txn(order_number='1000', method='auth')
+        create_txn(order_number='1001', method='pre')
+        response = self.get(method='pre')
+        self.assertTrue(response.streaming)
+        self.assertEqual('text/csv; charset=utf-8', response['Content-Type'])
+        self.assertTrue('datacash-transactions.csv' in
+                        response['Content-Disposition'])
+        content = b''.join(response.streaming_content).decode('utf8')
+        rows = parse_csv([content])
+        self.assertEqual(['1001'], [row[1] for row in rows[1:]])
+
+    def test_transactions_with_xml(self):
+        create_txn(order_number='1000', method='auth')
+        response = self.get(format='jsonl', include_xml='1')
+        content = b''.join(response.streaming_content).decode('utf8')
+        data = json.loads(content)
+        self.assertEqual(OrderTransaction.objects.get().response_xml,
+                         data['response_xml'])
+        self.assertTrue(data['response_xml'])
+
+    def test_fraud_responses_as_jsonl(self):
+        FraudResponse.objects.create(
+            merchant_identifier='1', merchant_order_ref='1000_AUTH',
+            t3m_id='123', score=0, recommendation=0, raw_response='<xml/>')
+        response = self.get(view=views.FraudResponseExportView,
+                            format='jsonl', include_xml='1')
+        content = b''.join(response.streaming_content).decode('utf8')
+        data = json.loads(content)
+        self.assertEqual('123', data['t3m_id'])
+        self.assertEqual('<xml/>', data['raw_response'])
+
+
+class ExportCommandTests(TestCase):
+
+    def setUp(self):
+        create_txn(order_number='1000', method='auth')
+        create_txn(order_number='1001', method='pre')
+
+    def test_writes_to_stdout(self):
+        out = six.StringIO()
+        call_command('datacash_export', 'transactions', format='jsonl',
+                     filter=['method=auth'], stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(['1000'],
+                         [json.loads(line)['order_number'] for line in lines])
+
+    def test_writes_to_a_file(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'export.csv')
+        call_command('datacash_export', 'transactions', output=path,
+                     include_xml=True)
+        with open(path, 'rb') as f:
+            rows = parse_csv([f.read().decode('utf8')])
+        self.assertEqual(3, len(rows))
+        self.assertTrue('response_xml' in rows[0])
+
+    def test_rejects_unknown_filters(self):
+        with self.assertRaises(CommandError):
+            call_command('datacash_export', 'transactions',
+                         filter=['colour=red'])
+
+    def test_rejects_invalid_filters(self):
+        with self.assertRaises(CommandError):
+            call_command('datacash_export', 'transactions',
+                         filter=['date_from=yesterday'])
@@ -6,7 +6,7 @@ from django.test import TestCase
 from oscar.apps.payment.utils import Bankcard
 from oscar.apps.payment.exceptions import UnableToTakePayment, InvalidGatewayRequestError
 
-from datacash.models import OrderTransaction
+from datacash.models import FraudResponse, OrderTransaction
 from datacash.facade import Facade
 
 from . import XmlTestingMixin, fixtures
@@ -256,7 +256,35 @@ class FacadeTests(TestCase, XmlTestingMixin):
             self.facade.pre_authorise('100001', D('123.22'), card)
 
 
+class MerchantReferenceTests(TestCase):
 
+    def setUp(self):
+        self.facade = Facade()
 
-
-
+    def test_does_not_query_the_database(self):
+        with self.assertNumQueries(0):
+            self.facade.merchant_reference('100001', 'pre')
+
+    def test_references_are_unique(self):
+        refs = set(self.facade.merchant_reference('100001', 'fulfill')
+                   for i in range(1000))
+        self.assertEqual(1000, len(refs))
+
+    def test_order_number_can_be_recovered(self):
+        ref = self.facade.merchant_reference('100001', 'pre')
+        self.assertTrue(ref.startswith('100001_PRE_'))
+        self.assertEqual('100001', FraudResponse(
+            merchant_order_ref=ref).order_number)
+
+    def test_references_are_at_most_32_characters(self):
+        ref = self.facade.merchant_reference('1' * 15, 'fulfill')
+        self.assertEqual(27, len(ref))
+        ref = self.facade.merchant_reference('1' * 18, 'fulfill')
+        self.assertEqual(30, len(ref))
+        self.assertEqual('1' * 18, ref.split('_')[0])
+        ref = self.facade.merchant_reference('1' * 20, 'fulfill')
+        self.assertEqual(32, len(ref))
+
+    def test_order_numbers_which_dont_fit_are_rejected(self):
+        with self.assertRaises(ValueError):
+            self.facade.merchant_reference('1' * 21, 'pre')
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+from decimal import Decimal as D
+from unittest import skipUnless
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db.models.query import QuerySet
+from django.test import TestCase
+from django.test.utils import override_settings
+from six import StringIO
+
+from datacash import fields
+from datacash.models import OrderTransaction
+
+from . import fixtures
+
+
+def create_txn(**kwargs):
+    values = dict(order_number='1000', method='auth', amount=D('95.99'),
+                  status=1, reason='ACCEPTED',
+                  request_xml=fixtures.SAMPLE_CV2AVS_REQUEST,
+                  response_xml=fixtures.SAMPLE_RESPONSE)
+    values.update(kwargs)
+    return OrderTransaction.objects.create(**values)
+
+
+def stored_values(txn):
+    return OrderTransaction.objects.filter(pk=txn.pk).values_list(
+        'request_xml', 'response_xml')[0]
+
+
+class CompressionTests(TestCase):
+
+    def test_round_trip(self):
+        value = fixtures.SAMPLE_RESPONSE + u'Smörgåsbord'
+        compressed = fields.compress(value)
+        self.assertTrue(fields.is_compressed(compressed))
+        self.assertTrue(len(compressed) < len(value))
+        self.assertEqual(value, fields.decompress(compressed))
+
+    def test_plain_zlib_is_used_by_default(self):
+        compressed = fields.compress(fixtures.SAMPLE_RESPONSE)
+        self.assertTrue(compressed.startswith(fields.ZLIB_MARKER))
+
+    @skipUnless(fields.HAS_ZDICT, "Requires Python 3.3+")
+    @override_settings(DATACASH_COMPRESS_XML_ZDICT=True)
+    def test_preset_dictionary_is_used_when_enabled(self):
+        compressed = fields.compress(fixtures.SAMPLE_RESPONSE)
+        self.assertTrue(compressed.startswith(fields.ZLIB_DICT_MARKER))
+        self.assertTrue(len(compressed) < len(
+            fields.compress(fixtures.SAMPLE_RESPONSE, zdict=False)))
+        self.assertEqual(fixtures.SAMPLE_RESPONSE,
+                         fields.decompress(compressed))
+
+    def test_uncompressed_values_are_returned_as_is(self):
+        self.assertEqual(fixtures.SAMPLE_RESPONSE,
+                         fields.decompress(fixtures.SAMPLE_RESPONSE))
+
+
+class CompressedTextFieldTests(TestCase):
+
+    def test_values_are_not_compressed_by_default(self):
+        txn = create_txn()
+        self.assertEqual(fixtures.SAMPLE_RESPONSE, stored_values(txn)[1])
+
+    @override_settings(DATACASH_COMPRESS_XML=True)
+    def test_values_are_compressed_when_enabled(self):
+        txn = create_txn()
+        request_xml, response_xml = stored_values(txn)
+        self.assertTrue(fields.is_compressed(request_xml))
+        self.assertTrue(fields.is_compressed(response_xml))
+
+        txn = OrderTransaction.objects.get(pk=txn.pk)
+        self.assertEqual(fixtures.SAMPLE_RESPONSE, txn.response_xml)
+        self.assertTrue('<cv2>XXX</cv2>' in txn.request_xml)
+        self.assertTrue('<cv2>XXX</cv2>' in txn.pretty_request_xml)
+
+    @override_settings(DATACASH_COMPRESS_XML=True)
+    def test_bulk_create_compresses(self):
+        OrderTransaction.objects.bulk_create([OrderTransaction(
+            order_number='1000', method='auth', status=1, reason='',
+            request_xml=fixtures.SAMPLE_REQUEST,
+            response_xml=fixtures.SAMPLE_RESPONSE)])
+        txn = OrderTransaction.objects.get()
+        self.assertTrue(fields.is_compressed(stored_values(txn)[0]))
+        self.assertTrue('XXXXXXXXXXXX0004' in txn.request_xml)
+
+    def test_compressed_values_can_be_read_when_disabled(self):
+        with self.settings(DATACASH_COMPRESS_XML=True):
+            txn = create_txn()
+        txn = OrderTransaction.objects.get(pk=txn.pk)
+        self.assertEqual(fixtures.SAMPLE_RESPONSE, txn.response_xml)
+
+
+class CompressCommandTests(TestCase):
+
+    def run_command(self, **kwargs):
+        out = StringIO()
+        call_command('datacash_compress_xml', batch_size=2, stdout=out,
+                     **kwargs)
+        return out.getvalue()
+
+    def test_compresses_existing_transactions(self):
+        txns = [create_txn() for i in range(3)]
+        output = self.run_command()
+        self.assertTrue(output.startswith('Converted 3 transactions'))
+        for txn in txns:
+            for value in stored_values(txn):
+                self.assertTrue(fields.is_compressed(value))
+        self.assertEqual(fixtures.SAMPLE_RESPONSE, OrderTransaction.objects.get(
+            pk=txns[0].pk).response_xml)
+
+        # Already compressed transactions are skipped
+        self.assertTrue(self.run_command().startswith(
+            'Converted 0 transactions'))
+
+    def test_scrubs_request_xml_before_compressing(self):
+        txn = create_txn()
+        # Simulate a transaction saved before bulk writes were masked
+        QuerySet(OrderTransaction).filter(pk=txn.pk).update(
+            request_xml=fixtures.SAMPLE_REQUEST)
+        self.run_command()
+        request_xml = stored_values(txn)[0]
+        self.assertTrue(fields.is_compressed(request_xml))
+        self.assertTrue('XXXXXXXXXXXX0004' in fields.decompress(request_xml))
+
+    def test_decompresses_transactions(self):
+        txn = create_txn()
+        self.run_command()
+        self.run_command(decompress=True)
+        self.assertEqual(fixtures.SAMPLE_RESPONSE, stored_values(txn)[1])
+
+    @override_settings(DATACASH_COMPRESS_XML=True)
+    def test_decompress_requires_compression_to_be_disabled(self):
+        with self.assertRaises(CommandError):
+            self.run_command(decompress=True)
@@ -1,9 +1,13 @@
+# -*- coding: utf-8 -*-
 from decimal import Decimal as D
+from xml.dom.minidom import Document
 from mock import Mock
 
 from django.test import TestCase
 
+from datacash import the3rdman
 from datacash.gateway import Gateway, Response
+from datacash.xmlutils import create_element
 
 from . import XmlTestingMixin, fixtures
 
@@ -198,6 +202,29 @@ class ResponseTests(TestCase):
         r = Response('', '<?xml version="1.0" ?><Response />')
         self.assertIsNone(r.status)
 
+    def test_none_is_returned_for_empty_element(self):
+        r = Response('', '<?xml version="1.0" ?><Response><reason/></Response>')
+        self.assertIsNone(r.reason)
+
+    def test_response_is_parsed_lazily(self):
+        r = Response('', 'not xml')
+        self.assertEqual('not xml', str(r))
+
+    def test_additional_elements_are_available_by_path(self):
+        response_xml = """<?xml version="1.0" encoding="UTF-8"?>
+<Response>
+    <CardTxn>
+        <Cv2Avs>
+            <cv2avs_status>ALL MATCH</cv2avs_status>
+        </Cv2Avs>
+        <authcode>100000</authcode>
+    </CardTxn>
+    <status>1</status>
+</Response>"""
+        r = Response('', response_xml)
+        self.assertEqual('ALL MATCH', r.elements['CardTxn.Cv2Avs.cv2avs_status'])
+        self.assertEqual('100000', r['auth_code'])
+
 
 class SuccessfulResponseTests(TestCase):
 
@@ -252,3 +279,172 @@ class DeclinedResponseTests(TestCase):
 
     def test_is_declined(self):
         self.assertTrue(self.response.is_declined())
+
+
+class BatchSubmissionTests(TestCase):
+
+    def setUp(self):
+        self.gateway = Gateway('example.com', '/Transaction', 'dummyclient', 'dummypassword')
+        self.gateway._fetch_response_xml = Mock(return_value=fixtures.SAMPLE_RESPONSE)
+
+    def fulfill(self, txn_reference='4500203021916406', **kwargs):
+        kwargs.update(amount=D('10.00'), currency='GBP',
+                      txn_reference=txn_reference, auth_code='123456')
+        return ('fulfill', kwargs)
+
+    def test_results_are_yielded_in_input_order(self):
+        requests = [self.fulfill(str(4500203021916400 + i)) for i in range(20)]
+        results = list(self.gateway.submit_many(requests, max_workers=5))
+        self.assertEqual(list(range(20)), [r.index for r in results])
+        self.assertTrue(all(r.is_successful() for r in results))
+
+    def test_results_can_be_yielded_as_completed(self):
+        requests = [self.fulfill() for i in range(10)]
+        results = list(self.gateway.submit_many(requests, ordered=False))
+        self.assertEqual(list(range(10)), sorted(r.index for r in results))
+
+    def test_invalid_requests_are_reported_without_being_sent(self):
+        requests = [self.fulfill(), ('fulfill', {'amount': D('10.00')}),
+                    ('unknown', {}), ('cancel', {'txn_reference': '1234'})]
+        results = list(self.gateway.submit_many(requests))
+        self.assertIsNone(results[0].error)
+        self.assertIsInstance(results[1].error, ValueError)
+        self.assertIsInstance(results[2].error, ValueError)
+        self.assertIsNone(results[3].error)
+        self.assertEqual(2, self.gateway._fetch_response_xml.call_count)
+
+    def test_failure_does_not_abort_batch(self):
+        self.gateway._fetch_response_xml = Mock(side_effect=[
+            fixtures.SAMPLE_RESPONSE, IOError("Connection reset"),
+            fixtures.SAMPLE_RESPONSE])
+        results = list(self.gateway.submit_many(
+            [self.fulfill() for i in range(3)], max_workers=1))
+        self.assertEqual(3, len(results))
+        self.assertEqual(1, len([r for r in results if r.error]))
+
+
+def minidom_request_xml(gateway, method_name, **kwargs):
+    """
+    The original DOM-based implementation of Gateway._build_request_xml
+    """
+    doc = Document()
+    req = create_element(doc, doc, 'Request')
+    auth = create_element(doc, req, 'Authentication')
+    create_element(doc, auth, 'client', gateway._client)
+    create_element(doc, auth, 'password', gateway._password)
+    txn = create_element(doc, req, 'Transaction')
+    if 'card_number' in kwargs or 'previous_txn_reference' in kwargs:
+        card_txn = create_element(doc, txn, 'CardTxn')
+        create_element(doc, card_txn, 'method', method_name)
+        if 'card_number' in kwargs:
+            card = create_element(doc, card_txn, 'Card')
+            create_element(doc, card, 'pan', kwargs['card_number'])
+            create_element(doc, card, 'expirydate', kwargs['expiry_date'])
+            if 'start_date' in kwargs:
+                create_element(doc, card, 'startdate', kwargs['start_date'])
+            if 'issue_number' in kwargs:
+                create_element(doc, card, 'issuenumber', kwargs['issue_number'])
+            if 'auth_code' in kwargs:
+                create_element(doc, card, 'authcode', kwargs['auth_code'])
+            if gateway._cv2avs:
+                cv2avs = create_element(doc, card, 'Cv2Avs')
+                for n in range(1, 5):
+                    key = 'address_line%d' % n
+                    if key in kwargs:
+                        create_element(doc, cv2avs, 'street_address%d' % n, kwargs[key])
+                if 'postcode' in kwargs:
+                    create_element(doc, cv2avs, 'postcode', kwargs['postcode'][:9])
+                if 'ccv' in kwargs:
+                    create_element(doc, cv2avs, 'cv2', kwargs['ccv'])
+        elif 'previous_txn_reference' in kwargs:
+            create_element(doc, card_txn, 'card_details', kwargs['previous_txn_reference'],
+                           attributes={'type': 'preregistered'})
+    is_historic = False
+    if 'txn_reference' in kwargs:
+        is_historic = True
+        historic_txn = create_element(doc, txn, 'HistoricTxn')
+        create_element(doc, historic_txn, 'reference', kwargs['txn_reference'])
+        create_element(doc, historic_txn, 'method', method_name)
+        if 'auth_code' in kwargs:
+            create_element(doc, historic_txn, 'authcode', kwargs['auth_code'])
+    txn_details = create_element(doc, txn, 'TxnDetails')
+    if 'merchant_reference' in kwargs:
+        create_element(doc, txn_details, 'merchantreference', kwargs['merchant_reference'])
+    if 'amount' in kwargs:
+        if is_historic:
+            create_element(doc, txn_details, 'amount', str(kwargs['amount']))
+        else:
+            create_element(doc, txn_details, 'amount', str(kwargs['amount']),
+                           {'currency': kwargs['currency']})
+    create_element(doc, txn_details, 'capturemethod', gateway._capturemethod)
+    if 'the3rdman_data' in kwargs and kwargs['the3rdman_data']:
+        the3rdman.add_fraud_fields(doc, txn_details, **kwargs['the3rdman_data'])
+    return doc.toxml()
+
+
+CARD_KWARGS = {
+    'amount': D('12.99'), 'currency': 'GBP',
+    'merchant_reference': 'TEST_132473839018',
+    'card_number': '1000350000000007', 'expiry_date': '10/12',
+    'start_date': '01/10', 'issue_number': '01', 'ccv': 345,
+    'address_line1': u'1 Smörgåsbord Street', 'address_line2': '',
+    'postcode': 'N12 9ET & <more>',
+}
+THE3RDMAN_DATA = {
+    'callback_url': 'http://example.com/datacash/the3rdman/?a=1&b="2"',
+    'customer_info': {'surname': u'Smörgåsbord', 'sales_channel': 3,
+                      'title': None, 'email': ''},
+    'delivery_info': {'street_address_1': '1 Egg Street', 'country': '826'},
+    'billing_info': {'postcode': 'N1 8RT'},
+    'account_info': {'sort_code': '12-34-56', 'avg': 0},
+    'order_info': {'products': [
+        {'code': '9780', 'price': D('12.99'), 'quantity': 2,
+         'prod_description': 'Fish & <chips>'},
+        {'prod_id': 2}]},
+}
+
+
+class RequestXmlEquivalenceTests(TestCase):
+    """
+    The streaming serialiser must produce exactly the same XML as minidom
+    """
+    requests = [
+        ('auth', CARD_KWARGS),
+        ('auth', dict(CARD_KWARGS, auth_code='123456')),
+        ('auth', dict(CARD_KWARGS, the3rdman_data=THE3RDMAN_DATA)),
+        ('pre', dict(CARD_KWARGS, the3rdman_data=THE3RDMAN_DATA)),
+        ('pre', {'amount': D('10.00'), 'currency': 'GBP',
+                 'merchant_reference': 'TEST_132473839018',
+                 'previous_txn_reference': '4500203021916406',
+                 'the3rdman_data': None}),
+        ('refund', CARD_KWARGS),
+        ('erp', CARD_KWARGS),
+        ('cancel', {'txn_reference': '4500203021916406'}),
+        ('fulfill', {'amount': D('767.00'), 'currency': 'GBP',
+                     'merchant_reference': '100001_FULFILL_1_6664',
+                     'txn_reference': '1234567890124209',
+                     'auth_code': '747595'}),
+        ('txn_refund', {'amount': D('10.00'), 'currency': 'GBP',
+                        'txn_reference': '1234567890124209'}),
+    ]
+
+    def assertSameXml(self, gateway):
+        for method, kwargs in self.requests:
+            self.assertEqual(minidom_request_xml(gateway, method, **kwargs),
+                             gateway._build_request_xml(method, **kwargs))
+
+    def test_with_cv2avs(self):
+        self.assertSameXml(Gateway('example.com', '/Transaction', 'client',
+                                   'pass&word', True))
+
+    def test_without_cv2avs(self):
+        self.assertSameXml(Gateway('example.com', '/Transaction', 'client',
+                                   'password', False, 'cnp'))
+
+    def test_cv2avs_without_fields(self):
+        gateway = Gateway('example.com', '/Transaction', 'client', 'password', True)
+        kwargs = {'amount': D('1.00'), 'currency': 'GBP',
+                  'merchant_reference': 'TEST_132473839018',
+                  'card_number': '1000350000000007', 'expiry_date': '10/12'}
+        self.assertEqual(minidom_request_xml(gateway, 'auth', **kwargs),
+                         gateway._build_request_xml('auth', **kwargs))
@@ -0,0 +1,55 @@
+from django.core.management import call_command
+from django.test import TestCase
+from six import StringIO
+
+from datacash import loadtest
+from datacash.models import OrderTransaction
+
+
+class PercentileTests(TestCase):
+
+    def test_returns_nearest_rank(self):
+        values = list(range(100, 0, -1))
+        self.assertEqual(50, loadtest.percentile(values, 50))
+        self.assertEqual(95, loadtest.percentile(values, 95))
+        self.assertEqual(100, loadtest.percentile(values, 100))
+
+    def test_returns_none_for_no_values(self):
+        self.assertIsNone(loadtest.percentile([], 50))
+
+
+class ParseMixTests(TestCase):
+
+    def test_parses_weights(self):
+        self.assertEqual({'pre': 3.0, 'fulfill': 1.0},
+                         loadtest.parse_mix('pre=3,fulfill'))
+
+    def test_rejects_unknown_methods(self):
+        with self.assertRaises(ValueError):
+            loadtest.parse_mix('pre,erp')
+
+
+class LoadTestCommandTests(TestCase):
+
+    def run_command(self, **kwargs):
+        out = StringIO()
+        call_command('datacash_loadtest', concurrency=1, stdout=out, **kwargs)
+        return out.getvalue()
+
+    def test_reports_phase_latencies(self):
+        report = self.run_command(requests=5)
+        self.assertTrue(report.startswith('5 payments'))
+        for phase in loadtest.PHASES:
+            self.assertIn('\n%s ' % phase, report)
+        self.assertIn('DB queries per payment: 1.00', report)
+
+    def test_historic_methods_use_a_previous_preauth(self):
+        self.run_command(requests=4, mix='fulfill', keep=True)
+        self.assertEqual(4, OrderTransaction.objects.filter(
+            method='pre').count())
+        self.assertEqual(4, OrderTransaction.objects.filter(
+            method='fulfill', status=1).count())
+
+    def test_removes_transactions_afterwards(self):
+        self.run_command(requests=3)
+        self.assertEqual(0, OrderTransaction.objects.count())
@@ -1,8 +1,19 @@
+# -*- coding: utf-8 -*-
+import re
 from decimal import Decimal as D
+from xml.dom.minidom import parseString
 
+import mock
+from django.contrib.admin.sites import site
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
 from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
 
-from datacash.models import OrderTransaction
+from datacash.admin import OrderTransactionAdmin
+from datacash.models import OrderTransaction, prettify_xml
 from . import XmlTestingMixin, fixtures
 
 
@@ -69,3 +80,156 @@ class TransactionModelTests(TestCase, XmlTestingMixin):
                                               request_xml=fixtures.SAMPLE_DATACASH_REFERENCE_REQUEST,
                                               response_xml=fixtures.SAMPLE_RESPONSE)
         self.assertXmlElementEquals(txn.request_xml, '1234567890124209', 'Request.Transaction.HistoricTxn.reference')
+
+
+class BulkWriteTests(TestCase, XmlTestingMixin):
+
+    def create_txn(self, request_xml=fixtures.SAMPLE_REQUEST):
+        return OrderTransaction(order_number='1000', method='auth',
+                                amount=D('95.99'), status=1,
+                                reason='ACCEPTED', request_xml=request_xml,
+                                response_xml=fixtures.SAMPLE_RESPONSE)
+
+    def test_bulk_create_masks_sensitive_data(self):
+        OrderTransaction.objects.bulk_create(
+            self.create_txn() for i in range(2))
+        for txn in OrderTransaction.objects.all():
+            self.assertXmlElementEquals(txn.request_xml, 'XXXXXXXXXXXX0004',
+                                        'Request.Transaction.CardTxn.Card.pan')
+            self.assertXmlElementEquals(txn.request_xml, 'XXX',
+                                        'Request.Authentication.password')
+
+    def test_update_masks_sensitive_data(self):
+        txn = self.create_txn(request_xml='')
+        txn.save()
+        OrderTransaction.objects.filter(pk=txn.pk).update(
+            request_xml=fixtures.SAMPLE_CV2AVS_REQUEST)
+        txn = OrderTransaction.objects.get(pk=txn.pk)
+        self.assertXmlElementEquals(txn.request_xml, 'XXX',
+                                    'Request.Transaction.CardTxn.Card.Cv2Avs.cv2')
+
+
+class DeferredPayloadTests(TestCase, XmlTestingMixin):
+
+    def setUp(self):
+        self.txn = OrderTransaction.objects.create(
+            order_number='1000', method='auth', amount=D('95.99'), status=1,
+            reason='ACCEPTED', request_xml=fixtures.SAMPLE_CV2AVS_REQUEST,
+            response_xml=fixtures.SAMPLE_RESPONSE)
+
+    def test_xml_is_selected_by_default(self):
+        txn = OrderTransaction.objects.get(pk=self.txn.pk)
+        self.assertEqual(OrderTransaction, txn.__class__)
+        with self.assertNumQueries(0):
+            self.assertEqual(fixtures.SAMPLE_RESPONSE, txn.response_xml)
+
+    def test_without_payload_doesnt_select_xml(self):
+        with CaptureQueriesContext(connection) as context:
+            list(OrderTransaction.objects.without_payload())
+            OrderTransaction.objects.without_payload().get(
+                order_number='1000')
+        for query in context.captured_queries:
+            self.assertFalse('request_xml' in query['sql'])
+            self.assertFalse('response_xml' in query['sql'])
+
+    def test_xml_is_loaded_on_access(self):
+        txn = OrderTransaction.objects.without_payload().get(pk=self.txn.pk)
+        self.assertEqual(fixtures.SAMPLE_RESPONSE, txn.response_xml)
+
+    def test_pretty_xml_loads_both_fields_in_one_query(self):
+        txn = OrderTransaction.objects.without_payload().get(pk=self.txn.pk)
+        with self.assertNumQueries(1):
+            txn.pretty_request_xml
+            txn.pretty_response_xml
+        self.assertXmlElementEquals(txn.request_xml, 'XXX',
+                                    'Request.Authentication.password')
+
+    def test_saving_a_deferred_instance_keeps_xml(self):
+        txn = OrderTransaction.objects.without_payload().get(pk=self.txn.pk)
+        txn.reason = 'DECLINED'
+        txn.save()
+        txn = OrderTransaction.objects.get(pk=self.txn.pk)
+        self.assertEqual('DECLINED', txn.reason)
+        self.assertEqual(fixtures.SAMPLE_RESPONSE, txn.response_xml)
+
+
+class AdminTests(TestCase):
+
+    def setUp(self):
+        self.txn = OrderTransaction.objects.create(
+            order_number='1000', method='auth', amount=D('95.99'), status=1,
+            reason='ACCEPTED', request_xml=fixtures.SAMPLE_CV2AVS_REQUEST,
+            response_xml=fixtures.SAMPLE_RESPONSE)
+        self.admin = OrderTransactionAdmin(OrderTransaction, site)
+        self.request = RequestFactory().get('/')
+        self.request.user = User.objects.create_superuser(
+            'admin', 'admin@example.com', 'password')
+
+    def test_changelist_doesnt_select_xml(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.admin.changelist_view(self.request)
+        self.assertEqual([self.txn.pk], [
+            txn.pk for txn in response.context_data['cl'].result_list])
+        selects = [query['sql'] for query in context.captured_queries
+                   if 'datacash_ordertransaction' in query['sql']]
+        self.assertTrue(selects)
+        for sql in selects:
+            self.assertFalse('request_xml' in sql)
+
+    def test_change_form_loads_xml(self):
+        txn = self.admin.get_object(self.request, str(self.txn.pk))
+        self.assertEqual(OrderTransaction, txn.__class__)
+        with self.assertNumQueries(0):
+            self.assertEqual(fixtures.SAMPLE_RESPONSE, txn.response_xml)
+        self.assertIsNone(self.admin.get_object(self.request, 'x'))
+
+
+def minidom_prettify_xml(xml_str):
+    # The original DOM-based implementation
+    xml_str = re.sub(r'\s*\n\s*', '', xml_str)
+    ugly = parseString(xml_str.encode('utf8')).toprettyxml(indent='    ')
+    regex = re.compile(r'>\n\s+([^<>\s].*?)\n\s+</', re.DOTALL)
+    return regex.sub('>\g<1></', ugly)
+
+
+class PrettyXmlTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def create_txn(self, request_xml=fixtures.SAMPLE_CV2AVS_REQUEST,
+                   response_xml=fixtures.SAMPLE_RESPONSE):
+        return OrderTransaction.objects.create(
+            order_number='1000', method='auth', amount=D('95.99'), status=1,
+            reason='ACCEPTED', request_xml=request_xml,
+            response_xml=response_xml)
+
+    def test_output_matches_minidom(self):
+        for xml in (fixtures.SAMPLE_REQUEST, fixtures.SAMPLE_CV2AVS_REQUEST,
+                    fixtures.SAMPLE_RESPONSE,
+                    fixtures.SAMPLE_SUCCESSFUL_FULFILL_RESPONSE,
+                    u'<a x="1" y="&amp;&quot;"><b>t &amp; &lt;</b><c></c>'
+                    u'<d>\n  <e>caf\xe9</e>\n</d><!-- note --></a>'):
+            self.assertEqual(minidom_prettify_xml(xml), prettify_xml(xml))
+
+    def test_malformed_xml_is_returned_unchanged(self):
+        truncated = fixtures.SAMPLE_RESPONSE[:100]
+        txn = self.create_txn(response_xml=truncated)
+        self.assertEqual(truncated, txn.pretty_response_xml)
+        self.assertEqual('', prettify_xml(''))
+
+    def test_pretty_xml_is_memoized(self):
+        txn = self.create_txn()
+        txn.pretty_response_xml
+        with self.assertNumQueries(0):
+            with mock.patch('datacash.xmlutils.pretty_print') as pretty_print:
+                txn.pretty_response_xml
+        self.assertFalse(pretty_print.called)
+
+    def test_pretty_xml_is_cached_across_instances(self):
+        txn = self.create_txn()
+        expected = txn.pretty_request_xml
+        txn = OrderTransaction.objects.get(pk=txn.pk)
+        with mock.patch('datacash.xmlutils.pretty_print') as pretty_print:
+            self.assertEqual(expected, txn.pretty_request_xml)
+        self.assertFalse(pretty_print.called)
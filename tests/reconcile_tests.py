@@ -0,0 +1,145 @@
+import os
+import shutil
+import tempfile
+from decimal import Decimal as D
+
+import six
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+
+from datacash import reconcile
+from datacash.models import OrderTransaction
+
+
+def create_txn(reference, method='auth', amount=D('10.00'), status=1):
+    return OrderTransaction.objects.create(
+        order_number='1000', method=method, amount=amount, status=status,
+        reason='', datacash_reference=reference, request_xml='',
+        response_xml='')
+
+
+def settlement(*rows, **kwargs):
+    header = kwargs.get('header', 'datacash_reference,method,amount')
+    return six.StringIO(u'\n'.join((header,) + rows) + u'\n')
+
+
+class ReconcileTests(TestCase):
+
+    def reconcile(self, f, **kwargs):
+        reconciler = reconcile.Reconciler(
+            reconcile.read_settlement(f, **kwargs),
+            reconcile.read_audit_trail(batch_size=2))
+        return [(m.kind, m.reference, m.method) for m in reconciler]
+
+    def test_matching_transactions(self):
+        create_txn('3000000000000001')
+        create_txn('3000000000000002', method='pre', amount=D('5.00'))
+        create_txn('3000000000000002', method='fulfill', amount=D('5.00'))
+        create_txn('3000000000000003', status=7)
+        f = settlement('3000000000000001,auth,10.00',
+                       '3000000000000002,fulfil,5.00')
+        self.assertEqual([], self.reconcile(f))
+
+    def test_mismatches(self):
+        create_txn('3000000000000001')
+        create_txn('3000000000000002', amount=D('12.00'))
+        create_txn('3000000000000003', status=7)
+        create_txn('3000000000000004', method='pre')
+        create_txn('3000000000000006')
+        create_txn('3000000000000007', method='pre')
+        create_txn('3000000000000007', method='cancel')
+        f = settlement('3000000000000002,auth,10.00',
+                       '3000000000000003,auth,10.00',
+                       '3000000000000004,fulfil,10.00',
+                       '3000000000000005,auth,10.00')
+        self.assertEqual([
+            (reconcile.UNSETTLED, '3000000000000001', 'auth'),
+            (reconcile.AMOUNT_DIFFERS, '3000000000000002', 'auth'),
+            (reconcile.STATUS_DIFFERS, '3000000000000003', 'auth'),
+            (reconcile.UNEXPECTED_FULFIL, '3000000000000004', 'fulfill'),
+            (reconcile.MISSING, '3000000000000005', 'auth'),
+            (reconcile.UNSETTLED, '3000000000000006', 'auth'),
+        ], self.reconcile(f))
+
+    def test_settled_after_cancel(self):
+        create_txn('3000000000000001')
+        create_txn('3000000000000001', method='cancel')
+        f = settlement('3000000000000001,auth,10.00')
+        self.assertEqual(
+            [(reconcile.STATUS_DIFFERS, '3000000000000001', 'auth')],
+            self.reconcile(f))
+
+    def test_references_spanning_batches(self):
+        # With a batch size of 2 the last reference of a batch has more rows
+        # in the next
+        create_txn('3000000000000001')
+        for method in ('pre', 'fulfill', 'refund'):
+            create_txn('3000000000000002', method=method)
+        create_txn('3000000000000003')
+        f = settlement('3000000000000001,auth,10.00',
+                       '3000000000000002,fulfil,10.00',
+                       '3000000000000002,refund,10.00',
+                       '3000000000000003,auth,10.00')
+        self.assertEqual([], self.reconcile(f))
+        records = list(reconcile.read_audit_trail(batch_size=2))
+        self.assertEqual(5, len(records))
+
+    def test_custom_columns_without_method(self):
+        create_txn('3000000000000001')
+        f = settlement('3000000000000001,10.00', header='DC Ref,Value')
+        self.assertEqual([], self.reconcile(
+            f, columns={'reference': 'DC Ref', 'amount': 'Value'}))
+
+    def test_settlement_status(self):
+        create_txn('3000000000000001')
+        f = settlement('3000000000000001,10.00,7',
+                       header='datacash_reference,amount,status')
+        self.assertEqual(
+            [(reconcile.STATUS_DIFFERS, '3000000000000001', 'auth')],
+            self.reconcile(f))
+
+    def test_unsorted_settlement_file(self):
+        f = settlement('3000000000000002,auth,10.00',
+                       '3000000000000001,auth,10.00')
+        with self.assertRaises(reconcile.ReconciliationError):
+            self.reconcile(f)
+
+    def test_missing_column(self):
+        f = settlement('3000000000000001', header='datacash_reference')
+        with self.assertRaises(reconcile.ReconciliationError):
+            self.reconcile(f)
+
+
+class ReconcileCommandTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def write_settlement(self, content):
+        path = os.path.join(self.tmpdir, 'settlement.csv')
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_writes_a_report(self):
+        create_txn('3000000000000001', amount=D('12.00'))
+        path = self.write_settlement(
+            'DC Ref,amount\n3000000000000001,10.00\n')
+        out, err = six.StringIO(), six.StringIO()
+        call_command('datacash_reconcile', path, column=['reference=DC Ref'],
+                     stdout=out, stderr=err)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(
+            'kind,reference,method,settled_amount,audit_amount,detail',
+            lines[0])
+        self.assertEqual('amount differs,3000000000000001,auth,10.00,12.00,',
+                         lines[1])
+        self.assertTrue('1 mismatches' in err.getvalue())
+
+    def test_reports_errors(self):
+        path = self.write_settlement('reference,amount\n')
+        with self.assertRaises(CommandError):
+            call_command('datacash_reconcile', path, stdout=six.StringIO(),
+                         stderr=six.StringIO())
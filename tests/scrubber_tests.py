@@ -0,0 +1,88 @@
+from django.core.management import call_command
+from django.db.models.query import QuerySet
+from django.test import TestCase
+from django.test.utils import override_settings
+from six import StringIO
+
+from datacash import fields
+from datacash.models import OrderTransaction
+from datacash.scrubber import Scrubber, scrub
+
+from . import fixtures
+
+
+class ScrubberTests(TestCase):
+
+    def test_masks_card_numbers_except_last_four_digits(self):
+        self.assertEqual('<Card><pan>XXXXXXXXXXXX0007</pan></Card>',
+                         scrub('<Card><pan>1000350000000007</pan></Card>'))
+        self.assertEqual('<alt_pan>XXXXXXXXX1234</alt_pan>',
+                         scrub('<alt_pan>4111111111234</alt_pan>'))
+
+    def test_masks_cv2_and_password(self):
+        self.assertEqual(
+            '<password>XXX</password><cv2>XXX</cv2>',
+            scrub('<password>s3cr&amp;t</password><cv2>123</cv2>'))
+
+    def test_masks_every_occurrence_in_one_pass(self):
+        xml = ('<password>a</password><pan>1000350000000007</pan>'
+               '<cv2>123</cv2><pan>1000010000000015</pan>')
+        self.assertEqual(
+            '<password>XXX</password><pan>XXXXXXXXXXXX0007</pan>'
+            '<cv2>XXX</cv2><pan>XXXXXXXXXXXX0015</pan>', scrub(xml))
+
+    def test_masks_bytes(self):
+        self.assertEqual(b'<pan>XXXXXXXXXXXX0007</pan><cv2>XXX</cv2>',
+                         scrub(b'<pan>1000350000000007</pan><cv2>123</cv2>'))
+
+    def test_leaves_other_elements_alone(self):
+        xml = fixtures.SAMPLE_DATACASH_REFERENCE_REQUEST
+        self.assertTrue('1234567890124209' in scrub(xml))
+        self.assertEqual('<pan>1234</pan>', scrub('<pan>1234</pan>'))
+
+    def test_elements_are_configurable(self):
+        scrubber = Scrubber(card_elements=('card',),
+                            secret_elements=('pin',), mask='***')
+        self.assertEqual('<card>XXXXXXXXXXXX0007</card><pin>***</pin>',
+                         scrubber.scrub('<card>1000350000000007</card>'
+                                        '<pin>1234</pin>'))
+
+
+class ScrubCommandTests(TestCase):
+
+    def setUp(self):
+        self.txn = OrderTransaction.objects.create(
+            order_number='1000', method='auth', status=1, reason='ACCEPTED',
+            request_xml='', response_xml='')
+        # Simulate a transaction saved before bulk writes were masked
+        QuerySet(OrderTransaction).filter(pk=self.txn.pk).update(
+            request_xml=fixtures.SAMPLE_REQUEST)
+
+    def test_masks_existing_transactions(self):
+        out = StringIO()
+        call_command('datacash_scrub', stdout=out)
+        self.assertTrue('1 of 1 transactions needed masking' in
+                        out.getvalue())
+        txn = OrderTransaction.objects.get(pk=self.txn.pk)
+        self.assertTrue('XXXXXXXXXXXX0004' in txn.request_xml)
+
+    def test_dry_run_doesnt_change_anything(self):
+        out = StringIO()
+        call_command('datacash_scrub', dry_run=True, stdout=out)
+        self.assertTrue('1 of 1 transactions need masking' in out.getvalue())
+        txn = OrderTransaction.objects.get(pk=self.txn.pk)
+        self.assertTrue('1000011100000004' in txn.request_xml)
+
+    @override_settings(DATACASH_COMPRESS_XML=True)
+    def test_masks_compressed_transactions(self):
+        # Compressed by an earlier version of datacash_compress_xml
+        QuerySet(OrderTransaction).filter(pk=self.txn.pk).update(
+            request_xml=fields.compress(fixtures.SAMPLE_REQUEST))
+        out = StringIO()
+        call_command('datacash_scrub', stdout=out)
+        self.assertTrue('1 of 1 transactions needed masking' in
+                        out.getvalue())
+        request_xml = OrderTransaction.objects.filter(
+            pk=self.txn.pk).values_list('request_xml', flat=True)[0]
+        self.assertTrue(fields.is_compressed(request_xml))
+        self.assertTrue('XXXXXXXXXXXX0004' in fields.decompress(request_xml))
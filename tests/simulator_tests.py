@@ -0,0 +1,126 @@
+import shutil
+import socket
+import tempfile
+from decimal import Decimal as D
+
+from django.test import TestCase
+from oscar.apps.payment.exceptions import GatewayError
+
+from datacash import connection, simulator
+from datacash.gateway import Gateway
+
+
+class SimulatorTestCase(TestCase):
+    simulator_kwargs = {}
+
+    def setUp(self):
+        self.simulator = simulator.Simulator(**self.simulator_kwargs).start()
+        self.gateway = self.create_gateway()
+
+    def tearDown(self):
+        connection.clear_pools()
+        self.simulator.stop()
+
+    def create_gateway(self, **kwargs):
+        return Gateway(self.simulator.host, '/Transaction', 'client',
+                       'password', use_ssl=False, **kwargs)
+
+    def auth(self, amount=D('10.00'), card_number='1000350000000007'):
+        return self.gateway.auth(amount=amount, currency='GBP',
+                                 card_number=card_number, expiry_date='10/12',
+                                 merchant_reference='TEST_132473839018')
+
+
+class SimulatorTests(SimulatorTestCase):
+
+    def test_accepts_payment(self):
+        response = self.auth()
+        self.assertTrue(response.is_successful())
+        self.assertEqual('TEST_132473839018', response['merchant_reference'])
+        self.assertTrue(response['auth_code'])
+
+    def test_declines_magic_card_number(self):
+        response = self.auth(card_number='4444333322221111')
+        self.assertTrue(response.is_declined())
+        self.assertEqual('VISA', response['card_scheme'])
+
+    def test_declines_magic_amount(self):
+        self.assertTrue(self.auth(amount=D('10.02')).is_declined())
+
+    def test_returns_error_for_magic_amount(self):
+        self.assertEqual(56, self.auth(amount=D('10.56')).status)
+
+    def test_historic_transactions(self):
+        response = self.gateway.fulfill(
+            amount=D('10.00'), currency='GBP', auth_code='123456',
+            txn_reference='4000000000000001')
+        self.assertEqual('FULFILLED OK', response.reason)
+        self.assertEqual('4000000000000001', response.datacash_reference)
+
+    def test_connections_are_reused(self):
+        for i in range(3):
+            self.auth()
+        self.assertEqual(2, self.gateway.pool_stats['hits'])
+
+
+class CredentialsTests(SimulatorTestCase):
+    simulator_kwargs = {'client': 'client', 'password': 'secret'}
+
+    def test_rejects_invalid_credentials(self):
+        self.assertEqual(10, self.auth().status)
+
+
+class ErrorInjectionTests(SimulatorTestCase):
+    simulator_kwargs = {'error_rate': 1}
+
+    def test_http_errors_raise_gateway_error(self):
+        with self.assertRaises(GatewayError):
+            self.auth()
+
+
+class ResetInjectionTests(SimulatorTestCase):
+    simulator_kwargs = {'reset_rate': 1}
+
+    def test_connection_reset_raises_error(self):
+        with self.assertRaises((socket.error, IOError)):
+            self.auth()
+
+
+class SlowDripTests(SimulatorTestCase):
+    simulator_kwargs = {'drip_delay': 0.2, 'drip_size': 64}
+
+    def test_read_timeout(self):
+        self.gateway = self.create_gateway(timeout=0.1)
+        with self.assertRaises(socket.timeout):
+            self.auth()
+
+
+class HttpsTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        try:
+            certfile, keyfile = simulator.generate_certificate(self.directory)
+        except OSError:
+            self.skipTest("openssl is not available")
+        self.simulator = simulator.Simulator(
+            certfile=certfile, keyfile=keyfile).start()
+        self.certfile = certfile
+
+    def tearDown(self):
+        connection.clear_pools()
+        self.simulator.stop()
+        shutil.rmtree(self.directory)
+
+    def test_accepts_payment_over_https(self):
+        import ssl
+        context = ssl.create_default_context(cafile=self.certfile)
+        # Python 2 can't match a certificate against an IP address
+        host = 'localhost:%d' % self.simulator.server.server_address[1]
+        gateway = Gateway(host, '/Transaction', 'client', 'password',
+                          ssl_context=context)
+        response = gateway.auth(amount=D('10.00'), currency='GBP',
+                                card_number='1000350000000007',
+                                expiry_date='10/12',
+                                merchant_reference='TEST_132473839018')
+        self.assertTrue(response.is_successful())
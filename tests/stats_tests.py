@@ -0,0 +1,205 @@
+import datetime
+from decimal import Decimal as D
+
+import mock
+import six
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+
+from datacash import stats
+from datacash.dashboard import views
+from datacash.facade import Facade
+from datacash.models import OrderTransaction, PaymentStatistic
+
+from . import fixtures
+
+HOUR = datetime.datetime(2014, 1, 1, 12)
+
+
+def create_txn(minutes=0, method='auth', status=1, amount=D('10.00'),
+               currency='GBP', response_xml=fixtures.SAMPLE_RESPONSE):
+    txn = OrderTransaction.objects.create(
+        order_number='1000', method=method, amount=amount, currency=currency,
+        status=status, reason='', request_xml='', response_xml=response_xml)
+    OrderTransaction.objects.filter(pk=txn.pk).update(
+        date_created=HOUR + datetime.timedelta(minutes=minutes))
+    return txn
+
+
+class CatchUpTests(TestCase):
+
+    def test_rolls_up_transactions_by_hour_and_key(self):
+        create_txn(minutes=1)
+        create_txn(minutes=59, amount=D('5.50'))
+        create_txn(minutes=61)
+        create_txn(minutes=2, status=7)
+        self.assertEqual(4, stats.catch_up(batch_size=3))
+
+        stat = PaymentStatistic.objects.get(hour=HOUR, status=1)
+        self.assertEqual(2, stat.num_transactions)
+        self.assertEqual(D('15.50'), stat.total_amount)
+        self.assertEqual('GBP', stat.currency)
+        self.assertEqual('auth', stat.method)
+        self.assertEqual(3, PaymentStatistic.objects.count())
+
+    def test_card_scheme_is_read_from_the_response(self):
+        create_txn()
+        stats.catch_up()
+        self.assertEqual('Switch', PaymentStatistic.objects.get().card_scheme)
+
+    def test_only_new_transactions_are_added(self):
+        create_txn()
+        stats.catch_up()
+        create_txn(minutes=5)
+        self.assertEqual(1, stats.catch_up())
+        self.assertEqual(
+            2, PaymentStatistic.objects.get().num_transactions)
+
+    def test_recent_transactions_are_left_for_the_next_run(self):
+        create_txn()
+        OrderTransaction.objects.create(
+            order_number='1001', method='auth', amount=D('1.00'), status=1,
+            reason='', request_xml='', response_xml='')
+        self.assertEqual(1, stats.catch_up(lag=60))
+        self.assertEqual(1, stats.catch_up(lag=0))
+
+    def test_rebuild(self):
+        create_txn()
+        stats.catch_up()
+        PaymentStatistic.objects.update(num_transactions=99)
+        self.assertEqual(1, stats.rebuild())
+        self.assertEqual(1, PaymentStatistic.objects.get().num_transactions)
+
+
+class RealtimeTests(TestCase):
+
+    def record(self, status):
+        response = mock.Mock()
+        response.status = status
+        response.__getitem__ = mock.Mock(side_effect=lambda key: {
+            'card_scheme': 'VISA'}.get(key, '1'))
+        response.request_xml = ''
+        response.response_xml = ''
+        Facade().record_txn('auth', '1000', D('12.00'), 'GBP', response)
+
+    def test_statistics_are_not_updated_by_default(self):
+        self.record(1)
+        self.assertEqual(0, PaymentStatistic.objects.count())
+
+    @override_settings(DATACASH_STATS_REALTIME=True)
+    def test_record_txn_updates_statistics(self):
+        self.record(1)
+        self.record(1)
+        self.record(7)
+        stat = PaymentStatistic.objects.get(status=1)
+        self.assertEqual(2, stat.num_transactions)
+        self.assertEqual(D('24.00'), stat.total_amount)
+        self.assertEqual('VISA', stat.card_scheme)
+
+    @override_settings(DATACASH_STATS_REALTIME=True)
+    def test_statistics_errors_are_not_raised(self):
+        with mock.patch('datacash.stats.record',
+                        side_effect=Exception("Database error")):
+            self.record(1)
+        self.assertEqual(1, OrderTransaction.objects.count())
+
+    def test_rebuild_detects_realtime_updates_while_it_runs(self):
+        create_txn()
+        card_scheme_from_xml = stats.card_scheme_from_xml
+
+        def record_meanwhile(response_xml):
+            # Another process with realtime updates still enabled
+            stats.record(create_txn(minutes=5))
+            return card_scheme_from_xml(response_xml)
+
+        with mock.patch('datacash.stats.card_scheme_from_xml',
+                        record_meanwhile):
+            with self.assertRaises(stats.StatisticsError):
+                stats.rebuild()
+
+    def test_catch_up_refuses_to_double_count(self):
+        stats.catch_up()
+        with override_settings(DATACASH_STATS_REALTIME=True):
+            self.record(1)
+        create_txn()
+        with self.assertRaises(stats.StatisticsError):
+            stats.catch_up()
+        self.assertEqual(2, stats.rebuild())
+        self.assertEqual(0, stats.catch_up())
+        self.assertEqual(
+            2, sum(PaymentStatistic.objects.values_list(
+                'num_transactions', flat=True)))
+
+
+class SummaryTests(TestCase):
+
+    def setUp(self):
+        create_txn(status=1)
+        create_txn(status=1, method='pre')
+        create_txn(status=7)
+        create_txn(status=21)
+        create_txn(status=1, currency='EUR', amount=D('3.00'))
+        stats.catch_up()
+
+    def test_summarise_by_method(self):
+        rows = stats.summarise(HOUR.date(), HOUR.date() +
+                               datetime.timedelta(days=1))
+        self.assertEqual([('auth', 'EUR'), ('auth', 'GBP'), ('pre', 'GBP')],
+                         [(row['value'], row['currency']) for row in rows])
+        auth = rows[1]
+        self.assertEqual(3, auth['num_transactions'])
+        self.assertEqual(1, auth['num_accepted'])
+        self.assertEqual(1, auth['num_declined'])
+        self.assertEqual(1, auth['num_errors'])
+        self.assertAlmostEqual(33.3, auth['accepted_rate'], places=1)
+        self.assertEqual(D('10.00'), auth['accepted_amount'])
+        self.assertEqual(D('30.00'), auth['total_amount'])
+
+    def test_summarise_by_currency(self):
+        rows = stats.summarise(HOUR.date(), HOUR.date() +
+                               datetime.timedelta(days=1), 'currency')
+        self.assertEqual(['EUR', 'GBP'], [row['value'] for row in rows])
+
+    def test_view_reads_only_statistics(self):
+        request = RequestFactory().get('/', {
+            'date_from': '2014-01-01', 'date_to': '2014-01-01',
+            'group_by': 'status'})
+        with self.assertNumQueries(1):
+            context = views.StatisticsView.as_view()(request).context_data
+        self.assertEqual([1, 1, 7, 21],
+                         [row['value'] for row in context['rows']])
+
+    def test_view_defaults_to_the_last_week(self):
+        request = RequestFactory().get('/', {'date_from': 'nonsense'})
+        context = views.StatisticsView.as_view()(request).context_data
+        self.assertEqual(datetime.date.today(), context['date_to'])
+        self.assertTrue(context['form'].errors)
+
+
+class RollupCommandTests(TestCase):
+
+    def test_catches_up(self):
+        create_txn()
+        out = six.StringIO()
+        call_command('datacash_rollup_stats', stdout=out)
+        self.assertEqual('Added 1 transactions to the statistics',
+                         out.getvalue().strip())
+
+    @override_settings(DATACASH_STATS_REALTIME=True)
+    def test_refuses_to_double_count(self):
+        with self.assertRaises(CommandError):
+            call_command('datacash_rollup_stats', stdout=six.StringIO())
+        with self.assertRaises(CommandError):
+            call_command('datacash_rollup_stats', rebuild=True,
+                         stdout=six.StringIO())
+
+    def test_requires_a_rebuild_after_realtime_updates(self):
+        stats.record(create_txn())
+        with self.assertRaises(CommandError):
+            call_command('datacash_rollup_stats', stdout=six.StringIO())
+        call_command('datacash_rollup_stats', rebuild=True,
+                     stdout=six.StringIO())
+        call_command('datacash_rollup_stats', stdout=six.StringIO())
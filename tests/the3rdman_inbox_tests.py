@@ -0,0 +1,323 @@
+import datetime
+
+import mock
+import six
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.db import connection, IntegrityError
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+
+from datacash.models import FraudCallback, FraudResponse
+from datacash.the3rdman import inbox, signals
+
+from .the3rdman_callback_tests import HOLD_RESPONSE, RELEASE_RESPONSE
+
+
+class SignalRecorder(object):
+
+    def __init__(self):
+        self.responses = []
+
+    def __call__(self, sender, response, **kwargs):
+        self.responses.append(response)
+
+    def __enter__(self):
+        signals.response_received.connect(self)
+        return self
+
+    def __exit__(self, *args):
+        signals.response_received.disconnect(self)
+
+
+@override_settings(DATACASH_3RDMAN_ACK_FIRST=True)
+class TestAckFirstCallbackView(TestCase):
+
+    def post(self, body):
+        return self.client.post(reverse('datacash-3rdman-callback'), body,
+                                content_type="text/xml")
+
+    def test_stores_the_body_without_processing_it(self):
+        with SignalRecorder() as recorder:
+            response = self.post(HOLD_RESPONSE)
+        self.assertEqual(b"ok", response.content)
+        self.assertEqual([], recorder.responses)
+        self.assertEqual(0, FraudResponse.objects.count())
+        callback = FraudCallback.objects.get()
+        self.assertEqual(HOLD_RESPONSE.decode('utf8'), callback.raw_body)
+
+    def test_stores_invalid_bodies_too(self):
+        response = self.post(b'<xml>')
+        self.assertEqual(b"ok", response.content)
+        self.assertEqual(1, FraudCallback.objects.count())
+
+    def test_stores_bodies_which_arent_utf8(self):
+        body = HOLD_RESPONSE.replace(b'100117', b'100117\xe9')
+        self.assertEqual(b"ok", self.post(body).content)
+        callback = FraudCallback.objects.get()
+        self.assertEqual(body, callback.body)
+
+        # and the worker marks it as failed rather than the view rejecting it
+        self.assertEqual((0, 1), inbox.drain())
+        self.assertIn('Error', FraudCallback.objects.get().last_error)
+
+    def test_responds_with_an_error_if_the_body_cant_be_stored(self):
+        with mock.patch.object(inbox, 'store', side_effect=Exception):
+            response = self.post(HOLD_RESPONSE)
+        self.assertEqual(b"error", response.content)
+
+    @override_settings(DATACASH_3RDMAN_ACK_FIRST=False)
+    def test_is_off_by_default(self):
+        self.post(HOLD_RESPONSE)
+        self.assertEqual(0, FraudCallback.objects.count())
+        self.assertEqual(1, FraudResponse.objects.count())
+
+
+class TestDrain(TestCase):
+
+    def test_creates_fraud_responses_in_order_and_raises_the_signal(self):
+        inbox.store(HOLD_RESPONSE)
+        inbox.store(RELEASE_RESPONSE)
+        with SignalRecorder() as recorder:
+            self.assertEqual((2, 0), inbox.drain(batch_size=1))
+        self.assertEqual([FraudResponse.HOLD, FraudResponse.RELEASE],
+                         [r.recommendation for r in recorder.responses])
+        self.assertEqual(2, FraudResponse.objects.count())
+        self.assertEqual(0, FraudCallback.objects.count())
+
+    def test_failures_are_retried_with_a_growing_delay(self):
+        inbox.store(b'<xml>')
+        inbox.store(HOLD_RESPONSE)
+        self.assertEqual((1, 1), inbox.drain(retry_delay=60))
+
+        callback = FraudCallback.objects.get()
+        self.assertEqual(1, callback.attempts)
+        self.assertFalse(callback.failed)
+        self.assertIn('Error', callback.last_error)
+        self.assertTrue(callback.next_attempt > timezone.now() +
+                        datetime.timedelta(seconds=50))
+        # Not due yet
+        self.assertEqual((0, 0), inbox.drain())
+
+        FraudCallback.objects.update(next_attempt=timezone.now())
+        inbox.drain(retry_delay=60)
+        callback = FraudCallback.objects.get()
+        self.assertEqual(2, callback.attempts)
+        self.assertTrue(callback.next_attempt > timezone.now() +
+                        datetime.timedelta(seconds=110))
+
+    def test_callbacks_are_marked_failed_after_max_attempts(self):
+        inbox.store(b'<xml>')
+        for i in range(3):
+            inbox.drain(max_attempts=3, retry_delay=0)
+        callback = FraudCallback.objects.get()
+        self.assertTrue(callback.failed)
+        self.assertEqual(3, callback.attempts)
+        self.assertEqual((0, 0), inbox.drain(retry_delay=0))
+
+        self.assertEqual(1, inbox.retry_failed())
+        callback = FraudCallback.objects.get()
+        self.assertFalse(callback.failed)
+        self.assertEqual(0, callback.attempts)
+
+    def test_a_failed_insert_is_rolled_back(self):
+        inbox.store(HOLD_RESPONSE)
+        save_unless_repeat = FraudResponse.save_unless_repeat
+
+        def save_then_fail(response):
+            save_unless_repeat(response)
+            raise Exception("Database error")
+
+        with mock.patch.object(FraudResponse, 'save_unless_repeat',
+                               save_then_fail):
+            self.assertEqual((0, 1), inbox.drain())
+        self.assertEqual(0, FraudResponse.objects.count())
+        self.assertEqual(1, FraudCallback.objects.count())
+
+    def test_callbacks_processed_elsewhere_arent_counted_as_failures(self):
+        inbox.store(HOLD_RESPONSE)
+        select_for_update = FraudCallback.objects.select_for_update
+
+        def processed_elsewhere():
+            # Another worker deletes the callback once this one has read it
+            FraudCallback.objects.all().delete()
+            return select_for_update()
+
+        with mock.patch.object(FraudCallback.objects, 'select_for_update',
+                               processed_elsewhere):
+            self.assertEqual((0, 0), inbox.drain())
+
+    def test_signal_is_sent_after_the_callback_is_deleted(self):
+        callback = inbox.store(HOLD_RESPONSE)
+        pending = []
+
+        def receiver(sender, response, **kwargs):
+            pending.append(FraudCallback.objects.filter(
+                pk=callback.pk).exists())
+
+        signals.response_received.connect(receiver)
+        try:
+            inbox.process(callback)
+        finally:
+            signals.response_received.disconnect(receiver)
+        self.assertEqual([False], pending)
+
+    def test_receiver_errors_dont_requeue_the_callback(self):
+        inbox.store(HOLD_RESPONSE)
+
+        def receiver(sender, response, **kwargs):
+            raise Exception("Unable to hold order")
+
+        signals.response_received.connect(receiver)
+        try:
+            self.assertEqual((1, 0), inbox.drain())
+        finally:
+            signals.response_received.disconnect(receiver)
+        self.assertEqual(1, FraudResponse.objects.count())
+        self.assertEqual(0, FraudCallback.objects.count())
+
+    def test_callbacks_processed_elsewhere_are_skipped(self):
+        callback = inbox.store(HOLD_RESPONSE)
+        FraudCallback.objects.all().delete()
+        self.assertIs(inbox.SKIPPED, inbox.process(callback))
+        self.assertEqual(0, FraudResponse.objects.count())
+
+
+class TestProcessCallbacksCommand(TestCase):
+
+    def test_processes_stored_callbacks(self):
+        inbox.store(HOLD_RESPONSE)
+        inbox.store(b'<xml>')
+        out = six.StringIO()
+        call_command('datacash_process_callbacks', stdout=out)
+        self.assertIn("Processed 1 callbacks (1 failed)", out.getvalue())
+        self.assertEqual(1, FraudResponse.objects.count())
+
+
+def stub_callback(t3m_id, recommendation=1):
+    return HOLD_RESPONSE.replace(
+        b'<t3m_id>1815120370', b'<t3m_id>' + t3m_id).replace(
+            b'<recommendation>1',
+            ('<recommendation>%d' % recommendation).encode('ascii'))
+
+
+class BatchRecorder(SignalRecorder):
+
+    def __init__(self):
+        super(BatchRecorder, self).__init__()
+        self.batches = []
+
+    def record_batch(self, sender, responses, **kwargs):
+        self.batches.append(responses)
+
+    def __enter__(self):
+        signals.responses_received.connect(self.record_batch)
+        return super(BatchRecorder, self).__enter__()
+
+    def __exit__(self, *args):
+        signals.responses_received.disconnect(self.record_batch)
+        super(BatchRecorder, self).__exit__(*args)
+
+
+class TestBatchDrain(TestCase):
+
+    def test_signal_is_sent_after_the_callbacks_are_deleted(self):
+        inbox.store(stub_callback(b'1'))
+        pending = []
+
+        def receiver(sender, responses, **kwargs):
+            pending.append(FraudCallback.objects.count())
+
+        signals.responses_received.connect(receiver)
+        try:
+            inbox.drain(batch=True)
+        finally:
+            signals.responses_received.disconnect(receiver)
+        self.assertEqual([0], pending)
+
+    def test_sends_one_signal_per_batch(self):
+        for t3m_id in (b'1', b'2', b'3'):
+            inbox.store(stub_callback(t3m_id))
+        with BatchRecorder() as recorder:
+            self.assertEqual((3, 0), inbox.drain(batch_size=2, batch=True))
+        self.assertEqual([], recorder.responses)
+        self.assertEqual([['1', '2'], ['3']],
+                         [[r.t3m_id for r in batch]
+                          for batch in recorder.batches])
+        saved = FraudResponse.objects.get(t3m_id='1')
+        self.assertEqual(saved.pk, recorder.batches[0][0].pk)
+        self.assertEqual(0, FraudCallback.objects.count())
+
+    def test_creates_a_batch_with_one_insert(self):
+        for t3m_id in (b'1', b'2', b'3'):
+            inbox.store(stub_callback(t3m_id))
+        callbacks = list(FraudCallback.objects.all())
+        with CaptureQueriesContext(connection) as context:
+            inbox.process_batch(callbacks)
+        inserts = [query for query in context.captured_queries
+                   if 'INSERT' in query['sql']]
+        self.assertEqual(1, len(inserts))
+        self.assertEqual(3, FraudResponse.objects.count())
+
+    def test_repeats_are_dropped(self):
+        FraudResponse.create_from_body(stub_callback(b'1'))
+        inbox.store(stub_callback(b'1'))
+        inbox.store(stub_callback(b'2'))
+        inbox.store(stub_callback(b'2'))
+        inbox.store(stub_callback(b'2', recommendation=0))
+        with BatchRecorder() as recorder:
+            self.assertEqual((4, 0), inbox.drain(batch=True))
+        self.assertEqual([[('2', 1), ('2', 0)]],
+                         [[(r.t3m_id, r.recommendation) for r in batch]
+                          for batch in recorder.batches])
+        self.assertEqual(3, FraudResponse.objects.count())
+        self.assertEqual(0, FraudCallback.objects.count())
+
+    def test_invalid_callbacks_are_retried(self):
+        inbox.store(stub_callback(b'1'))
+        inbox.store(b'<xml>')
+        self.assertEqual((1, 1), inbox.drain(batch=True))
+        callback = FraudCallback.objects.get()
+        self.assertEqual(1, callback.attempts)
+        self.assertEqual(1, FraudResponse.objects.count())
+
+    def test_conflicting_inserts_are_retried(self):
+        inbox.store(stub_callback(b'1'))
+        bulk_create = FraudResponse.objects.bulk_create
+        calls = []
+
+        def conflicting_bulk_create(objs):
+            # As if another process saved the same response in the meantime
+            calls.append(objs)
+            if len(calls) == 1:
+                raise IntegrityError
+            return bulk_create(objs)
+
+        with mock.patch.object(FraudResponse.objects, 'bulk_create',
+                               conflicting_bulk_create):
+            with BatchRecorder() as recorder:
+                self.assertEqual((1, 0), inbox.drain(batch=True))
+        self.assertEqual(2, len(calls))
+        self.assertEqual(1, len(recorder.batches))
+        self.assertEqual(1, FraudResponse.objects.count())
+
+    def test_repeated_conflicts_fall_back_to_processing_each_callback(self):
+        inbox.store(stub_callback(b'1'))
+        inbox.store(b'<?xml <')
+        with mock.patch.object(FraudResponse.objects, 'bulk_create',
+                               side_effect=IntegrityError):
+            self.assertEqual((1, 1), inbox.drain(batch=True))
+        self.assertEqual(1, FraudResponse.objects.count())
+        callback = FraudCallback.objects.get()
+        self.assertEqual(1, callback.attempts)
+        self.assertTrue(callback.last_error)
+
+    def test_command_processes_in_batches(self):
+        inbox.store(stub_callback(b'1'))
+        out = six.StringIO()
+        with BatchRecorder() as recorder:
+            call_command('datacash_process_callbacks', batch=True,
+                         stdout=out)
+        self.assertIn("Processed 1 callbacks (0 failed)", out.getvalue())
+        self.assertEqual(1, len(recorder.batches))
@@ -1,6 +1,9 @@
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
 from datacash import models
+from datacash.the3rdman import signals
 
 XML_RESPONSE = """<?xml version="1.0"?>
 <RealTimeResponse xmlns="T3MCallback">
@@ -45,3 +48,58 @@ class TestFormURLEncodedResponse(TestCase):
     def test_for_smoke(self):
         response = models.FraudResponse.create_from_querystring(QUERY_RESPONSE)
         self.assertTrue(response.rejected)
+
+
+class TestRepeatedCallbacks(TestCase):
+
+    def setUp(self):
+        self.received = []
+        signals.response_received.connect(self.receiver)
+
+    def tearDown(self):
+        signals.response_received.disconnect(self.receiver)
+
+    def receiver(self, sender, response, **kwargs):
+        self.received.append(response)
+
+    def test_repeat_returns_the_existing_response(self):
+        first = models.FraudResponse.create_from_xml(stub_response(score=10))
+        repeat = models.FraudResponse.create_from_xml(stub_response(score=10))
+        self.assertEqual(first.pk, repeat.pk)
+        self.assertEqual(1, models.FraudResponse.objects.count())
+
+    def test_repeat_doesnt_raise_the_signal_again(self):
+        models.FraudResponse.create_from_querystring(QUERY_RESPONSE)
+        models.FraudResponse.create_from_querystring(QUERY_RESPONSE)
+        self.assertEqual(1, len(self.received))
+
+    def test_new_recommendation_for_the_same_transaction_is_stored(self):
+        models.FraudResponse.create_from_xml(stub_response(recommendation=1))
+        models.FraudResponse.create_from_xml(stub_response(recommendation=0))
+        self.assertEqual(2, models.FraudResponse.objects.count())
+        self.assertEqual(2, len(self.received))
+
+    def test_new_response_is_a_single_insert(self):
+        with CaptureQueriesContext(connection) as context:
+            models.FraudResponse.create_from_xml(stub_response())
+        sql = [query['sql'] for query in context.captured_queries]
+        # Ignoring any savepoint
+        self.assertEqual(1, len([q for q in sql if 'INSERT' in q]))
+        self.assertEqual(0, len([q for q in sql if 'SELECT' in q]))
+
+    def test_repeats_are_found_by_a_fixed_length_digest(self):
+        xml = stub_response().replace(
+            '<t3m_id>333333333', '<t3m_id>' + '3' * 128).replace(
+                '<message_digest>', '<message_digest>' + 'a' * 128)
+        first = models.FraudResponse.create_from_xml(xml)
+        self.assertEqual(40, len(first.repeat_digest))
+        self.assertEqual(first.pk,
+                         models.FraudResponse.create_from_xml(xml).pk)
+
+    def test_digest_is_set_when_saved(self):
+        response = models.FraudResponse.objects.create(
+            merchant_identifier='1', merchant_order_ref='100_AUTH',
+            t3m_id='123', score=0, recommendation=1, raw_response='')
+        self.assertEqual(models.FraudResponse(
+            t3m_id='123', recommendation=1, message_digest=''
+        ).set_repeat_digest().repeat_digest, response.repeat_digest)
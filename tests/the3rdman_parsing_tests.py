@@ -0,0 +1,112 @@
+from xml.dom.minidom import parseString
+from xml.parsers.expat import ExpatError
+
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+from django.test.utils import override_settings
+from six.moves.urllib.parse import parse_qs
+
+from datacash.models import FraudCallback, FraudResponse
+from datacash.the3rdman import parsing
+
+from .the3rdman_callback_tests import (
+    SUCCESS_RESPONSE, HOLD_RESPONSE, RELEASE_RESPONSE)
+from .the3rdman_model_tests import QUERY_RESPONSE
+
+ENTITY_EXPANSION = b"""<?xml version="1.0"?>
+<!DOCTYPE lolz [
+  <!ENTITY lol "lol">
+  <!ENTITY lol2 "&lol;&lol;&lol;&lol;&lol;&lol;&lol;&lol;&lol;&lol;">
+  <!ENTITY lol3 "&lol2;&lol2;&lol2;&lol2;&lol2;&lol2;&lol2;&lol2;&lol2;">
+]>
+<RealTimeCallBack><t3m_id>&lol3;</t3m_id></RealTimeCallBack>"""
+
+EXTERNAL_ENTITY = b"""<?xml version="1.0"?>
+<!DOCTYPE foo [<!ENTITY xxe SYSTEM "file:///etc/passwd">]>
+<RealTimeCallBack><t3m_id>&xxe;</t3m_id></RealTimeCallBack>"""
+
+
+def minidom_fields(xml_str):
+    # The fields as FraudResponse read them with minidom
+    doc = parseString(xml_str)
+    fields = {}
+    for name in parsing.FIELDS:
+        elements = doc.getElementsByTagName(name)
+        fields[name] = (elements[0].firstChild.data
+                        if elements and elements[0].firstChild else '')
+    return fields
+
+
+class TestParseXml(TestCase):
+
+    def test_matches_minidom(self):
+        for xml in (SUCCESS_RESPONSE, HOLD_RESPONSE, RELEASE_RESPONSE):
+            self.assertEqual(minidom_fields(xml), parsing.parse_callback(xml))
+
+    def test_reads_fields(self):
+        fields = parsing.parse_callback(HOLD_RESPONSE)
+        self.assertEqual('1815120370', fields['t3m_id'])
+        self.assertEqual('', fields['aggregator_identifier'])
+        self.assertEqual('baa7421d73c962ce92220e64526af1a559f26f46',
+                         fields['message_digest'])
+
+    def test_missing_fields_are_blank(self):
+        fields = parsing.parse_xml(b'<?xml version="1.0"?><a><score>1</score>'
+                                   b'<score>2</score></a>')
+        self.assertEqual('1', fields['score'])
+        self.assertEqual('', fields['t3m_id'])
+
+    def test_malformed_xml_raises_an_error(self):
+        with self.assertRaises(ExpatError):
+            parsing.parse_callback(HOLD_RESPONSE[:100])
+
+    def test_rejects_entity_declarations(self):
+        for xml in (ENTITY_EXPANSION, EXTERNAL_ENTITY):
+            with self.assertRaises(parsing.InvalidCallback):
+                parsing.parse_callback(xml)
+
+    def test_rejects_large_bodies(self):
+        xml = HOLD_RESPONSE.replace(
+            b'<aggregator_identifier/>',
+            b'<aggregator_identifier>' + b'x' * parsing.MAX_SIZE +
+            b'</aggregator_identifier>')
+        with self.assertRaises(parsing.InvalidCallback):
+            parsing.parse_callback(xml)
+
+
+class TestParseQuerystring(TestCase):
+
+    def test_matches_parse_qs(self):
+        data = parse_qs(QUERY_RESPONSE)
+        expected = dict((name, data.get(name, [''])[0])
+                        for name in parsing.FIELDS)
+        self.assertEqual(expected, parsing.parse_callback(QUERY_RESPONSE))
+
+    def test_decodes_values(self):
+        fields = parsing.parse_callback(
+            b'merchant_order_ref=100%5F1+2&score=3&score=4&junk')
+        self.assertEqual(u'100_1 2', fields['merchant_order_ref'])
+        self.assertEqual(u'3', fields['score'])
+        self.assertEqual(u'', fields['t3m_id'])
+
+    def test_rejects_large_bodies(self):
+        with self.assertRaises(parsing.InvalidCallback):
+            parsing.parse_callback(
+                QUERY_RESPONSE + '&x=' + 'x' * parsing.MAX_SIZE)
+
+
+class TestCallbackViewLimits(TestCase):
+
+    def post(self, body):
+        return self.client.post(reverse('datacash-3rdman-callback'), body,
+                                content_type="text/xml")
+
+    def test_entity_expansion_is_rejected(self):
+        self.assertEqual(b"error", self.post(ENTITY_EXPANSION).content)
+        self.assertEqual(0, FraudResponse.objects.count())
+
+    @override_settings(DATACASH_3RDMAN_ACK_FIRST=True)
+    def test_large_bodies_arent_stored(self):
+        response = self.post(b'x' * (parsing.MAX_SIZE + 1))
+        self.assertEqual(b"error", response.content)
+        self.assertEqual(0, FraudCallback.objects.count())